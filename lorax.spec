@@ -45,7 +45,6 @@ Requires:       xz
 Requires:       pigz
 Requires:       pbzip2
 Requires:       dracut >= 030
-Requires:       kpartx
 Requires:       psmisc
 
 # Python modules
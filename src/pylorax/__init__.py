@@ -44,6 +44,7 @@ import libdnf5 as dnf5
 from pylorax.sysutils import joinpaths, remove, linktree
 
 from pylorax.treebuilder import RuntimeBuilder, TreeBuilder
+from pylorax.ltmpl import TemplateProfile, TemplateJournal
 from pylorax.buildstamp import BuildStamp
 from pylorax.treeinfo import TreeInfo
 from pylorax.discinfo import DiscInfo
@@ -59,6 +60,8 @@ else:
     vernum = pylorax.version.num
 
 DRACUT_DEFAULT = ["--xz", "--install", "/.buildstamp", "--no-early-microcode", "--add", "fips"]
+# Added to the dracut args for an erofs runtime, the initrd has to be able to mount it
+DRACUT_EROFS = ["--add-drivers", "erofs"]
 
 # Used for DNF conf.module_platform_id
 DEFAULT_PLATFORM_ID = "platform:f41"
@@ -137,6 +140,9 @@ class Lorax(BaseLoraxClass):
         self.conf.set("lorax", "debug", "1")
         self.conf.set("lorax", "sharedir", "/usr/share/lorax")
         self.conf.set("lorax", "logdir", "/var/log/lorax")
+        self.conf.set("lorax", "templatecache", "/var/cache/lorax/template-cache")
+        self.conf.set("lorax", "profile", "0")
+        self.conf.set("lorax", "treeindex", "0")
 
         self.conf.add_section("output")
         self.conf.set("output", "colors", "1")
@@ -220,7 +226,12 @@ class Lorax(BaseLoraxClass):
             verify=True,
             user_dracut_args=None,
             squashfs_only=False,
-            skip_branding=False):
+            erofs=False,
+            skip_branding=False,
+            resume=False,
+            journal=False,
+            installexcludes=None,
+            installexcludes_reference=None):
 
         assert self._configured
 
@@ -293,81 +304,127 @@ class Lorax(BaseLoraxClass):
             logger.fatal("the volume id cannot be longer than 32 characters")
             sys.exit(1)
 
-        # NOTE: rb.root = dbo.get_config().installroot (== self.inroot)
-        rb = RuntimeBuilder(product=self.product, arch=self.arch,
-                            dbo=dbo, templatedir=self.templatedir,
-                            installpkgs=installpkgs,
-                            excludepkgs=excludepkgs,
-                            add_templates=add_templates,
-                            add_template_vars=add_template_vars,
-                            skip_branding=skip_branding)
+        # Compiled templates are only reused by the same version of lorax
+        templatecache = self.conf.get("lorax", "templatecache")
+        if templatecache:
+            templatecache = joinpaths(templatecache, vernum)
+            logger.debug("using template cache %s", templatecache)
 
-        logger.info("installing runtime packages")
-        rb.install()
+        # Record the time taken by each template command
+        profile = None
+        if self.conf.getboolean("lorax", "profile"):
+            profile = TemplateProfile(joinpaths(logdir, "template-profile.json"))
+            logger.debug("writing template profile to %s", profile.path)
 
-        # write .buildstamp
-        buildstamp = BuildStamp(self.product.name, self.product.version,
-                                self.product.bugurl, self.product.isfinal,
-                                self.arch.buildarch, self.product.variant)
+        # Record the template lines that complete, so that a failed build can be resumed
+        template_journal = None
+        if journal or resume:
+            template_journal = TemplateJournal(joinpaths(self.workdir, "template-journal.jsonl"),
+                                               resume=resume)
 
-        buildstamp.write(joinpaths(self.inroot, ".buildstamp"))
-
-        if self.debug:
-            logger.info("writing debug data to pkglists and original-pkgsizes.txt")
-            rb.writepkglists(joinpaths(logdir, "pkglists"))
-            rb.writepkgsizes(joinpaths(logdir, "original-pkgsizes.txt"))
-
-        logger.info("doing post-install configuration")
-        rb.postinstall()
-
-        # write .discinfo
-        discinfo = DiscInfo(self.product.release, self.arch.basearch)
-        discinfo.write(joinpaths(self.outputdir, ".discinfo"))
-
-        logger.info("backing up installroot")
         installroot = joinpaths(self.workdir, "installroot")
-        linktree(self.inroot, installroot)
-
-        logger.info("generating kernel module metadata")
-        rb.generate_module_data()
-
-        logger.info("cleaning unneeded files")
-        rb.cleanup()
-
-        if verify:
-            logger.info("verifying the installroot")
-            if not rb.verify():
+        runtime = "images/install.img"
+        if resume:
+            # The package transaction cannot be resumed, only the steps after the runtime image
+            if not template_journal.step_done("runtime") or not os.path.exists(joinpaths(installroot, runtime)):
+                logger.critical("cannot resume, the runtime image in %s was not finished", installroot)
                 sys.exit(1)
+            logger.info("resuming with the runtime image in %s", installroot)
         else:
-            logger.info("Skipping verify")
-
-        if self.debug:
-            rb.writepkgsizes(joinpaths(logdir, "final-pkgsizes.txt"))
-
-        logger.info("creating the runtime image")
-        runtime = "images/install.img"
-        compression = self.conf.get("compression", "type")
-        compressargs = self.conf.get("compression", "args").split()     # pylint: disable=no-member
-        if self.conf.getboolean("compression", "bcj"):
-            if self.arch.bcj:
-                compressargs += ["-Xbcj", self.arch.bcj]
+            # NOTE: rb.root = dbo.get_config().installroot (== self.inroot)
+            rb = RuntimeBuilder(product=self.product, arch=self.arch,
+                                dbo=dbo, templatedir=self.templatedir,
+                                installpkgs=installpkgs,
+                                excludepkgs=excludepkgs,
+                                add_templates=add_templates,
+                                add_template_vars=add_template_vars,
+                                skip_branding=skip_branding,
+                                templatecache=templatecache,
+                                profile=profile,
+                                journal=template_journal,
+                                installexcludes=installexcludes,
+                                treeindex=self.conf.getboolean("lorax", "treeindex"))
+
+            logger.info("installing runtime packages")
+            rb.install()
+
+            # write .buildstamp
+            buildstamp = BuildStamp(self.product.name, self.product.version,
+                                    self.product.bugurl, self.product.isfinal,
+                                    self.arch.buildarch, self.product.variant)
+
+            buildstamp.write(joinpaths(self.inroot, ".buildstamp"))
+
+            if self.debug:
+                logger.info("writing debug data to pkglists and original-pkgsizes.txt")
+                rb.writepkglists(joinpaths(logdir, "pkglists"))
+                rb.writepkgsizes(joinpaths(logdir, "original-pkgsizes.txt"),
+                                 self.conf.get("compression", "type"))
+
+            logger.info("doing post-install configuration")
+            rb.postinstall()
+
+            # write .discinfo
+            discinfo = DiscInfo(self.product.release, self.arch.basearch)
+            discinfo.write(joinpaths(self.outputdir, ".discinfo"))
+
+            logger.info("backing up installroot")
+            linktree(self.inroot, installroot).log("backing up installroot")
+
+            logger.info("generating kernel module metadata")
+            rb.generate_module_data()
+
+            logger.info("cleaning unneeded files")
+            rb.cleanup()
+
+            if installexcludes == "verify":
+                logger.info("verifying the package files that were not installed")
+                if not rb.verify_excludes(installexcludes_reference):
+                    sys.exit(1)
+            elif self.debug:
+                # A reference for builds with --install-excludes verify
+                rb.write_manifest(joinpaths(logdir, "runtime-manifest.json"))
+
+            if verify:
+                logger.info("verifying the installroot")
+                if not rb.verify():
+                    sys.exit(1)
             else:
-                logger.info("no BCJ filter for arch %s", self.arch.basearch)
-        if squashfs_only:
-            # Create an ext4 rootfs.img and compress it with squashfs
-            rc = rb.create_squashfs_runtime(joinpaths(installroot,runtime),
-                    compression=compression, compressargs=compressargs,
-                    size=size)
-        else:
-            # Create an ext4 rootfs.img and compress it with squashfs
-            rc = rb.create_ext4_runtime(joinpaths(installroot,runtime),
-                    compression=compression, compressargs=compressargs,
-                    size=size)
-        if rc != 0:
-            logger.error("rootfs.img creation failed. See program.log")
-            sys.exit(1)
+                logger.info("Skipping verify")
+
+            if self.debug:
+                rb.writepkgsizes(joinpaths(logdir, "final-pkgsizes.txt"),
+                                 self.conf.get("compression", "type"))
+
+            logger.info("creating the runtime image")
+            compression = self.conf.get("compression", "type")
+            compressargs = self.conf.get("compression", "args").split()     # pylint: disable=no-member
+            if compression == "xz" and not erofs and self.conf.getboolean("compression", "bcj"):
+                if self.arch.bcj:
+                    compressargs += ["-Xbcj", self.arch.bcj]
+                else:
+                    logger.info("no BCJ filter for arch %s", self.arch.basearch)
+            if erofs:
+                # Create a compressed erofs image of the root
+                rc = rb.create_erofs_runtime(joinpaths(installroot,runtime),
+                        compression=compression, compressargs=compressargs)
+            elif squashfs_only:
+                # Create an ext4 rootfs.img and compress it with squashfs
+                rc = rb.create_squashfs_runtime(joinpaths(installroot,runtime),
+                        compression=compression, compressargs=compressargs,
+                        size=size)
+            else:
+                # Create an ext4 rootfs.img and compress it with squashfs
+                rc = rb.create_ext4_runtime(joinpaths(installroot,runtime),
+                        compression=compression, compressargs=compressargs,
+                        size=size)
+            if rc != 0:
+                logger.error("rootfs.img creation failed. See program.log")
+                sys.exit(1)
 
-        rb.finished()
+            rb.finished()
+            if template_journal:
+                template_journal.record_step("runtime")
 
         logger.info("preparing to build output tree and boot images")
         treebuilder = TreeBuilder(product=self.product, arch=self.arch,
@@ -377,7 +434,10 @@ class Lorax(BaseLoraxClass):
                                   templatedir=self.templatedir,
                                   add_templates=add_arch_templates,
                                   add_template_vars=add_arch_template_vars,
-                                  workdir=self.workdir)
+                                  workdir=self.workdir,
+                                  templatecache=templatecache,
+                                  profile=profile,
+                                  journal=template_journal)
 
         logger.info("rebuilding initramfs images")
         if not user_dracut_args:
@@ -386,12 +446,19 @@ class Lorax(BaseLoraxClass):
             dracut_args = []
             for arg in user_dracut_args:
                 dracut_args += arg.split(" ", 1)
+        if erofs:
+            dracut_args = dracut_args + DRACUT_EROFS
 
         anaconda_args = dracut_args + ["--add", "anaconda pollcdrom qemu qemu-net prefixdevname-tools"]
 
         logger.info("dracut args = %s", dracut_args)
         logger.info("anaconda args = %s", anaconda_args)
-        treebuilder.rebuild_initrds(add_args=anaconda_args)
+        if template_journal and template_journal.step_done("initrds"):
+            logger.info("resuming with the initramfs images already rebuilt")
+        else:
+            treebuilder.rebuild_initrds(add_args=anaconda_args)
+            if template_journal:
+                template_journal.record_step("initrds")
 
         logger.info("populating output tree and building boot images")
         treebuilder.build()
@@ -403,6 +470,11 @@ class Lorax(BaseLoraxClass):
             treeinfo.add_section(section, data)
         treeinfo.write(joinpaths(self.outputdir, ".treeinfo"))
 
+        if profile:
+            profile.log_summary()
+        if template_journal:
+            template_journal.close()
+
         # cleanup
         if remove_temp:
             remove(self.workdir)
@@ -111,8 +111,30 @@ def lorax_parser(dracut_default=""):
                           help="Enable a DNF plugin by name/glob, or * to enable all of them.")
     optional.add_argument("--squashfs-only", action="store_true", default=False,
                           help="Use a plain squashfs filesystem for the runtime.")
+    optional.add_argument("--erofs", action="store_true", default=False,
+                          help="Use a compressed erofs filesystem for the runtime.")
     optional.add_argument("--skip-branding", action="store_true", default=False,
                           help="Disable automatic branding package selection. Use --installpkgs to add custom branding.")
+    optional.add_argument("--profile-templates", action="store_true", default=False,
+                          help="Record the time taken by each template command in template-profile.json "
+                               "in the log directory.")
+    optional.add_argument("--tree-index", action="store_true", default=False,
+                          help="Match the runtime template globs against an index of the tree "
+                               "instead of listing the directories each time.")
+    optional.add_argument("--journal", action="store_true", default=False,
+                          help="Record the template lines that complete in template-journal.jsonl "
+                               "in the work directory, so a failed build can be resumed.")
+    optional.add_argument("--resume", action="store_true", default=False,
+                          help="Resume a build run with --journal that failed after creating the "
+                               "runtime image, skipping the template lines that completed. "
+                               "Requires --workdir.")
+    optional.add_argument("--install-excludes", choices=["on", "verify"], default=None,
+                          help="Do not install the package files that runtime-cleanup.tmpl removes. "
+                               "With verify the excluded paths are checked after the cleanup. "
+                               "Requires python3-rpm.")
+    optional.add_argument("--install-excludes-reference", default=None, metavar="PATH",
+                          help="With --install-excludes verify, compare the tree with this runtime-manifest.json "
+                               "from the log directory, or the cleaned up tree, of a build without excludes.")
 
     # dracut arguments
     dracut_group = parser.add_argument_group("dracut arguments: (default: %s)" % dracut_default)
@@ -247,7 +269,7 @@ def lmc_parser(dracut_default=""):
     image_group.add_argument("--qcow2-arg", action="append", dest="qemu_args", default=[],
                              help="Arguments to pass to qemu-img. Pass once for each argument, they will be used for ALL calls to qemu-img.")
     image_group.add_argument("--compression", default="xz",
-                             help="Compression binary for make-tar. xz, lzma, gzip, and bzip2 are supported. xz is the default.")
+                             help="Compression binary for make-tar. xz, lzma, gzip, bzip2, zstd, and lz4 are supported. xz is the default.")
     image_group.add_argument("--compress-arg", action="append", dest="compress_args", default=[],
                              help="Arguments to pass to compression. Pass once for each argument")
     # Group of arguments for appliance creation
@@ -326,6 +348,8 @@ def lmc_parser(dracut_default=""):
     parser.add_argument("--volid", default=None, help="volume id")
     parser.add_argument("--squashfs-only", action="store_true", default=False,
                         help="Use a plain squashfs filesystem for the runtime.")
+    parser.add_argument("--erofs", action="store_true", default=False,
+                        help="Use a compressed erofs filesystem for the runtime.")
     parser.add_argument("--timeout", default=None, type=int,
                         help="Cancel installer after X minutes")
 
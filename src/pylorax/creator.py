@@ -34,7 +34,7 @@ from pykickstart.constants import KS_SHUTDOWN
 from pykickstart.version import makeVersion
 
 # Use the Lorax treebuilder branch for iso creation
-from pylorax import DEFAULT_RELEASEVER, ArchData
+from pylorax import DEFAULT_RELEASEVER, DRACUT_EROFS, ArchData
 from pylorax.base import DataHolder
 from pylorax.executils import execWithRedirect
 from pylorax.imgutils import DracutChroot, PartitionMount
@@ -138,17 +138,20 @@ def dracut_args(opts):
     """Return a list of the args to pass to dracut
 
     Return the default argument list unless one of the dracut cmdline arguments
-    has been used.
+    has been used. With --erofs the erofs driver is always added, the initrd
+    needs it to mount the runtime.
     """
     if opts.dracut_conf:
-        return ["--conf", opts.dracut_conf]
+        args = ["--conf", opts.dracut_conf]
     elif opts.dracut_args:
         args = []
         for arg in opts.dracut_args:
             args += arg.split(" ", 1)
-        return args
     else:
-        return DRACUT_DEFAULT
+        args = DRACUT_DEFAULT
+    if getattr(opts, "erofs", False):
+        args = args + DRACUT_EROFS
+    return args
 
 def make_appliance(disk_img, name, template, outfile, networks=None, ram=1024,
                    vcpus=1, arch=None, title="Linux", project="Linux",
@@ -201,14 +204,14 @@ def make_appliance(disk_img, name, template, outfile, networks=None, ram=1024,
 
 def make_runtime(opts, mount_dir, work_dir, size=None):
     """
-    Make the squashfs image from a directory
+    Make the squashfs or erofs image from a directory
 
     :param opts: options passed to livemedia-creator
     :type opts: argparse options
     :param str mount_dir: Directory tree to compress
     :param str work_dir: Output compressed image to work_dir+images/install.img
     :param int size: Size of disk image, in GiB
-    :returns: rc of squashfs creation
+    :returns: rc of squashfs or erofs creation
     :rtype: int
     """
     kernel_arch = get_arch(mount_dir)
@@ -221,7 +224,13 @@ def make_runtime(opts, mount_dir, work_dir, size=None):
     rb = RuntimeBuilder(product, arch, skip_branding=True, root=mount_dir)
     compression, compressargs = squashfs_args(opts)
 
-    if opts.squashfs_only:
+    if opts.erofs:
+        log.info("Creating an erofs runtime")
+        # The default args are squashfs filters
+        compressargs = compressargs if opts.compress_args else []
+        return rb.create_erofs_runtime(joinpaths(work_dir, RUNTIME),
+                  compression=compression, compressargs=compressargs)
+    elif opts.squashfs_only:
         log.info("Creating a squashfs only runtime")
         return rb.create_squashfs_runtime(joinpaths(work_dir, RUNTIME), size=size,
                   compression=compression, compressargs=compressargs)
@@ -387,15 +396,18 @@ def mount_boot_part_over_root(img_mount):
     is_boot_part = lambda dir: os.path.exists(dir+"/loader.0")
     tmp_mount_dir = tempfile.mkdtemp(prefix="lmc-tmpdir-")
     sysroot_boot_dir = None
-    for dev, _size in img_mount.loop_devices:
-        if dev is img_mount.mount_dev:
+    for part in img_mount.partitions:
+        if part is img_mount.mount_part:
             continue
+        # mount sets up the loop device and frees it on umount
+        (_number, offset, size, _fstype) = part
+        opts = "loop,offset=%d,sizelimit=%d" % (offset, size)
         try:
-            mount("/dev/mapper/"+dev, mnt=tmp_mount_dir)
+            mount(img_mount.disk_img, opts=opts, mnt=tmp_mount_dir)
             if is_boot_part(tmp_mount_dir):
                 umount(tmp_mount_dir)
                 sysroot_boot_dir = joinpaths(root_dir, "boot")
-                mount("/dev/mapper/"+dev, mnt=sysroot_boot_dir)
+                mount(img_mount.disk_img, opts=opts, mnt=sysroot_boot_dir)
                 break
             else:
                 umount(tmp_mount_dir)
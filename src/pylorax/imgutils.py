@@ -21,34 +21,40 @@ import logging
 logger = logging.getLogger("pylorax.imgutils")
 
 import os, tempfile
+import errno
+import stat
+import struct
+import fcntl
+import zlib
+import glob
 from os.path import join, dirname
 from subprocess import Popen, PIPE, CalledProcessError
 import sys
 import time
 import traceback
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from time import sleep
 import shutil
 
-from pylorax.sysutils import cpfile
+from pylorax.sysutils import cpfile, TreeCopier
 from pylorax.executils import execWithRedirect, execWithCapture
 from pylorax.executils import runcmd, runcmd_output
 
 ######## Functions for making container images (cpio, tar, squashfs) ##########
 
-def compress(command, root, outfile, compression="xz", compressargs=None):
-    '''Make a compressed archive of the given rootdir or file.
-    command is a list of the archiver commands to run
-    compression should be "xz", "gzip", "lzma", "bzip2", or None.
-    compressargs will be used on the compression commandline.'''
-    if compression not in (None, "xz", "gzip", "lzma", "bzip2"):
+def compression_command(compression, compressargs=None):
+    '''Return the commandline for compressing an archive.
+    compression should be "xz", "gzip", "lzma", "bzip2", "zstd", "lz4", or None.
+    compressargs will be used on the compression commandline.
+    Returns None when there is no compression.'''
+    if compression not in (None, "xz", "gzip", "lzma", "bzip2", "zstd", "lz4"):
         raise ValueError("Unknown compression type %s" % compression)
-    compressargs = compressargs or ["-9"]
+    if compression is None:
+        return None
+    compressargs = list(compressargs or ["-9"])
     if compression == "xz":
         compressargs.insert(0, "--check=crc32")
-    if compression is None:
-        compression = "cat" # this is a little silly
-        compressargs = []
 
     # make compression run with multiple threads if possible
     if compression in ("xz", "lzma"):
@@ -59,27 +65,36 @@ def compress(command, root, outfile, compression="xz", compressargs=None):
     elif compression == "bzip2":
         compression = "pbzip2"
         compressargs.insert(0, "-p%d" % multiprocessing.cpu_count())
+    elif compression == "zstd":
+        compressargs.insert(0, "-T%d" % multiprocessing.cpu_count())
+    return [compression] + compressargs
+
+def compress(command, root, outfile, compression="xz", compressargs=None):
+    '''Make a compressed archive of the given rootdir or file.
+    command is a list of the archiver commands to run
+    compression should be "xz", "gzip", "lzma", "bzip2", "zstd", "lz4", or None.
+    compressargs will be used on the compression commandline.'''
+    compcmd = compression_command(compression, compressargs) or ["cat"] # this is a little silly
 
     find, archive, comp = None, None, None
 
     try:
         if os.path.isdir(root):
-            logger.debug("find %s -print0 |%s | %s %s > %s", root, " ".join(command),
-                    compression, " ".join(compressargs), outfile)
+            logger.debug("find %s -print0 |%s | %s > %s", root, " ".join(command),
+                    " ".join(compcmd), outfile)
 
             find = Popen(["find", ".", "-print0"], stdout=PIPE, cwd=root)
             archive = Popen(command, stdin=find.stdout, stdout=PIPE, cwd=root)
         else:
-            logger.debug("echo %s |%s | %s %s > %s", root, " ".join(command),
-                         compression, " ".join(compressargs), outfile)
+            logger.debug("echo %s |%s | %s > %s", root, " ".join(command),
+                         " ".join(compcmd), outfile)
 
             archive = Popen(command, stdin=PIPE, stdout=PIPE, cwd=os.path.dirname(root))
             archive.stdin.write(os.path.basename(root).encode("utf-8") + b"\0")
             archive.stdin.close()
 
         with open(outfile, "wb") as fout:
-            comp = Popen([compression] + compressargs,
-                         stdin=archive.stdout, stdout=fout)
+            comp = Popen(compcmd, stdin=archive.stdout, stdout=fout)
             comp.wait()
 
         # Clean up the open fds and processes
@@ -98,10 +113,193 @@ def compress(command, root, outfile, compression="xz", compressargs=None):
         list(p.kill() for p in (find, archive, comp) if p)
         return 1
 
-def mkcpio(root, outfile, compression="xz", compressargs=None):
-    compressargs = compressargs or ["-9"]
-    return compress(["cpio", "--null", "--quiet", "-H", "newc", "-o"],
-                    root, outfile, compression, compressargs)
+class CpioWriter(object):
+    """
+    Write a newc cpio archive
+
+    :param fobj: Binary file object to write the archive to
+    :param epoch: Clamp the mtimes to this time, or None to keep them
+    :type epoch: int
+
+    Entries are written in sorted order, parents before their children, with
+    the inode numbers renumbered and the device numbers zeroed like
+    ``cpio --reproducible`` does, so the same tree always makes the same
+    archive. Hardlinked files share an inode number and only the last link in
+    the archive carries the data, which is what cpio does and what the
+    kernel's initramfs unpacker expects.
+
+    File data is copied with sendfile when the output supports it.
+    """
+    def __init__(self, fobj, epoch=None):
+        self._fobj = fobj
+        self._epoch = epoch
+        self._inodes = {}
+        self._offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tracebk):
+        if exc_type is None:
+            self.close()
+
+    @staticmethod
+    def walk(root):
+        """
+        List the entries of a directory tree in archive order
+
+        :param str root: Directory to list
+        :returns: (name, path, stat) tuples, starting with "."
+        :rtype: list
+        """
+        entries = [(".", root, os.lstat(root))]
+        def _walk(name, path):
+            with os.scandir(path) as it:
+                children = sorted(it, key=lambda e: e.name)
+            for e in children:
+                child = e.name if name == "." else name + "/" + e.name
+                entries.append((child, e.path, e.stat(follow_symlinks=False)))
+                if e.is_dir(follow_symlinks=False):
+                    _walk(child, e.path)
+        _walk(".", root)
+        return entries
+
+    def add_tree(self, root):
+        """
+        Add the contents of a directory to the archive
+
+        :param str root: Directory to add, it is stored as "."
+        """
+        self.add(self.walk(root))
+
+    def add(self, entries):
+        """
+        Add entries to the archive
+
+        :param entries: (name, path, stat) tuples in the order to write them
+        :type entries: list
+
+        Hardlinks are only matched up within a single call.
+        """
+        last = {}
+        for i, (_name, _path, st) in enumerate(entries):
+            if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                last[(st.st_dev, st.st_ino)] = i
+        for i, (name, path, st) in enumerate(entries):
+            key = (st.st_dev, st.st_ino)
+            data = None
+            if stat.S_ISLNK(st.st_mode):
+                data = os.fsencode(os.readlink(path))
+                size = len(data)
+            elif stat.S_ISREG(st.st_mode) and last.get(key, i) == i:
+                size = st.st_size
+            else:
+                size = 0
+            mtime = int(st.st_mtime)
+            if self._epoch is not None:
+                mtime = min(mtime, self._epoch)
+            if key not in self._inodes:
+                self._inodes[key] = len(self._inodes) + 1
+            rdev = st.st_rdev if stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode) else 0
+            self._header(name, self._inodes[key], st.st_mode, st.st_uid, st.st_gid,
+                         st.st_nlink, mtime, size, rdev)
+            if data is not None:
+                self._write(data)
+            elif size:
+                self._copy(path, size)
+            self._pad()
+
+    def close(self):
+        """
+        Write the trailer and pad the archive to a 512 byte block like cpio does
+        """
+        self._header("TRAILER!!!", 0, 0, 0, 0, 1, 0, 0, 0)
+        self._pad(512)
+        self._fobj.flush()
+
+    def _header(self, name, ino, mode, uid, gid, nlink, mtime, size, rdev):
+        if size > 0xffffffff:
+            raise ValueError("%s is too large for a cpio archive" % name)
+        name = os.fsencode(name) + b"\0"
+        fields = (ino, mode, uid, gid, nlink, mtime, size, 0, 0,
+                  os.major(rdev), os.minor(rdev), len(name), 0)
+        self._write(b"070701" + b"".join(b"%08x" % f for f in fields) + name)
+        self._pad()
+
+    def _pad(self, align=4):
+        if self._offset % align:
+            self._write(b"\0" * (align - self._offset % align))
+
+    def _write(self, data):
+        self._fobj.write(data)
+        self._offset += len(data)
+
+    def _copy(self, path, size):
+        self._fobj.flush()
+        with open(path, "rb") as f:
+            offset = 0
+            try:
+                while offset < size:
+                    sent = os.sendfile(self._fobj.fileno(), f.fileno(), offset, size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+            except (OSError, ValueError) as e:
+                # Fall back to copying through userspace if sendfile isn't supported
+                if offset or isinstance(e, OSError) and e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                while offset < size:
+                    data = f.read(min(size - offset, 1024**2))
+                    if not data:
+                        break
+                    self._fobj.write(data)
+                    offset += len(data)
+        if offset != size:
+            raise RuntimeError("%s changed size while it was being archived" % path)
+        self._offset += size
+
+def mkcpio(root, outfile, compression="xz", compressargs=None, epoch=None):
+    '''Make a compressed newc cpio archive of the given rootdir or file.
+    The archive is written by CpioWriter straight into the compression program,
+    epoch clamps the mtimes and defaults to $SOURCE_DATE_EPOCH when it is set.'''
+    compcmd = compression_command(compression, compressargs)
+    if epoch is None and 'SOURCE_DATE_EPOCH' in os.environ:
+        epoch = int(os.environ['SOURCE_DATE_EPOCH'])
+
+    comp = None
+    try:
+        if os.path.isdir(root):
+            entries = CpioWriter.walk(root)
+        else:
+            entries = [(os.path.basename(root), root, os.lstat(root))]
+
+        with open(outfile, "wb") as fout:
+            if compcmd is None:
+                logger.debug("cpio %s > %s", root, outfile)
+                with CpioWriter(fout, epoch) as cpio:
+                    cpio.add(entries)
+                return 0
+
+            logger.debug("cpio %s | %s > %s", root, " ".join(compcmd), outfile)
+            comp = Popen(compcmd, stdin=PIPE, stdout=fout)
+            try:
+                with CpioWriter(comp.stdin, epoch) as cpio:
+                    cpio.add(entries)
+            finally:
+                comp.stdin.close()
+            comp.wait()
+        return comp.returncode
+    except (OSError, ValueError, RuntimeError) as e:
+        # CpioWriter raises ValueError and RuntimeError for files it can't archive
+        logger.error(e)
+        # Kill off the compression process if it is still running
+        if comp:
+            comp.kill()
+            comp.wait()
+        # Don't leave a partial archive behind
+        if os.path.exists(outfile):
+            os.unlink(outfile)
+        return 1
 
 def mktar(root, outfile, compression="xz", compressargs=None, selinux=True):
     compressargs = compressargs or ["-9"]
@@ -118,6 +316,20 @@ def mksquashfs(rootdir, outfile, compression="default", compressargs=None):
         compressargs = ["-comp", compression] + compressargs
     return execWithRedirect("mksquashfs", [rootdir, outfile] + compressargs)
 
+# mkfs.erofs names for the compression types
+EROFS_COMPRESSORS = {"xz": "lzma", "gzip": "deflate", "lz4": "lz4hc"}
+
+def mkerofs(rootdir, outfile, compression="xz", compressargs=None):
+    '''Make an erofs image containing the given rootdir.
+    compression is one of the compress() types, or a mkfs.erofs compressor,
+    or None for an uncompressed image. Duplicate compressed data is stored once.
+    compressargs are passed to mkfs.erofs.'''
+    compressargs = compressargs or []
+    if compression:
+        compression = EROFS_COMPRESSORS.get(compression, compression)
+        compressargs = ["-z", compression, "-Ededupe"] + compressargs
+    return execWithRedirect("mkfs.erofs", compressargs + [outfile, rootdir])
+
 def mkrootfsimg(rootdir, outfile, label, size=2, sysroot=""):
     """
     Make rootfs image from a directory
@@ -164,6 +376,100 @@ def mkqemu_img(outfile, size, options=None):
         options.extend(["-f", "qcow2"])
     runcmd(["qemu-img", "create"] + options + [outfile, str(size)])
 
+# Loop device ioctls and structures, from linux/loop.h
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_READ_ONLY = 1
+# struct loop_info64: device, inode, rdevice, offset, sizelimit, number,
+# encrypt_type, encrypt_key_size, flags, file_name, crypt_name, encrypt_key, init
+LOOP_INFO64 = "=QQQQQIIII64s64s32s2Q"
+# struct loop_config: fd, block_size, info, reserved
+LOOP_CONFIG = "=II%ds8Q" % struct.calcsize(LOOP_INFO64)
+
+def loop_backing_file(loop_dev):
+    """Return the backing file of a loop device from sysfs, or None if it isn't attached"""
+    try:
+        with open("/sys/block/%s/loop/backing_file" % os.path.basename(loop_dev)) as f:
+            return f.read().rstrip("\n")
+    except OSError:
+        return None
+
+def _loop_set_fd(loop_dev, fd, info):
+    """Attach fd to loop_dev, return False if another process attached it first"""
+    devfd = os.open(loop_dev, os.O_RDWR | os.O_CLOEXEC)
+    try:
+        try:
+            fcntl.ioctl(devfd, LOOP_CONFIGURE, struct.pack(LOOP_CONFIG, fd, 0, info, *[0]*8))
+            return True
+        except OSError as e:
+            if e.errno == errno.EBUSY:
+                return False
+            if e.errno not in (errno.EINVAL, errno.ENOTTY):
+                raise
+
+        # Kernels before 5.8 don't have LOOP_CONFIGURE
+        try:
+            fcntl.ioctl(devfd, LOOP_SET_FD, fd)
+        except OSError as e:
+            if e.errno == errno.EBUSY:
+                return False
+            raise
+        try:
+            fcntl.ioctl(devfd, LOOP_SET_STATUS64, info)
+        except OSError:
+            fcntl.ioctl(devfd, LOOP_CLR_FD, 0)
+            raise
+        return True
+    finally:
+        os.close(devfd)
+
+def loop_configure(outfile, offset=0, sizelimit=0):
+    """Attach a free loop device to the file using ioctls. Return the loop device name.
+
+    LOOP_CTL_GET_FREE picks the device and LOOP_CONFIGURE attaches it, if
+    another process attaches the device first the next free one is tried.
+    The file is attached read-only if it can't be opened for writing.
+    offset and sizelimit, in bytes, limit the device to part of the file.
+
+    Raises OSError if the ioctls fail, or if the device's backing file in sysfs
+    is not the file. The device is detached first.
+    """
+    path = os.path.realpath(outfile)
+    flags = 0
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+    except OSError as e:
+        if e.errno not in (errno.EROFS, errno.EACCES, errno.EPERM):
+            raise
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        flags = LO_FLAGS_READ_ONLY
+    info = struct.pack(LOOP_INFO64, 0, 0, 0, offset, sizelimit, 0, 0, 0, flags, os.fsencode(path)[:63], b"", b"", 0, 0)
+    try:
+        ctl = os.open("/dev/loop-control", os.O_RDWR | os.O_CLOEXEC)
+        try:
+            for _x in range(100):
+                loop_dev = "/dev/loop%d" % fcntl.ioctl(ctl, LOOP_CTL_GET_FREE)
+                if _loop_set_fd(loop_dev, fd, info):
+                    break
+            else:
+                raise OSError(errno.EBUSY, "No free loop device for %s" % path)
+        finally:
+            os.close(ctl)
+    finally:
+        os.close(fd)
+
+    # The kernel has set the backing file by the time the ioctl returns, there is no
+    # need to wait for udev. If it isn't path, eg. inside a container, get_loop_name()
+    # can't find the device so it is detached and the caller can use losetup instead.
+    backing_file = loop_backing_file(loop_dev)
+    if backing_file != path:
+        loop_detach(loop_dev)
+        raise OSError(errno.ENXIO, "%s backing file is %s, not %s" % (loop_dev, backing_file, path))
+    return loop_dev
+
 def loop_waitfor(loop_dev, outfile):
     """Make sure the loop device is attached to the outfile.
 
@@ -187,20 +493,35 @@ def loop_waitfor(loop_dev, outfile):
 
     raise RuntimeError("Unable to setup %s on %s" % (loop_dev, outfile))
 
-def loop_attach(outfile):
+def loop_attach(outfile, offset=0, sizelimit=0):
     """Attach a loop device to the given file. Return the loop device name.
 
-    On rare occasions it appears that the device never shows up, some experiments
+    offset and sizelimit, in bytes, limit the device to part of the file.
+    The device is attached with loop_configure(), without waiting for udev.
+    If the ioctls can't be used it falls back to losetup.
+
+    On rare occasions it appears that the losetup device never shows up, some experiments
     seem to indicate that it may be a race with another process using /dev/loop* devices.
 
     So we now try 3 times before actually failing.
 
     Raises CalledProcessError if losetup fails.
     """
+    try:
+        return loop_configure(outfile, offset, sizelimit)
+    except OSError as e:
+        logger.debug("Attaching a loop device with ioctls failed, using losetup: %s", e)
+
     retries = 0
     while True:
         try:
             retries += 1
+            if offset or sizelimit:
+                # There may be more than one loop on the file, so it can't be looked up
+                dev = runcmd_output(["losetup", "--find", "--show", "--offset", str(offset),
+                                     "--sizelimit", str(sizelimit), outfile]).strip()
+                runcmd(["udevadm", "settle", "--timeout", "300"])
+                break
             dev = runcmd_output(["losetup", "--find", "--show", outfile]).strip()
 
             # Sometimes the loop device isn't ready yet, make extra sure before returning
@@ -216,11 +537,29 @@ def loop_attach(outfile):
 
 def loop_detach(loopdev):
     '''Detach the given loop device. Return False on failure.'''
+    try:
+        devfd = os.open(loopdev, os.O_RDWR | os.O_CLOEXEC)
+        try:
+            fcntl.ioctl(devfd, LOOP_CLR_FD, 0)
+        finally:
+            os.close(devfd)
+        return True
+    except OSError as e:
+        logger.debug("Detaching %s with an ioctl failed, using losetup: %s", loopdev, e)
     return (execWithRedirect("losetup", ["--detach", loopdev]) == 0)
 
 def get_loop_name(path):
     '''Return the loop device associated with the path.
+    The backing files in sysfs are checked first, losetup is used if none match.
     Raises RuntimeError if more than one loop is associated'''
+    realpath = os.path.realpath(path)
+    names = [f.split("/")[3] for f in glob.glob("/sys/block/loop*/loop/backing_file")
+             if loop_backing_file(f.split("/")[3]) == realpath]
+    if len(names) > 1:
+        raise RuntimeError("multiple loops associated with %s" % path)
+    if names:
+        return names[0]
+
     buf = runcmd_output(["losetup", "-j", path])
     if len(buf.splitlines()) > 1:
         # there should never be more than one loop device listed
@@ -287,15 +626,20 @@ def umount(mnt,  lazy=False, maxretry=3, retrysleep=1.0, delete=True):
         logger.debug("remove tmp mountdir %s", mnt)
     return (rv == 0)
 
-def copytree(src, dest, preserve=True):
-    '''Copy a tree of files using cp -a, thus preserving modes, timestamps,
+def copytree(src, dest, preserve=True, stats=None):
+    '''Copy a tree of files like cp -a, thus preserving modes, timestamps,
     links, acls, sparse files, xattrs, selinux contexts, etc.
-    If preserve is False, uses cp -R (useful for modeless filesystems)
-    raises CalledProcessError if copy fails.'''
+    The data is cloned or copied in the kernel when it can be, see TreeCopier.
+    If preserve is False, symlinks are followed and only the timestamps are
+    kept, like cp -R -L (useful for modeless filesystems)
+    Returns the CopyStats, raises CalledProcessError if copy fails.'''
     logger.debug("copytree %s %s", src, dest)
-    cp = ["cp", "-a"] if preserve else ["cp", "-R", "-L", "--preserve=timestamps"]
-    cp += [join(src, "."), os.path.abspath(dest)]
-    runcmd(cp)
+    copier = TreeCopier(preserve=preserve, follow=not preserve, stats=stats)
+    try:
+        copier.copy(src, dest)
+    except OSError as e:
+        raise CalledProcessError(1, ["copytree", src, dest], output=str(e))
+    return copier.stats
 
 def do_grafts(grafts, dest, preserve=True):
     '''Copy each of the items listed in grafts into dest.
@@ -321,27 +665,281 @@ def round_to_blocks(size, blocksize):
         size += blocksize - diff
     return size
 
-# TODO: move filesystem data outside this function
-def estimate_size(rootdir, graft=None, fstype=None, blocksize=4096, overhead=256):
+class TreeUsage(object):
+    """
+    The space a directory tree needs on a new filesystem
+
+    :param bool follow: Follow symlinks, for filesystems that are copied with cp -L
+    :param bool sparse: Count only the data of sparse files, not the holes
+    :param bool hardlinks: Count the data of hardlinked files once
+
+    The counts are filesystem independent, the filesystem models in
+    estimate_size() turn them into blocks.
+    """
+    def __init__(self, follow=False, sparse=True, hardlinks=True):
+        self.follow = follow
+        self.sparse = sparse
+        self.hardlinks = hardlinks
+        self.files = []     # bytes of data in each file
+        self.links = {}     # (st_dev, st_ino) of hardlinked files -> bytes of data
+        self.symlinks = []  # length of each symlink target
+        self.dirs = []      # length of the names in each directory
+        self.inodes = 0
+
+    def scan(self, path, workers=None):
+        """
+        Add a directory tree or a file
+
+        :param str path: The directory or file to add
+        :param int workers: The maximum number of directories to scan at the same time
+
+        Each directory is scanned by a pool of threads, the subdirectories it
+        finds are queued for the pool as it finishes. Hardlinks are only
+        counted once within each call, because each tree is copied into the
+        image separately.
+        """
+        top = TreeUsage(self.follow, self.sparse, self.hardlinks)
+        st = os.stat(path) if self.follow else os.lstat(path)
+        if stat.S_ISDIR(st.st_mode):
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = {executor.submit(self._directory, path)}
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for job in done:
+                        usage, subdirs = job.result()
+                        top.merge(usage)
+                        pending.update(executor.submit(self._directory, d) for d in subdirs)
+        else:
+            top.add(path, st)
+
+        # Count each hardlinked file once
+        top.files.extend(top.links.values())
+        top.inodes += len(top.links)
+        top.links = {}
+        self.merge(top)
+
+    def _directory(self, path):
+        """Return the usage of the entries of one directory, and its subdirectories"""
+        usage = TreeUsage(self.follow, self.sparse, self.hardlinks)
+        return usage, usage.scandir(path)
+
+    def scandir(self, path):
+        """
+        Add the entries of one directory, without the ones in its subdirectories
+
+        :param str path: The directory to add
+        :returns: The paths of its subdirectories
+        :rtype: list of str
+        """
+        names = []
+        subdirs = []
+        with os.scandir(path) as it:
+            for e in it:
+                names.append(len(os.fsencode(e.name)))
+                st = e.stat(follow_symlinks=self.follow)
+                if stat.S_ISDIR(st.st_mode):
+                    self.inodes += 1
+                    subdirs.append(e.path)
+                else:
+                    self.add(e.path, st)
+        self.dirs.append(names)
+        return subdirs
+
+    def add(self, path, st):
+        """
+        Add a file, symlink or other entry that is not a directory
+
+        :param str path: The path of the entry
+        :param st: Its stat result
+        """
+        if stat.S_ISLNK(st.st_mode):
+            self.symlinks.append(st.st_size)
+        elif stat.S_ISREG(st.st_mode):
+            size = st.st_size
+            if self.sparse and st.st_blocks * 512 < size:
+                size = data_size(path, size)
+            if self.hardlinks and st.st_nlink > 1:
+                self.links[(st.st_dev, st.st_ino)] = size
+                return
+            self.files.append(size)
+        self.inodes += 1
+
+    def merge(self, usage):
+        """
+        Add the counts from another TreeUsage
+
+        :param usage: The usage to add
+        :type usage: TreeUsage
+        """
+        self.files.extend(usage.files)
+        self.links.update(usage.links)
+        self.symlinks.extend(usage.symlinks)
+        self.dirs.extend(usage.dirs)
+        self.inodes += usage.inodes
+
+def data_size(path, size):
+    """
+    Return the number of bytes of a file that are data and not holes
+
+    :param str path: Path to the file
+    :param int size: Size of the file
+    :rtype: int
+
+    If the holes can't be found the whole size is returned.
+    """
+    total = 0
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return size
+    try:
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # Nothing but holes after offset
+                    break
+                return size
+            offset = os.lseek(fd, start, os.SEEK_HOLE)
+            total += offset - start
+    finally:
+        os.close(fd)
+    return total
+
+def _blocks(size, blocksize):
+    return -(-size // blocksize)
+
+def _ext4_layout(blocks, blocksize=4096):
+    """
+    Return the metadata blocks and inode count mkfs.ext4 makes for a filesystem
+
+    :param int blocks: Size of the filesystem in blocks
+    :param int blocksize: Size of the blocks
+    :returns: (metadata blocks, inodes)
+    :rtype: tuple
+
+    This uses the defaults from /etc/mke2fs.conf: 256 byte inodes, the
+    inode ratio of the floppy, small and default filesystem types, 64bit
+    group descriptors with space reserved for resizing, sparse_super and the
+    default journal size.
+    """
+    size = blocks * blocksize
+    if size < 3 * 1024**2:
+        ratio = 8192
+    elif size < 512 * 1024**2:
+        ratio = 4096
+    else:
+        ratio = 16384
+    per_group = blocksize * 8
+    groups = _blocks(blocks, per_group)
+    inodes_per_block = blocksize // 256
+    inodes_per_group = _blocks(_blocks(size // ratio, groups), inodes_per_block) * inodes_per_block
+    inode_tables = groups * inodes_per_group // inodes_per_block
+
+    descriptors = _blocks(groups * 64, blocksize)
+    reserved = _blocks(_blocks(min(2**32 - 1, blocks * 1024), per_group) * 64, blocksize) - descriptors
+    reserved = min(blocksize // 4, max(0, reserved))
+    # sparse_super puts superblock backups in groups 0, 1 and powers of 3, 5 and 7
+    backups = 2 if groups > 1 else 1
+    for base in (3, 5, 7):
+        g = base
+        while g < groups:
+            backups += 1
+            g *= base
+
+    journal = 0
+    if blocks >= 2048:
+        journal = 262144
+        for limit, jblocks in ((32768, 1024), (256*1024, 4096), (512*1024, 8192), (4096*1024, 16384),
+                               (8192*1024, 32768), (16384*1024, 65536), (32768*1024, 131072)):
+            if blocks < limit:
+                journal = jblocks
+                break
+
+    # 6 blocks for /, lost+found and the resize inode
+    meta = inode_tables + 2 * groups + backups * (1 + descriptors + reserved) + journal + 6
+    return (meta, groups * inodes_per_group)
+
+def _fat_layout(size):
+    """
+    Return the cluster size and metadata bytes mkfs.fat uses for a filesystem
+
+    :param int size: Size of the filesystem in bytes
+    :returns: (cluster size, metadata bytes)
+    :rtype: tuple
+
+    mkfs.fat starts with 2KiB clusters, doubling them until FAT16 has few
+    enough clusters, and switches to FAT32 with 4KiB clusters at 512MiB.
+    """
+    if size >= 512 * 1024**2:
+        cluster, bits, reserved = 4096, 32, 32 * 512
+    else:
+        cluster = 2048
+        while size // cluster > 65524:
+            cluster *= 2
+        bits = 12 if size // cluster < 4085 else 16
+        reserved = 512 + 512 * 32   # boot sector and the fixed root directory
+    fats = 2 * _blocks(_blocks(size // cluster * bits, 8), 512) * 512
+    # The data area is aligned to the cluster size
+    return (cluster, reserved + fats + cluster)
+
+def estimate_size(rootdir, graft=None, fstype=None, blocksize=4096, overhead=256, workers=None):
+    '''Estimate the size of a filesystem image holding rootdir and the grafts.
+    The trees are scanned in parallel, hardlinks are counted once and sparse
+    files only by their data, on the filesystems that cp preserves them on.
+    The ext4 and vfat metadata is calculated from the layout their mkfs uses,
+    overhead is extra space in blocks (clusters for vfat).'''
     graft = graft or {}
-    getsize = lambda f: os.lstat(f).st_size
-    if fstype == "btrfs":
-        overhead = 64*1024 # don't worry, it's all sparse
-    if fstype == "hfsplus":
-        overhead = 200 # hack to deal with two bootloader copies
-    if fstype in ("vfat", "msdos"):
-        blocksize = 2048
-        getsize = lambda f: os.stat(f).st_size # no symlinks, count as copies
-    total = overhead*blocksize
+    vfat = fstype in ("vfat", "msdos")
+    usage = TreeUsage(follow=vfat, sparse=fstype in ("ext4", "btrfs"), hardlinks=not vfat)
     dirlist = list(graft.values())
     if rootdir:
         dirlist.append(rootdir)
     for root in dirlist:
-        for top, dirs, files in os.walk(root):
-            for f in files + dirs:
-                total += round_to_blocks(getsize(join(top,f)), blocksize)
-    if fstype == "btrfs":
+        usage.scan(root, workers)
+
+    if fstype == "ext4":
+        dirent = lambda n: (8 + n + 3) & ~3
+        data = sum(_blocks(f, blocksize) for f in usage.files)
+        data += sum(1 for s in usage.symlinks if s >= 60)   # shorter targets are stored in the inode
+        data += sum(_blocks(24 + sum(dirent(n) for n in names), blocksize) for names in usage.dirs)
+        blocks = data + overhead
+        while True:
+            meta, inodes = _ext4_layout(blocks, blocksize)
+            if inodes < usage.inodes + 11:
+                # The inode count comes from the size, make it bigger
+                blocks += _blocks((usage.inodes + 11 - inodes) * 4096, blocksize)
+            elif blocks < data + overhead + meta:
+                blocks = data + overhead + meta
+            else:
+                break
+        total = blocks * blocksize
+    elif vfat:
+        dirent = lambda n: 32 * (1 + _blocks(n, 13))   # 8.3 entry and long name entries
+        # Use the smallest cluster size that is at least as big as the one mkfs.fat will pick
+        for blocksize in (2048, 4096, 8192, 16384, 32768):
+            data = sum(_blocks(f, blocksize) for f in usage.files)
+            data += sum(_blocks(64 + sum(dirent(n) for n in names), blocksize) for names in usage.dirs)
+            total = (data + overhead) * blocksize
+            cluster, meta = _fat_layout(total + _fat_layout(total)[1])
+            if cluster <= blocksize:
+                break
+        total += meta
+    elif fstype == "btrfs":
+        # Small files and symlinks are stored in the metadata, which is duplicated
+        blocks = sum(_blocks(f, blocksize) for f in usage.files if f > 2048)
+        meta = 2 * sum(f for f in usage.files if f <= 2048) + usage.inodes * 2048
+        total = (blocks + 64*1024) * blocksize + meta # don't worry, it's all sparse
         total = max(256*1024*1024, total) # btrfs minimum size: 256MB
+    else:
+        if fstype == "hfsplus":
+            overhead = 200 # hack to deal with two bootloader copies
+        # Every directory and symlink takes a block, and a catalog record for every file
+        blocks = sum(_blocks(f, blocksize) for f in usage.files)
+        blocks += len(usage.symlinks) + len(usage.dirs)
+        blocks += _blocks(usage.inodes * 512, blocksize) + overhead
+        total = blocks * blocksize
     logger.info("Size of %s block %s fs at %s estimated to be %s", blocksize, fstype, rootdir, total)
     return total
 
@@ -378,33 +976,145 @@ class Mount(object):
     def __exit__(self, exc_type, exc_value, tracebk):
         umount(self.mnt)
 
-def kpartx_disk_img(disk_img):
-    """Attach a disk image's partitions to /dev/loopX using kpartx
-
-    :param disk_img: The full path to a partitioned disk image
-    :type disk_img: str
-    :returns: list of (loopXpN, size)
+# GPT header: signature, revision, header size, header crc32, reserved, current lba,
+# backup lba, first usable lba, last usable lba, disk guid, partition entries lba,
+# number of entries, entry size, entries crc32
+GPT_HEADER = "<8sIIIIQQQQ16sQIII"
+# GPT partition entry: type guid, partition guid, first lba, last lba, attributes
+GPT_ENTRY = "<16s16sQQQ"
+# MBR partition entry: status, first chs, type, last chs, first lba, sectors
+MBR_ENTRY = "<B3sB3sII"
+MBR_EXTENDED = (0x05, 0x0F, 0x85)
+MBR_GPT = 0xEE
+
+# (fstype, offset, magic) to identify the filesystem on a partition
+FS_MAGIC = [("ext4",     0x438,   b"\x53\xef"),
+            ("xfs",      0,       b"XFSB"),
+            ("btrfs",    0x10040, b"_BHRfS_M"),
+            ("vfat",     0x52,    b"FAT32   "),
+            ("vfat",     0x36,    b"FAT1"),
+            ("erofs",    0x400,   b"\xe2\xe1\xf5\xe0"),
+            ("squashfs", 0,       b"hsqs"),
+            ("hfsplus",  0x400,   b"H+"),
+            ("iso9660",  0x8001,  b"CD001"),
+            ("swap",     0xff6,   b"SWAPSPACE2")]
+
+def _read_at(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+def _gpt_partitions(f, sector_size):
+    """Return the (number, offset, size) of the partitions in a GPT, or None if there isn't a valid one
+
+    The header and the partition entries must match their CRC32.
+    """
+    header = _read_at(f, sector_size, sector_size)
+    if len(header) < struct.calcsize(GPT_HEADER) or not header.startswith(b"EFI PART"):
+        return None
+    fields = struct.unpack_from(GPT_HEADER, header)
+    (header_size, header_crc) = fields[2:4]
+    (entries_lba, num_entries, entry_size, entries_crc) = fields[10:14]
+    if not struct.calcsize(GPT_HEADER) <= header_size <= sector_size or \
+       entry_size < struct.calcsize(GPT_ENTRY):
+        return None
+    # The CRC is calculated with the CRC field set to 0
+    if zlib.crc32(header[:16] + bytes(4) + header[20:header_size]) != header_crc:
+        return None
+    table = _read_at(f, entries_lba * sector_size, num_entries * entry_size)
+    if zlib.crc32(table) != entries_crc:
+        return None
+    partitions = []
+    for i in range(min(num_entries, len(table) // entry_size)):
+        (type_guid, _guid, first, last, _attrs) = struct.unpack_from(GPT_ENTRY, table, i * entry_size)
+        if type_guid == bytes(16):
+            continue
+        partitions.append((i+1, first * sector_size, (last - first + 1) * sector_size))
+    return partitions
+
+def _mbr_partitions(f):
+    """Return the (number, offset, size) of the partitions in an MBR, or None if there isn't one
+
+    Logical partitions are numbered from 5, like the kernel does.
+    """
+    def entries(offset):
+        sector = _read_at(f, offset, 512)
+        if len(sector) < 512 or sector[510:512] != b"\x55\xaa":
+            return None
+        return [struct.unpack_from(MBR_ENTRY, sector, 0x1BE + i*16) for i in range(4)]
+
+    primary = entries(0)
+    if primary is None:
+        return None
+    partitions = []
+    extended = None
+    for i, (_status, _chs, ptype, _chs_end, first, sectors) in enumerate(primary):
+        if ptype == 0 or sectors == 0:
+            continue
+        if ptype in MBR_EXTENDED:
+            extended = first
+            continue
+        partitions.append((i+1, first * 512, sectors * 512))
+
+    # Follow the chain of extended boot records, each one has a logical partition
+    # relative to itself and the next record relative to the extended partition.
+    number = 5
+    ebr = extended
+    seen = set()
+    while ebr is not None and ebr not in seen:
+        seen.add(ebr)
+        logical = entries(ebr * 512)
+        if logical is None:
+            break
+        (_status, _chs, ptype, _chs_end, first, sectors) = logical[0]
+        if ptype != 0 and sectors != 0:
+            partitions.append((number, (ebr + first) * 512, sectors * 512))
+            number += 1
+        (_status, _chs, ptype, _chs_end, first, sectors) = logical[1]
+        ebr = extended + first if ptype in MBR_EXTENDED and first else None
+    return partitions
+
+def read_partitions(disk_img):
+    """Read the partition table of a disk image file
+
+    :param str disk_img: The full path to a partitioned disk image
+    :returns: list of (number, offset, size) in bytes, sorted by number
     :rtype: list of tuples
+
+    Like the kernel, a GPT is only used when the MBR has a protective
+    entry for it, and the GPT's checksums are correct. It is looked for
+    with 512 and 4096 byte sectors. Otherwise the MBR primary and logical
+    partitions are used, so a GPT header left over from an earlier partition
+    table is ignored. An image without a partition table has no partitions.
+    """
+    with open(disk_img, "rb") as f:
+        mbr = _read_at(f, 0, 512)
+        protective = len(mbr) == 512 and mbr[510:512] == b"\x55\xaa" and \
+                     any(mbr[0x1BE + i*16 + 4] == MBR_GPT for i in range(4))
+        if not protective:
+            return _mbr_partitions(f) or []
+        for sector_size in (512, 4096):
+            partitions = _gpt_partitions(f, sector_size)
+            if partitions is not None:
+                return partitions
+        logger.warning("%s has a protective MBR without a valid GPT", disk_img)
+        return []
+
+def fs_type(disk_img, offset=0):
+    """Identify the filesystem at an offset in an image file from its superblock magic
+
+    :param str disk_img: The full path to an image file
+    :param int offset: The offset in bytes of the filesystem, eg. from read_partitions()
+    :returns: The filesystem type or None if it isn't recognized
+    :rtype: str
     """
-    # Example kpartx output
-    # kpartx -p p -v -a /tmp/diskV2DiCW.im
-    # add map loop2p1 (253:2): 0 3481600 linear /dev/loop2 2048
-    # add map loop2p2 (253:3): 0 614400 linear /dev/loop2 3483648
-    kpartx_output = runcmd_output(["kpartx", "-v", "-a", "-s", disk_img])
-    logger.debug(kpartx_output)
-
-    # list of (deviceName, sizeInBytes)
-    loop_devices = []
-    for line in kpartx_output.splitlines():
-        # add map loop2p3 (253:4): 0 7139328 linear /dev/loop2 528384
-        # 3rd element is size in 512 byte blocks
-        if line.startswith("add map "):
-            fields = line[8:].split()
-            loop_devices.append( (fields[0], int(fields[3])*512) )
-    return loop_devices
+    with open(disk_img, "rb") as f:
+        for fstype, magic_offset, magic in FS_MAGIC:
+            if _read_at(f, offset + magic_offset, len(magic)) == magic:
+                return fstype
+    return None
 
 class PartitionMount(object):
-    """ Mount a partitioned image file using kpartx """
+    """ Mount a partitioned image file using loop devices """
     def __init__(self, disk_img, mount_ok=None, submount=None):
         """
         :param str disk_img: The full path to a partitioned disk image
@@ -417,13 +1127,19 @@ class PartitionMount(object):
         If the partition is found it will be mounted under a temporary
         directory and self.temp_dir set to it. If submount is passed it will be
         created and mounted there instead, with self.mount_dir set to point to
-        it. self.mount_dev is set to the loop device, and self.mount_size is
-        set to the size of the partition.
+        it. self.mount_dev is set to the loop device, self.mount_size is
+        set to the size of the partition, and self.mount_part to its entry
+        in self.partitions.
+
+        The partition table is read from the image, only partitions with a
+        filesystem that can be mounted are tried. Each one is attached to a
+        loop device limited to the partition.
 
         When no subdir is passed self.temp_dir and self.mount_dir will be the same.
         """
         self.mount_dev = None
         self.mount_size = None
+        self.mount_part = None
         self.mount_dir = None
         self.disk_img = disk_img
         self.mount_ok = mount_ok
@@ -434,8 +1150,13 @@ class PartitionMount(object):
         if not self.mount_ok:
             self.mount_ok = lambda mount_dir: os.path.isfile(mount_dir+"/etc/passwd")
 
-        # list of (deviceName, sizeInBytes)
-        self.loop_devices = kpartx_disk_img(self.disk_img)
+        # list of (number, offset, size, fstype)
+        self.partitions = []
+        for number, offset, size in read_partitions(self.disk_img):
+            fstype = fs_type(self.disk_img, offset)
+            logger.debug("%s partition %d: offset=%d size=%d fstype=%s", self.disk_img, number, offset, size, fstype)
+            if fstype not in (None, "swap"):
+                self.partitions.append((number, offset, size, fstype))
 
     def __enter__(self):
         # Mount the device selected by mount_ok, if possible
@@ -445,17 +1166,16 @@ class PartitionMount(object):
             os.makedirs(mount_dir, mode=0o755, exist_ok=True)
         else:
             mount_dir = self.temp_dir
-        for dev, size in self.loop_devices:
-            try:
-                mount( "/dev/mapper/"+dev, mnt=mount_dir )
-                if self.mount_ok(mount_dir):
-                    self.mount_dir = mount_dir
-                    self.mount_dev = dev
-                    self.mount_size = size
+        try:
+            for part in self.partitions:
+                if self._try_mount(part, mount_dir):
                     break
-                umount( mount_dir )
-            except CalledProcessError:
-                logger.debug(traceback.format_exc())
+        except BaseException:
+            # Don't remove the directory if a failed umount left something on it
+            if not os.path.ismount(mount_dir):
+                shutil.rmtree(self.temp_dir)
+                self.temp_dir = None
+            raise
         if self.mount_dir:
             logger.info("Partition mounted on %s size=%s", self.mount_dir, self.mount_size)
         else:
@@ -464,13 +1184,43 @@ class PartitionMount(object):
             self.temp_dir = None
         return self
 
+    def _try_mount(self, part, mount_dir):
+        """Mount the partition on mount_dir and return True if mount_ok accepts it
+
+        Otherwise, or if anything fails, it is unmounted and its loop device
+        is detached.
+        """
+        (_number, offset, size, _fstype) = part
+        dev = loop_attach(self.disk_img, offset, size)
+        mounted = False
+        try:
+            mount( dev, mnt=mount_dir )
+            mounted = True
+            if self.mount_ok(mount_dir):
+                self.mount_dir = mount_dir
+                self.mount_dev = dev
+                self.mount_size = size
+                self.mount_part = part
+                return True
+        except CalledProcessError:
+            logger.debug(traceback.format_exc())
+        finally:
+            # Only the chosen partition stays attached
+            if self.mount_dev != dev:
+                if mounted:
+                    umount( mount_dir )
+                loop_detach(dev)
+        return False
+
     def __exit__(self, exc_type, exc_value, tracebk):
         if self.temp_dir:
             umount(self.mount_dir)
             shutil.rmtree(self.temp_dir)
             self.mount_dir = None
             self.temp_dir = None
-        execWithRedirect("kpartx", ["-d", "-s", self.disk_img])
+        if self.mount_dev:
+            loop_detach(self.mount_dev)
+            self.mount_dev = None
 
 
 class ProcMount(object):
@@ -541,17 +1291,37 @@ class DracutChroot(ProcMount):
 
 ######## Functions for making filesystem images ##########################
 
+# mkfs arguments for populating a new filesystem from a directory
+MKFS_ROOTDIR = {"ext4": "-d", "btrfs": "--rootdir"}
+
 def mkfsimage(fstype, rootdir, outfile, size=None, mkfsargs=None, mountargs="", graft=None):
     '''Generic filesystem image creation function.
     fstype should be a filesystem type - "mkfs.${fstype}" must exist.
     graft should be a dict: {"some/path/in/image": "local/file/or/dir"};
     if the path ends with a '/' it's assumed to be a directory.
+    Filesystems in MKFS_ROOTDIR are populated by mkfs straight from rootdir,
+    without a loop device or mount, unless there are grafts or mountargs. If
+    that fails, like with an older mkfs or a file it can't copy, the image is
+    made again by mounting it and copying the files.
     Will raise CalledProcessError if something goes wrong.'''
     mkfsargs = mkfsargs or []
     graft = graft or {}
     preserve = (fstype not in ("msdos", "vfat"))
     if not size:
         size = estimate_size(rootdir, graft, fstype)
+    if fstype in MKFS_ROOTDIR and not graft and not mountargs:
+        mksparse(outfile, size)
+        cmd = ["mkfs.%s" % fstype] + mkfsargs
+        if rootdir:
+            cmd += [MKFS_ROOTDIR[fstype], os.path.abspath(rootdir)]
+        try:
+            runcmd(cmd + [os.path.abspath(outfile)])
+            return
+        except CalledProcessError as e:
+            logger.warning("mkfs exited with a non-zero return code: %d, copying the files to the mounted image instead",
+                           e.returncode)
+            logger.warning(e.output)
+
     with LoopDev(outfile, size) as loopdev:
         try:
             runcmd(["mkfs.%s" % fstype] + mkfsargs + [loopdev])
@@ -606,6 +1376,9 @@ def mkfsimage_from_disk(diskimage, fsimage, img_size=None, label="Anaconda"):
     :param int img_size: Optional size of the fsimage in MiB or None to make
        it as small as possible
     :param str label: The label to apply to the image. Defaults to "Anaconda"
+
+    This needs root, the partition is mounted from a loop device. Only the
+    new image is made without mounting it.
     """
     with PartitionMount(diskimage) as img_mount:
         if not img_mount or not img_mount.mount_dir:
@@ -627,5 +1400,5 @@ def default_image_name(compression, basename):
 
     If the compression is unknown it defaults to xz
     """
-    SUFFIXES = {"xz": ".xz", "gzip": ".gz", "bzip2": ".bz2", "lzma": ".lzma"}
+    SUFFIXES = {"xz": ".xz", "gzip": ".gz", "bzip2": ".bz2", "lzma": ".lzma", "zstd": ".zst", "lz4": ".lz4"}
     return basename + SUFFIXES.get(compression, ".xz")
@@ -24,38 +24,127 @@ import logging
 logger = logging.getLogger("pylorax.ltmpl")
 
 import os, re, glob, shlex, fnmatch
+import hashlib
+import ast
+import errno
+import inspect
+import tempfile
+import threading
+import time
+import json
+from contextlib import contextmanager
+from collections import Counter
 from os.path import basename, isdir
+from stat import S_ISDIR, S_ISREG, S_ISLNK, S_ISVTX
+from bisect import bisect_left
 from subprocess import CalledProcessError
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
-from pylorax.sysutils import joinpaths, cpfile, mvfile, replace, remove
+from pylorax.sysutils import joinpaths, cpfile, mvfile, multi_replace, remove, PendingRemovals
 from pylorax.dnfhelper import LoraxDownloadCallback, LoraxRpmCallback
 from pylorax.base import DataHolder
-from pylorax.executils import runcmd, runcmd_output
+from pylorax.executils import runcmd, runcmd_output, execWithCapture
+from pylorax.systemdutils import UnitFiles
+from pylorax.pkgsizes import PackageSizes
 from pylorax.imgutils import mkcpio, ProcMount
 
 import collections.abc
 from mako.lookup import TemplateLookup
+from mako.template import ModuleInfo
 from mako.exceptions import text_error_template
 import sys, traceback
 import struct
 
 import libdnf5 as dnf5
 from libdnf5.base import GoalProblem_NO_PROBLEM as NO_PROBLEM
-from libdnf5.common import QueryCmp_EQ as EQ
+from libdnf5.common import QueryCmp_GLOB as GLOB
+try:
+    # Only needed to leave files out of the package transaction
+    import rpm
+except ImportError:
+    rpm = None
 action_is_inbound = dnf5.base.transaction.transaction_item_action_is_inbound
 
 
 class LoraxTemplate(object):
-    def __init__(self, directories=None):
+    """
+    Render and split Lorax templates
+
+    If cachedir is set the compiled mako modules are written under it, in a
+    subdirectory for the template directories, and reused by later builds as
+    long as the template's contents have not changed. The caller should include
+    the lorax version in cachedir. The cache is not used if cachedir, or a
+    directory above it, can be changed by another user.
+
+    The loaded templates and the split and expanded results are kept by the
+    object, so they are reused when the same object parses a template again.
+    Only the last max_expanded results are kept.
+    """
+    max_expanded = 32
+
+    def __init__(self, directories=None, cachedir=None):
         directories = directories or ["/usr/share/lorax"]
         # we have to add ["/"] to the template lookup directories or the
         # file includes won't work properly for absolute paths
         self.directories = ["/"] + directories
+        self.cachedir = cachedir
+        self.stats = Counter()
+        self._lookup = None
+        self._loaded = {}
+        self._expanded = {}
+
+    def _get_lookup(self):
+        """Return the TemplateLookup for these directories, creating it if needed"""
+        if self._lookup is None:
+            module_directory = None
+            if self.cachedir:
+                # Templates with the same name in different directories must not share a module
+                dirhash = hashlib.sha256("\0".join(self.directories).encode("utf-8")).hexdigest()
+                try:
+                    module_directory = joinpaths(self.cachedir, dirhash[:16])
+                    os.makedirs(module_directory, mode=0o755, exist_ok=True)
+                    _check_cache_dir(module_directory)
+                except OSError as e:
+                    module_directory = None
+                    logger.warning("Not caching compiled templates in %s: %s", self.cachedir, e)
+            modulename = None
+            if module_directory:
+                modulename = lambda filename, uri, d=module_directory: _template_module_name(d, filename, uri)
+            self._lookup = _TemplateLookup(directories=self.directories,
+                                           module_directory=module_directory,
+                                           modulename_callable=modulename,
+                                           module_writer=self._write_module)
+        return self._lookup
+
+    def _write_module(self, source, outputpath):
+        """Write a compiled template module, counting it"""
+        self.stats["compiled"] += 1
+        _write_template_module(source, outputpath)
 
     def parse(self, template_file, variables):
-        lookup = TemplateLookup(directories=self.directories)
+        """Return the template's commands as lists of the command and its arguments"""
+        return [line for _num, _source, line in self.parse_lines(template_file, variables)]
+
+    def parse_lines(self, template_file, variables):
+        """Return the template's commands as (line number, source, command list) tuples
+
+        The line number is the line in the rendered template, the source is
+        the (template uri, line number) of the template source it came from,
+        which can be an included template.
+        """
+        lookup = self._get_lookup()
+        compiled = self.stats["compiled"]
         template = lookup.get_template(template_file)
+        if self._loaded.get(template_file) is template:
+            self.stats["memory"] += 1
+        elif not lookup.module_directory:
+            # Compiled in memory, the module writer is not used
+            self.stats["compiled"] += 1
+        elif self.stats["compiled"] == compiled:
+            # The module writer counts the ones it compiles
+            self.stats["disk"] += 1
+        self._loaded[template_file] = template
 
         try:
             textbuf = template.render(**variables)
@@ -64,25 +153,181 @@ class LoraxTemplate(object):
             logger.error(text_error_template().render())
             raise
 
+        sources = _line_sources(textbuf, _template_literals(lookup, template))
+        key = hashlib.sha256(textbuf.encode("utf-8")).hexdigest()
+        if key in self._expanded:
+            self.stats["expanded"] += 1
+            # Move it to the end, the oldest results are dropped first
+            self._expanded[key] = self._expanded.pop(key)
+        else:
+            while len(self._expanded) >= self.max_expanded:
+                del self._expanded[next(iter(self._expanded))]
+            self._expanded[key] = self._split(textbuf, sources)
+        logger.debug("template cache: %d compiled, %d loaded from disk, %d from memory, %d expansions reused",
+                     self.stats["compiled"], self.stats["disk"], self.stats["memory"], self.stats["expanded"])
+        return [(num, sources.get(num), list(line)) for num, line in self._expanded[key]]
+
+    @staticmethod
+    def _split(textbuf, sources=None):
+        """Split the rendered template into a list of numbered commands and their arguments"""
         # split, strip and remove empty lines
-        lines = textbuf.splitlines()
-        lines = [line.strip() for line in lines]
-        lines = [line for line in lines if line]
+        lines = enumerate(textbuf.splitlines(), 1)
+        lines = [(num, line.strip()) for num, line in lines]
+        lines = [(num, line) for num, line in lines if line]
 
         # remove comments
-        lines = [line for line in lines if not line.startswith("#")]
+        lines = [(num, line) for num, line in lines if not line.startswith("#")]
 
         # split with shlex and perform brace expansion. This can fail, so we unroll the loop
         # for better error reporting.
         expanded_lines = []
         try:
-            for line in lines:
-                expanded_lines.append(split_and_expand(line))
+            for num, line in lines:
+                expanded_lines.append((num, split_and_expand(line)))
         except Exception as e:
-            logger.error('shlex error processing "%s": %s', line, str(e))
+            source = (sources or {}).get(num)
+            if source:
+                logger.error('shlex error processing %s line %d "%s": %s', source[0], source[1], line, str(e))
+            else:
+                logger.error('shlex error processing line %d "%s": %s', num, line, str(e))
             raise
         return expanded_lines
 
+def _template_literals(lookup, template, seen=None):
+    """Return the (text, uri, line) of the lines of text written by a template
+
+    The text and its line in the template source are found from the calls that
+    write it in the compiled module and the module's line map. The text of the
+    templates it includes follows the text written before the include, in the
+    same order as the module's code, not the order it is rendered in.
+    """
+    seen = seen or set()
+    if template.uri in seen:
+        return []
+    seen.add(template.uri)
+    metadata = ModuleInfo.get_module_source_metadata(template.code, full_line_map=True)
+    line_map = metadata["full_line_map"]
+    if not line_map:
+        return []
+    calls = [node for node in ast.walk(ast.parse(template.code))
+             if isinstance(node, ast.Call) and node.args]
+    literals = []
+    for node in sorted(calls, key=lambda n: (n.lineno, n.col_offset)):
+        line = line_map[min(node.lineno, len(line_map)) - 1]
+        if isinstance(node.func, ast.Name) and node.func.id == "__M_writer" \
+           and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
+            for i, part in enumerate(node.args[0].value.split("\n")):
+                if part.strip():
+                    literals.append((part.strip(), metadata["uri"], line + i))
+        elif isinstance(node.func, ast.Attribute) and node.func.attr == "_include_file" \
+             and len(node.args) > 1 and isinstance(node.args[1], ast.Constant):
+            try:
+                included = lookup.get_template(lookup.adjust_uri(node.args[1].value, template.uri))
+            except Exception: # pylint: disable=broad-except
+                continue
+            literals.extend(_template_literals(lookup, included, seen))
+    return literals
+
+def _line_sources(textbuf, literals):
+    """Return a dict of the rendered line numbers and the (uri, line) they came from
+
+    A line comes from the longest text written by a template that it starts
+    with. When the same text is written by several lines, or by a loop, the
+    first one after the previous line's source is used. Lines that start with
+    the value of an expression are not in the dict.
+    """
+    sources = {}
+    pos = 0
+    for num, line in enumerate(textbuf.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        matches = [i for i, (text, _uri, _line) in enumerate(literals) if line.startswith(text)]
+        if not matches:
+            continue
+        longest = max(len(literals[i][0]) for i in matches)
+        matches = [i for i in matches if len(literals[i][0]) == longest]
+        pos = next((i for i in matches if i >= pos), matches[0])
+        sources[num] = literals[pos][1:]
+    return sources
+
+def _check_cache_dir(path):
+    """Raise OSError if another user could change the modules in path
+
+    The modules are imported by lorax, running as root. path must be owned by
+    the current user and not writable by others, the directories above it must
+    be owned by root or the current user and only writable by others if they are
+    sticky, like /var/tmp.
+    """
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    if st.st_uid != os.geteuid() or st.st_mode & 0o022:
+        raise OSError(errno.EPERM, "Not owned by uid %d or writable by other users" % os.geteuid(), path)
+    while path != "/":
+        path = os.path.dirname(path)
+        st = os.stat(path)
+        if st.st_uid not in (0, os.geteuid()) or (st.st_mode & 0o022 and not st.st_mode & S_ISVTX):
+            raise OSError(errno.EPERM, "Writable by other users", path)
+
+def _file_digest(filename):
+    """Return the sha256 hex digest of a file's contents"""
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class _TemplateLookup(TemplateLookup):
+    """
+    TemplateLookup that reloads a template when its contents change
+
+    mako compares the template's mtime, in whole seconds, with the time it
+    was compiled so it misses a template that is rewritten within the same
+    second. This one also compares a hash of the contents with the ones it
+    loaded, the same hash that names the modules in the disk cache. The file
+    is only hashed again when its mtime or size has changed.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._digests = {}
+
+    def _load(self, filename, uri):
+        st = os.stat(filename)
+        digest = _file_digest(filename)
+        template = super()._load(filename, uri)
+        self._digests[uri] = (st.st_mtime_ns, st.st_size, digest)
+        return template
+
+    def _check(self, uri, template):
+        if template.filename is not None and uri in self._digests:
+            mtime, size, digest = self._digests[uri]
+            try:
+                st = os.stat(template.filename)
+                if (st.st_mtime_ns, st.st_size) != (mtime, size):
+                    if _file_digest(template.filename) != digest:
+                        self._collection.pop(uri, None)
+                        return self._load(template.filename, uri)
+                    self._digests[uri] = (st.st_mtime_ns, st.st_size, digest)
+            except OSError:
+                pass
+        return super()._check(uri, template)
+
+def _template_module_name(module_directory, filename, uri):
+    """Return the path of a template's compiled module, named after a hash of its contents
+
+    mako only recompiles a module when the template is newer than it, but
+    templates installed by rpm keep the mtime from when they were built.
+    """
+    digest = _file_digest(filename)
+    return os.path.normpath(joinpaths(module_directory, uri.lstrip("/"))) + "." + digest[:16] + ".py"
+
+def _write_template_module(source, outputpath):
+    """Write a compiled template module, replacing any old one atomically"""
+    fd, name = tempfile.mkstemp(dir=os.path.dirname(outputpath))
+    try:
+        os.write(fd, source)
+    finally:
+        os.close(fd)
+    os.chmod(name, 0o644)
+    os.rename(name, outputpath)
+
 def split_and_expand(line):
     return [exp for word in shlex.split(line) for exp in brace_expand(word)]
 
@@ -100,7 +345,7 @@ def brace_expand(s):
 def rglob(pathname, root="/", fatal=False):
     seen = set()
     rootlen = len(root)+1
-    for f in glob.iglob(joinpaths(root, pathname)):
+    for f in glob.iglob(joinpaths(root, pathname), recursive=True):
         if f not in seen:
             seen.add(f)
             yield f[rootlen:] # remove the root to produce relative path
@@ -114,6 +359,1409 @@ def rexists(pathname, root=""):
         return True
     return False
 
+def glob_re(pattern):
+    """
+    Return a regex that matches the paths matching a glob
+
+    Unlike fnmatch.translate the wildcards do not match /, like glob. The
+    regex is not anchored at the end so it can be combined with others.
+    """
+    res = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == "*" and pattern[i:i+1] == "*":
+            # ** matches any number of directories, like a recursive glob
+            res.append(".*")
+            i += 1
+        elif c == "*":
+            res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+        elif c == "[" and "]" in pattern[i+1:]:
+            j = pattern.index("]", i+1)
+            chars = pattern[i:j]
+            if chars[0] == "!":
+                chars = "^" + chars[1:]
+            res.append("[%s]" % chars.replace("\\", "\\\\"))
+            i = j + 1
+        else:
+            res.append(re.escape(c))
+    return "".join(res)
+
+class ModuleIndex(object):
+    """
+    Index of the kernel modules under /lib/modules/*/kernel/
+
+    This has the size of each file, and the dependencies of the modules from
+    each kernel's modules.dep. The paths are the same as the ones os.walk
+    returns for the kernel directories, the runner is responsible for calling
+    removed() when it removes any of them.
+    """
+    def __init__(self, root):
+        """
+        :param root: The root directory containing the kernel modules
+        :type root: str
+        """
+        self.root = root
+        self.moddir = os.path.normpath(joinpaths(root, "lib/modules"))
+        # The same directory can be reached through /usr/lib/modules
+        realroot = os.path.realpath(root)
+        realdir = os.path.realpath(self.moddir)
+        self.aliases = []
+        if realdir.startswith(realroot + "/"):
+            alias = os.path.normpath(joinpaths(root, realdir[len(realroot):]))
+            if alias != self.moddir:
+                self.aliases.append(alias)
+        self.files = {}
+        self.deps = {}
+        if not os.path.isdir(self.moddir):
+            return
+        for version in sorted(os.listdir(self.moddir)):
+            kerneldir = joinpaths(self.moddir, version, "kernel")
+            for dirpath, _dirs, files in os.walk(kerneldir):
+                for f in files:
+                    path = dirpath + "/" + f
+                    try:
+                        self.files[path] = (path[len(kerneldir)+1:], os.lstat(path).st_size)
+                    except OSError:
+                        pass
+            self._read_deps(joinpaths(self.moddir, version))
+
+    def _read_deps(self, versiondir):
+        try:
+            with open(joinpaths(versiondir, "modules.dep"), "r") as f:
+                for line in f:
+                    module, _colon, deps = line.partition(":")
+                    if deps.strip():
+                        self.deps[joinpaths(versiondir, module.strip())] = \
+                            [joinpaths(versiondir, d) for d in deps.split()]
+        except OSError:
+            logger.debug("no modules.dep in %s", versiondir)
+
+    def match(self, globs):
+        """
+        Return the files under the directories matching any of the globs
+
+        :param globs: Globs relative to the kernel directory of each kernel
+        :type globs: list of str
+        :returns: The paths of the matching files
+        :rtype: set of str
+        """
+        globs_re = re.compile("|".join("(?:%s)/" % glob_re(g.strip("/")) for g in globs))
+        return set(path for path, (relpath, _size) in self.files.items() if globs_re.match(relpath))
+
+    def getsize(self, *paths):
+        return sum(self.files[p][1] for p in paths if p in self.files)
+
+    def needed_by(self, paths):
+        """
+        Return the modules needed to load the modules in paths
+
+        :param paths: The paths of the modules
+        :type paths: iterable of str
+        :returns: The paths of all the modules they depend on, directly or indirectly
+        :rtype: set of str
+        """
+        needed = set()
+        todo = [d for p in paths for d in self.deps.get(p, [])]
+        while todo:
+            p = todo.pop()
+            if p not in needed:
+                needed.add(p)
+                todo.extend(self.deps.get(p, []))
+        return needed
+
+    def _relpath(self, path):
+        """Return path relative to the modules directory, or None if it isn't related to it"""
+        for d in [self.moddir] + self.aliases:
+            if path == d or path.startswith(d + "/"):
+                return path[len(d)+1:]
+            if d.startswith(path + "/"):
+                # A parent of the modules directory
+                return ""
+        return None
+
+    def related(self, path):
+        """Return True if path is, or contains, part of the kernel modules"""
+        return self._relpath(os.path.normpath(path)) is not None
+
+    def removed(self, path):
+        """Record that path, and everything under it, has been removed"""
+        path = os.path.normpath(path)
+        if self.files.pop(path, None) is not None:
+            return
+        relpath = self._relpath(path)
+        if relpath is None:
+            return
+        prefix = joinpaths(self.moddir, relpath) + "/" if relpath else self.moddir + "/"
+        for p in [p for p in self.files if p.startswith(prefix) or p == prefix[:-1]]:
+            del self.files[p]
+
+class PkgFileIndex(object):
+    """
+    Index of the files installed by a package transaction
+
+    This maps package names to their files, and files to the packages that
+    own them. The type and size of each path in the outroot is looked up the
+    first time it is needed and cached, the runner is responsible for
+    calling invalidate() or removed() when it changes the tree.
+    """
+    def __init__(self, root, packages):
+        """
+        :param root: The root directory the packages were installed into
+        :type root: str
+        :param packages: The packages that were installed
+        :type packages: list of libdnf5.rpm.Package
+        """
+        self.root = root
+        self.packages = []
+        self.pkgfiles = {}
+        self.owners = {}
+        self._stat = {}
+        self._names = {}
+        for pkg in packages:
+            self._add(pkg.get_name(), pkg.get_arch(), list(pkg.get_files()))
+        self._paths = sorted(self.owners)
+
+    @classmethod
+    def from_pkglists(cls, root, pkglistdir):
+        """
+        Create the index from the package file lists written by _writepkglists
+
+        :param root: The root directory the packages were installed into
+        :type root: str
+        :param pkglistdir: The directory with a file list for each package
+        :type pkglistdir: str
+        :returns: The index, the package arches are not known and are empty
+        :rtype: PkgFileIndex
+        """
+        index = cls(root, [])
+        for name in sorted(os.listdir(pkglistdir)):
+            with open(joinpaths(pkglistdir, name), "r") as f:
+                index._add(name, "", [l.rstrip("\n") for l in f if l.strip()])
+        index._paths = sorted(index.owners)
+        return index
+
+    def _add(self, name, arch, files):
+        self.packages.append((name, arch, files))
+        self.pkgfiles.setdefault(name, []).extend(files)
+        for f in files:
+            self.owners.setdefault(f, set()).add(name)
+
+    def _lookup(self, path):
+        """Return a (isdir, isfile, size) tuple for path, following symlinks"""
+        if not path.startswith("/"):
+            path = "/" + path
+        try:
+            return self._stat[path]
+        except KeyError:
+            pass
+        cache = path in self.owners
+        try:
+            st = os.lstat(joinpaths(self.root, path))
+            if S_ISLNK(st.st_mode):
+                # The target may be changed by removing some other path, don't cache it
+                cache = False
+                st = os.stat(joinpaths(self.root, path))
+            info = (S_ISDIR(st.st_mode), S_ISREG(st.st_mode), st.st_size)
+        except OSError:
+            info = (False, False, 0)
+        # Only paths owned by a package are cached, these are the only ones
+        # that invalidate() knows how to find.
+        if cache:
+            self._stat[path] = info
+        return info
+
+    def _subtree(self, path):
+        """Return the indexed paths that are path or are under path"""
+        path = path.rstrip("/") or "/"
+        prefix = path if path == "/" else path + "/"
+        start = bisect_left(self._paths, path)
+        for p in self._paths[start:]:
+            if p == path or p.startswith(prefix):
+                yield p
+            elif p > prefix:
+                break
+
+    def _relpath(self, path):
+        """Convert a path in the root to an absolute path inside the root"""
+        if path.startswith(self.root):
+            path = path[len(self.root):]
+        return os.path.normpath("/" + path.lstrip("/"))
+
+    def isdir(self, path):
+        return self._lookup(path)[0]
+
+    def getsize(self, path):
+        """Return the size of path if it is a regular file, otherwise 0"""
+        _isdir, isfile, size = self._lookup(path)
+        return size if isfile else 0
+
+    def names(self, *pkg_specs):
+        """Return the package names matching the globs"""
+        key = tuple(pkg_specs)
+        if key not in self._names:
+            self._names[key] = [n for n in self.pkgfiles
+                                if any(fnmatch.fnmatch(n, spec) for spec in pkg_specs)]
+        return self._names[key]
+
+    def filelist(self, *pkg_specs):
+        """Return the files, not directories, owned by packages matching the globs"""
+        return set(f for n in self.names(*pkg_specs) for f in self.pkgfiles[n]
+                   if not self.isdir(f))
+
+    def owned_by(self, path):
+        """Return the names of the packages owning path"""
+        return self.owners.get(self._relpath(path), set())
+
+    def removed(self, path):
+        """Record that path, and everything under it, has been removed"""
+        for p in self._subtree(self._relpath(path)):
+            self._stat[p] = (False, False, 0)
+
+    def invalidate(self, path=None):
+        """Forget the cached details of path and everything under it, or all paths"""
+        if path is None:
+            self._stat.clear()
+            return
+        for p in self._subtree(self._relpath(path)):
+            self._stat.pop(p, None)
+
+class TreeIndex(object):
+    """
+    Index of the directory entries under a root, for matching globs in memory
+
+    Each directory is listed with scandir the first time a glob needs it and
+    the listing is kept until the runner reports that it changed, by calling
+    changed() or removed(). Symlinks are followed through the index, the same
+    way the kernel would follow them on disk, including absolute links that
+    point outside the root.
+
+    glob() returns the same paths as glob.glob(recursive=True) would, relative
+    to the root, with two exceptions. ** will not descend into a directory that
+    it is already inside of by way of a symlink loop, and DIR/** does not
+    return DIR/ when DIR doesn't exist. If check is True every glob is also run
+    against the disk and a RuntimeError is raised if the results differ.
+    """
+    # The kernel gives up with ELOOP after following this many symlinks
+    max_links = 40
+
+    def __init__(self, root, check=False):
+        """
+        :param root: The directory to index
+        :type root: str
+        :param check: Compare the results of every glob with glob.glob()
+        :type check: bool
+        """
+        self.root = os.path.normpath(root)
+        self.check = check
+        self._prefix = self.root.rstrip("/") + "/"
+        self._dirs = {}
+        self._links = {}
+        self._patterns = {}
+
+    def _inside(self, path):
+        return path == self.root or path.startswith(self._prefix)
+
+    def _listdir(self, path):
+        """Return a dict of the entries in the directory and their type, d, f or l"""
+        inside = self._inside(path)
+        if inside and path in self._dirs:
+            return self._dirs[path]
+        try:
+            with os.scandir(path) as entries:
+                listing = {e.name: "l" if e.is_symlink() else "d" if e.is_dir(follow_symlinks=False) else "f"
+                           for e in entries}
+        except OSError:
+            return None
+        # Directories outside the root are not kept up to date, look at them every time
+        if inside:
+            self._dirs[path] = listing
+        return listing
+
+    def _readlink(self, path):
+        if path in self._links:
+            return self._links[path]
+        target = os.readlink(path)
+        if self._inside(path):
+            self._links[path] = target
+        return target
+
+    def _resolve(self, path, name, depth=0):
+        """Return the physical path of the directory name in path, or None if it isn't one"""
+        if name == ".":
+            return path
+        if name == "..":
+            return os.path.dirname(path)
+        listing = self._listdir(path)
+        kind = listing.get(name) if listing is not None else None
+        if kind == "d":
+            return os.path.join(path, name)
+        if kind != "l" or depth >= self.max_links:
+            return None
+
+        link = os.path.join(path, name)
+        try:
+            target = self._readlink(link)
+        except OSError:
+            return None
+        path = "/" if target.startswith("/") else path
+        for part in target.split("/"):
+            if part:
+                path = self._resolve(path, part, depth+1)
+                if path is None:
+                    return None
+        return path
+
+    def _lexists(self, path, name):
+        if name in (".", ".."):
+            return True
+        listing = self._listdir(path)
+        return listing is not None and name in listing
+
+    def _match(self, part):
+        if part not in self._patterns:
+            self._patterns[part] = re.compile(fnmatch.translate(part)).match
+        return self._patterns[part]
+
+    def _walk(self, path, rel, dironly, parents):
+        """Yield the physical and relative paths of everything under path, like ** does"""
+        listing = self._listdir(path)
+        if listing is None:
+            return
+        parents = parents | {path}
+        for name in list(listing):
+            if name.startswith("."):
+                continue
+            subpath = self._resolve(path, name)
+            if dironly and subpath is None:
+                continue
+            subrel = rel + "/" + name if rel else name
+            yield subpath, subrel
+            if subpath is not None and subpath not in parents:
+                yield from self._walk(subpath, subrel, dironly, parents)
+
+    def _glob(self, path, rel, parts, dironly):
+        """Yield the relative paths under path that match the pattern parts"""
+        part, rest = parts[0], parts[1:]
+        if part == "**":
+            if rest:
+                yield from self._glob(path, rel, rest, dironly)
+                for subpath, subrel in self._walk(path, rel, True, frozenset()):
+                    yield from self._glob(subpath, subrel, rest, dironly)
+            else:
+                yield rel + "/" if rel else ""
+                for _subpath, subrel in self._walk(path, rel, dironly, frozenset()):
+                    yield subrel
+            return
+
+        magic = glob.has_magic(part)
+        if magic:
+            listing = self._listdir(path)
+            if listing is None:
+                return
+            match = self._match(part)
+            names = [n for n in listing if match(n) and (part.startswith(".") or not n.startswith("."))]
+        else:
+            names = [part]
+        for name in names:
+            subrel = rel + "/" + name if rel else name
+            if rest or dironly:
+                subpath = self._resolve(path, name)
+                if subpath is None:
+                    continue
+                if rest:
+                    yield from self._glob(subpath, subrel, rest, dironly)
+                else:
+                    yield subrel + "/"
+            elif magic or self._lexists(path, name):
+                yield subrel
+
+    def iglob(self, pattern):
+        """Yield the paths matching pattern, relative to the root, without checking them"""
+        parts = [p for p in pattern.split("/") if p]
+        if not parts:
+            if os.path.isdir(self.root):
+                yield ""
+            return
+        seen = set()
+        for f in self._glob(self.root, "", parts, pattern.endswith("/")):
+            if f not in seen:
+                seen.add(f)
+                yield f
+
+    def glob(self, pattern):
+        """
+        Return the paths matching pattern
+
+        :param pattern: The glob to match, relative to the root, ** matches any number of directories
+        :type pattern: str
+        :returns: The matching paths, relative to the root
+        :rtype: list of str
+        :raises: RuntimeError if check is True and the results from the disk are different
+        """
+        results = list(self.iglob(pattern))
+        if self.check:
+            rootlen = len(self.root)+1
+            ondisk = set(os.path.normpath(f[rootlen:].lstrip("/") or ".")
+                         for f in glob.iglob(joinpaths(self.root, pattern), recursive=True)
+                         if os.path.lexists(f))
+            indexed = set(os.path.normpath(f or ".") for f in results)
+            if ondisk != indexed:
+                raise RuntimeError("tree index glob of %s in %s is wrong, missing: %s extra: %s" % \
+                                   (pattern, self.root, sorted(ondisk - indexed), sorted(indexed - ondisk)))
+        return results
+
+    def exists(self, pattern):
+        """Return True if anything matches pattern"""
+        if self.check:
+            return bool(self.glob(pattern))
+        for _path in self.iglob(pattern):
+            return True
+        return False
+
+    def _forget(self, path):
+        """Drop the listings of path and everything under it"""
+        prefix = path + "/"
+        for cache in (self._dirs, self._links):
+            for p in [p for p in cache if p == path or p.startswith(prefix)]:
+                del cache[p]
+
+    def _update(self, path, kind):
+        path = os.path.normpath(path)
+        if not self._inside(path):
+            return
+        if path == self.root:
+            self.changed()
+            return
+        # The runner's paths may go through symlinks, the listings are of the real directories
+        parent = os.path.realpath(os.path.dirname(path))
+        path = os.path.join(parent, os.path.basename(path))
+        old = None
+        listing = self._dirs.get(parent)
+        if listing is not None:
+            old = listing.pop(os.path.basename(path), None)
+            if kind is not None:
+                listing[os.path.basename(path)] = kind
+        self._links.pop(path, None)
+        if "d" in (old, kind) or (old is None and kind is None):
+            self._forget(path)
+
+    def changed(self, path=None):
+        """Update the index after path, or anything if path is None, was created or changed"""
+        if path is None:
+            self._dirs.clear()
+            self._links.clear()
+            return
+        try:
+            mode = os.lstat(path).st_mode
+            kind = "l" if S_ISLNK(mode) else "d" if S_ISDIR(mode) else "f"
+        except OSError:
+            kind = None
+        self._update(path, kind)
+
+    def removed(self, path):
+        """Update the index after path, and everything under it, was removed"""
+        self._update(path, None)
+
+class FindClause(object):
+    """
+    One PATH... [TEST...] ACTION... clause of the find template command
+
+    The paths are relative to the root being searched. The tests are ANDed
+    together and each one can be negated with a ! before it. The actions
+    are run in order on everything that passes all of the tests.
+    """
+    # The tests and actions, and the number of arguments they take
+    _test_nargs = {"-name": 1, "-type": 1, "-newer": 1, "-broken": 0}
+    _action_nargs = {"-delete": 0, "-setmtime": 1, "-log": 0}
+
+    def __init__(self, args):
+        """
+        :param args: The arguments of the clause
+        :type args: list of str
+        :raises: ValueError if the clause is not valid
+        """
+        self.cmd = " ".join(args)
+        self.xdev = False
+        self.paths = []
+        self.tests = []
+        self.actions = []
+        args = list(args)
+        while args and not args[0].startswith("-") and args[0] != "!":
+            self.paths.append(os.path.normpath("/" + args.pop(0)).lstrip("/"))
+        if not self.paths:
+            raise ValueError("find %s: needs at least one PATH" % self.cmd)
+
+        negate = False
+        while args:
+            arg = args.pop(0)
+            if arg == "!":
+                negate = not negate
+                continue
+            if arg == "-xdev":
+                self.xdev = True
+                continue
+            if arg not in self._test_nargs and arg not in self._action_nargs:
+                raise ValueError("find %s: unknown test or action %s" % (self.cmd, arg))
+            nargs = self._test_nargs.get(arg, self._action_nargs.get(arg))
+            if len(args) < nargs:
+                raise ValueError("find %s: %s needs an argument" % (self.cmd, arg))
+            value = args.pop(0) if nargs else None
+            if arg in self._test_nargs:
+                if self.actions:
+                    raise ValueError("find %s: %s must come before the actions" % (self.cmd, arg))
+                self.tests.append((arg, self._test_arg(arg, value), negate))
+            elif negate:
+                raise ValueError("find %s: %s cannot be negated" % (self.cmd, arg))
+            else:
+                self.actions.append((arg, self._action_arg(arg, value)))
+            negate = False
+        if negate:
+            raise ValueError("find %s: nothing after !" % self.cmd)
+        if not self.actions:
+            raise ValueError("find %s: needs at least one action" % self.cmd)
+
+    def _test_arg(self, test, value):
+        if test == "-type":
+            if value not in ("f", "d", "l"):
+                raise ValueError("find %s: -type must be f, d or l" % self.cmd)
+            return {"f": S_ISREG, "d": S_ISDIR, "l": S_ISLNK}[value]
+        if test == "-newer":
+            return self._timestamp(value) * 10**9
+        return value
+
+    def _action_arg(self, action, value):
+        if action == "-setmtime":
+            return self._timestamp(value)
+        return value
+
+    def _timestamp(self, value):
+        try:
+            # Accept the @SECONDS format used by find -newermt and touch --date too
+            return int(value.lstrip("@"))
+        except ValueError:
+            raise ValueError("find %s: %s is not a number of seconds" % (self.cmd, value)) from None
+
+    @property
+    def deletes(self):
+        return "-delete" in dict(self.actions)
+
+    def covers(self, relpath, st, devices):
+        """Return True if relpath is under one of the clause's paths, on the same filesystem with -xdev"""
+        for p in self.paths:
+            if not p or relpath == p or relpath.startswith(p + "/"):
+                if not self.xdev or devices.get(p) == st.st_dev:
+                    return True
+        return False
+
+    def match(self, finder, relpath, st):
+        """Return True if everything in the tests is True for relpath"""
+        for test, value, negate in self.tests:
+            if test == "-name":
+                result = fnmatch.fnmatchcase(os.path.basename(relpath) or "/", value)
+            elif test == "-type":
+                result = value(st.st_mode)
+            elif test == "-newer":
+                result = st.st_mtime_ns > value
+            else:
+                result = S_ISLNK(st.st_mode) and not finder.exists(relpath)
+            if result == negate:
+                return False
+        return True
+
+
+class TreeFind(object):
+    """
+    Run the clauses of a find command in one pass over a tree
+
+    Everything under the clauses' paths is listed once, with scandir, and
+    each path is checked against each of the clauses that cover it, in
+    order. A path that a clause deletes is not seen by the later clauses,
+    but the tests see the tree as it was before any of the deletions, so
+    -broken does not match a symlink to a path that is deleted.
+    Like find -delete the directories are visited after everything in them,
+    and a directory is only deleted when everything in it is deleted too.
+
+    The directories just below the top of each path are searched in
+    parallel. Nothing is changed by run(), it returns the matches so that
+    the runner can apply the actions.
+    """
+    # The kernel gives up with ELOOP after following this many symlinks
+    max_links = 40
+
+    def __init__(self, root, clauses, workers=None, skip=None):
+        """
+        :param root: The directory to search, all the paths are relative to it
+        :type root: str
+        :param clauses: The clauses to run
+        :type clauses: list of FindClause
+        :param workers: The number of threads to use
+        :type workers: int
+        :param skip: Physical paths to treat as already removed, with everything under them
+        :type skip: set of str
+        """
+        self.root = root
+        self.clauses = clauses
+        self.workers = workers or min(16, (os.cpu_count() or 1) * 2)
+        self.skip = skip or set()
+        self._realroot = os.path.realpath(root)
+        self._devices = {}
+
+    def _skipped(self, relpath):
+        return bool(self.skip) and os.path.normpath(joinpaths(self._realroot, relpath)) in self.skip
+
+    def _lstat(self, relpath):
+        if self._skipped(relpath):
+            return None
+        try:
+            return os.lstat(joinpaths(self.root, relpath))
+        except OSError:
+            return None
+
+    def exists(self, relpath):
+        """Return True if relpath exists, following symlinks as if the root was /"""
+        resolved = []
+        todo = list(reversed(relpath.split("/")))
+        links = 0
+        while todo:
+            part = todo.pop()
+            if part in ("", "."):
+                continue
+            if part == "..":
+                if resolved:
+                    resolved.pop()
+                continue
+            path = joinpaths(self.root, *resolved, part)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                return False
+            if not S_ISLNK(st.st_mode):
+                resolved.append(part)
+                continue
+            links += 1
+            if links > self.max_links:
+                return False
+            target = os.readlink(path)
+            if target.startswith("/"):
+                resolved = []
+            todo.extend(reversed(target.split("/")))
+        return True
+
+    def _descend(self, relpath, st):
+        """Return True if any of the clauses need the entries of the directory"""
+        for clause in self.clauses:
+            if clause.covers(relpath, st, self._devices):
+                return True
+            if any(not relpath or p.startswith(relpath + "/") for p in clause.paths):
+                return True
+        return False
+
+    def _entries(self, relpath):
+        """Return the names and lstat results of the entries of a directory, sorted by name"""
+        try:
+            with os.scandir(joinpaths(self.root, relpath)) as entries:
+                listing = []
+                for e in entries:
+                    if self._skipped(joinpaths(relpath, e.name)):
+                        continue
+                    try:
+                        listing.append((e.name, e.stat(follow_symlinks=False)))
+                    except OSError:
+                        pass
+        except OSError:
+            return []
+        return sorted(listing)
+
+    def _walk(self, relpath, st):
+        """Return the matches in and under relpath, and True if relpath will be deleted"""
+        matches = []
+        empty = True
+        if S_ISDIR(st.st_mode) and self._descend(relpath, st):
+            for name, subst in self._entries(relpath):
+                submatches, deleted = self._walk(relpath + "/" + name if relpath else name, subst)
+                matches.extend(submatches)
+                empty = empty and deleted
+        return self._check(relpath, st, empty, matches)
+
+    def _check(self, relpath, st, empty, matches):
+        """Add the clauses that match relpath to matches"""
+        for clause in self.clauses:
+            if clause.covers(relpath, st, self._devices) and clause.match(self, relpath, st):
+                delete = clause.deletes and (empty or not S_ISDIR(st.st_mode))
+                matches.append((clause, relpath, delete))
+                if delete:
+                    return matches, True
+        return matches, False
+
+    def run(self):
+        """
+        Find the paths that the clauses match
+
+        :returns: The clause, path, and whether it should be deleted, for each match
+        :rtype: list of (FindClause, str, bool) tuples
+
+        The paths are in the order the actions should be run in, the clauses
+        that match each path are in the order they were given.
+        """
+        paths = sorted(set(p for clause in self.clauses for p in clause.paths))
+        for p in paths:
+            st = self._lstat(p)
+            if st is None:
+                logger.debug("find: %s doesn't exist", p or "/")
+            else:
+                self._devices[p] = st.st_dev
+        # Search the paths that aren't under one of the others
+        tops = [p for p in paths if p in self._devices and
+                not any(not t or p.startswith(t + "/") for t in paths if t != p and t in self._devices)]
+
+        matches = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for top in tops:
+                st = self._lstat(top)
+                if not S_ISDIR(st.st_mode) or not self._descend(top, st):
+                    matches.extend(self._check(top, st, True, [])[0])
+                    continue
+                entries = self._entries(top)
+                subpaths = [top + "/" + name if top else name for name, _st in entries]
+                empty = True
+                for submatches, deleted in executor.map(self._walk, subpaths, [s for _n, s in entries]):
+                    matches.extend(submatches)
+                    empty = empty and deleted
+                matches.extend(self._check(top, st, empty, [])[0])
+        return matches
+
+class TemplateCommand(object):
+    """
+    A single command from a template, ready to be run
+
+    The handler is the runner method that implements the command. Commands
+    with options have a _parse_<cmd> method on the runner, it is run when
+    the template is compiled and the resulting args are passed to the
+    _do_<cmd> method instead of to the command itself. Lines ending with &
+    are run in the background.
+
+    num is the line in the rendered template, source is the (uri, line) of
+    the template source it came from, if it is known.
+    """
+    __slots__ = ("num", "source", "line", "name", "target", "handler", "args", "skiperror", "background")
+
+    def __init__(self, num, line, name, target, handler, args, skiperror, background=False, source=None):
+        self.num = num
+        self.source = source
+        self.line = line
+        self.name = name
+        self.target = target
+        self.handler = handler
+        self.args = args
+        self.skiperror = skiperror
+        self.background = background
+
+    def __str__(self):
+        return " ".join(self.line)
+
+    def location(self, templatefile):
+        """Return the template and line the command came from, for messages"""
+        return _template_location(templatefile, self.num, self.source)
+
+def _template_location(templatefile, num, source=None):
+    """Return the source template and line if it is known, or the rendered line"""
+    if source:
+        return "%s line %d" % source
+    return "%s rendered line %d" % (templatefile, num)
+
+class CompiledTemplate(object):
+    """
+    The commands from a parsed template, with their handlers bound to a runner
+
+    Use TemplateRunner.compile() to create one, and TemplateRunner.run_compiled()
+    to run it. Running it with a different runner rebinds the handlers, the
+    template is not rendered or parsed again.
+    """
+    def __init__(self, templatefile, commands, runner):
+        self.templatefile = templatefile
+        self.commands = commands
+        self.runner = runner
+
+    def bind(self, runner):
+        """Bind the command handlers to a different runner"""
+        if runner is not self.runner:
+            for c in self.commands:
+                c.handler = getattr(runner, c.target)
+            self.runner = runner
+
+class _ProfileThread(threading.local):
+    """The command being measured in each thread, and the files it touched"""
+    def __init__(self):
+        super().__init__()
+        self.files = 0
+        self.measuring = False
+
+class TemplateProfile(object):
+    """
+    Time and resources used by each template command
+
+    Set the runner's profile attribute to one of these to record the wall
+    time, cpu time (including child processes), number of files changed or
+    removed, and bytes freed on the root's filesystem by each command. The
+    report is rewritten to path every time a template finishes.
+
+    Lines run in the background are measured in their worker thread. The cpu
+    time and bytes freed are for the whole process, so they include the
+    lines that ran at the same time.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: The file to write the JSON report to
+        :type path: str
+        """
+        self.path = path
+        self.records = []
+        self._thread = _ProfileThread()
+
+    @staticmethod
+    def _cpu():
+        t = os.times()
+        return t.user + t.system + t.children_user + t.children_system
+
+    @staticmethod
+    def _free(root):
+        if not root:
+            return 0
+        try:
+            st = os.statvfs(root)
+        except OSError:
+            return 0
+        return st.f_bfree * st.f_frsize
+
+    def touched(self, count=1):
+        """Count files changed or removed by the current command"""
+        self._thread.files += count
+
+    @contextmanager
+    def measure(self, templatefile, num, name, text, root=None):
+        """Record what happens inside the with block as a template command"""
+        if self._thread.measuring:
+            # Part of the command that is already being measured
+            yield
+            return
+        self._thread.measuring = True
+        files = self._thread.files
+        free = self._free(root)
+        cpu = self._cpu()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.records.append({"template": templatefile, "line": num, "command": name, "text": text,
+                                 "wall": time.monotonic() - start,
+                                 "cpu": self._cpu() - cpu,
+                                 "files": self._thread.files - files,
+                                 "freed": self._free(root) - free})
+            self._thread.measuring = False
+
+    def report(self):
+        """
+        Return the report
+
+        :returns: Totals for each template and command, and the details of each line
+        :rtype: dict
+        """
+        templates = {}
+        commands = {}
+        for r in self.records:
+            for key, totals in ((r["template"], templates), (r["command"], commands)):
+                t = totals.setdefault(key, {"count": 0, "wall": 0.0, "cpu": 0.0, "files": 0, "freed": 0})
+                t["count"] += 1
+                for k in ("wall", "cpu", "files", "freed"):
+                    t[k] += r[k]
+        return {"templates": templates, "commands": commands, "lines": self.records}
+
+    def save(self):
+        """Write the report to path"""
+        if not self.path:
+            return
+        tmpname = self.path + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(tmpname, self.path)
+
+    def log_summary(self, top=10):
+        """Log the totals for each command and the slowest lines"""
+        report = self.report()
+        logger.info("template command totals:")
+        for name, t in sorted(report["commands"].items(), key=lambda i: -i[1]["wall"]):
+            logger.info("  %-12s %5d lines %9.2fs wall %9.2fs cpu %7d files %12d bytes freed",
+                        name, t["count"], t["wall"], t["cpu"], t["files"], t["freed"])
+        logger.info("slowest %d template lines:", top)
+        for r in sorted(self.records, key=lambda r: -r["wall"])[:top]:
+            logger.info("  %9.2fs %s:%d %.80s", r["wall"], os.path.basename(r["template"] or ""),
+                        r["line"], r["text"])
+
+class CleanupPlan(object):
+    """
+    The files and bytes that the removal commands would delete
+
+    Set the runner's plan attribute to one of these to run a cleanup template
+    without changing the tree. remove, removefrom, removepkg, removekmod and
+    the -delete action of find record the paths they would remove instead of
+    removing them, and the indexes are told they are gone so that later lines
+    see the same tree as they would in a real run. The other commands, except
+    for flush and log, are skipped and listed in the report.
+    """
+    def __init__(self, root, path=None):
+        """
+        :param root: The root directory being cleaned up
+        :type root: str
+        :param path: The file to write the JSON report to
+        :type path: str
+        """
+        self.root = root
+        self.path = path
+        self.records = []
+        self.skipped = []
+        self._pending = PendingRemovals()
+        self._inodes = set()
+        self._current = None
+
+    def start(self, templatefile, num, name, text):
+        """Start recording the removals for a template line"""
+        self._current = {"template": templatefile, "line": num, "command": name, "text": text,
+                         "files": 0, "bytes": 0}
+        self.records.append(self._current)
+
+    def skip(self, templatefile, num, name, text):
+        """Record a template line that cannot be planned"""
+        self._current = None
+        self.skipped.append({"template": templatefile, "line": num, "command": name, "text": text})
+
+    def planned(self):
+        """Return the physical paths that would be removed, everything under them is removed too"""
+        return set(self._pending)
+
+    @staticmethod
+    def _lstat_tree(path):
+        """Yield the lstat of path and of everything under it, without following symlinks"""
+        st = os.lstat(path)
+        yield st
+        if not S_ISDIR(st.st_mode):
+            return
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                try:
+                    yield os.lstat(os.path.join(root, name))
+                except OSError:
+                    pass
+
+    def add(self, path):
+        """
+        Record that path, and everything under it, would be removed
+
+        :param path: The file or directory to remove
+        :type path: str
+        :returns: True if it was added, False if an earlier path already removes it
+        :rtype: bool
+
+        Each file is only counted once, even when it has several hardlinks.
+        """
+        if not self._pending.add(path):
+            return False
+        files = 0
+        size = 0
+        for st in self._lstat_tree(path):
+            key = (st.st_dev, st.st_ino)
+            if S_ISDIR(st.st_mode) or key in self._inodes:
+                continue
+            self._inodes.add(key)
+            files += 1
+            if S_ISREG(st.st_mode):
+                size += st.st_size
+        if self._current is not None:
+            self._current["files"] += files
+            self._current["bytes"] += size
+        return True
+
+    def _tree_size(self):
+        """Return the size of the files in the root before and after the removals"""
+        planned = set(self._pending)
+        removed_dirs = set()
+        before = {}
+        after = {}
+        for root, dirs, files in os.walk(os.path.realpath(self.root)):
+            removed = root in planned or os.path.dirname(root) in removed_dirs
+            if removed:
+                removed_dirs.add(root)
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if not S_ISREG(st.st_mode):
+                    continue
+                key = (st.st_dev, st.st_ino)
+                before[key] = st.st_size
+                if not removed and path not in planned:
+                    after[key] = st.st_size
+        return (sum(before.values()), sum(after.values()))
+
+    def report(self):
+        """
+        Return the report
+
+        :returns: The removals made by each line, the skipped lines, and the size of the tree
+        :rtype: dict
+        """
+        before, after = self._tree_size()
+        return {"lines": self.records, "skipped": self.skipped,
+                "files": sum(r["files"] for r in self.records),
+                "bytes": sum(r["bytes"] for r in self.records),
+                "size_before": before, "size_after": after}
+
+    def save(self, report=None):
+        """Write the report to path"""
+        if not self.path:
+            return
+        tmpname = self.path + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(report or self.report(), f, indent=2)
+        os.replace(tmpname, self.path)
+
+    def log_summary(self, report=None, top=10):
+        """Log the size of the tree after cleanup and the lines that remove the most"""
+        report = report or self.report()
+        logger.info("cleanup would remove %d files, %d bytes", report["files"], report["bytes"])
+        logger.info("runtime size %d bytes before cleanup, %d bytes after",
+                    report["size_before"], report["size_after"])
+        if report["skipped"]:
+            logger.info("%d template lines were not planned", len(report["skipped"]))
+        logger.info("largest %d cleanup lines:", top)
+        for r in sorted(self.records, key=lambda r: -r["bytes"])[:top]:
+            logger.info("  %12d bytes %6d files %s:%d %.80s", r["bytes"], r["files"],
+                        os.path.basename(r["template"] or ""), r["line"], r["text"])
+
+class InstallExcludes(object):
+    """
+    Package files that a cleanup template removes, so they need not be installed
+
+    The remove, removefrom and removepkg lines of the compiled cleanup
+    template are run against the file lists of the packages in the
+    transaction, before it is run. The paths they would remove are left out
+    of the transaction with rpm's %_netsharedpath, so they are never written.
+    It only uses whole paths: a directory is only excluded when everything
+    in it is removed, and a file or directory is not excluded if any of the
+    other commands, from any of the templates passed as readers, or the
+    protect globs mention it, something under it, or something above it.
+    The same goes for the paths that the packages' scriptlets mention and the
+    prefixes of their file triggers, like /usr/share/mime/packages that
+    shared-mime-info's trigger reads to make mime.cache. Top level
+    directories in them, like /usr, are ignored.
+
+    The file lists do not say which paths are directories or symlinks, a
+    path with something under it is a directory, and a top level path with
+    nothing under it, like /lib, is taken to be a symlink to the same path
+    under /usr when that is a directory.
+
+    When verify is True the excluded paths are created again after the
+    transaction, as empty files and directories, and leftovers() returns the
+    ones still there after the cleanup template has run, these are the
+    differences from a tree that was installed without any excludes.
+    """
+    # The commands whose removals are worked out ahead of time
+    _removals = ("remove", "removefrom", "removepkg")
+    # Commands that only remove files, or only change what is left, they don't read any paths
+    _ignored = ("removekmod", "find", "flush", "log", "wait", "installpkg", "run_pkg_transaction")
+    # Absolute paths in a scriptlet, not ones that start with a shell variable
+    _script_path_re = re.compile(r"(?<![\w$}./-])/[\w.+@-]+(?:/[\w.+@-]+)*")
+
+    def __init__(self, root, commands, readers=None, protect=None, verify=False, max_paths=2000):
+        """
+        :param root: The root the packages are installed into
+        :type root: str
+        :param commands: The commands of the compiled cleanup template
+        :type commands: list of TemplateCommand
+        :param readers: The commands of the other templates run on the root before the cleanup
+        :type readers: list of TemplateCommand
+        :param protect: Globs of the paths that must always be installed
+        :type protect: list of str
+        :param verify: Create the excluded paths again so that leftovers() can check them
+        :type verify: bool
+        :param max_paths: The most paths to pass to rpm, the ones with the most files under them are kept
+        :type max_paths: int
+        """
+        self.root = root
+        self.commands = commands
+        self.readers = readers or []
+        self.protect = protect or []
+        self.verify = verify
+        self.max_paths = max_paths
+        self.paths = []
+        self.excluded = set()
+        self._dirs = set()
+        self._packaged = []
+
+    def _normalize(self, path):
+        """Return an argument as an absolute path inside the root"""
+        if path.startswith(self.root + "/"):
+            path = path[len(self.root):]
+        return os.path.normpath("/" + path.lstrip("/"))
+
+    def _aliases(self, packaged):
+        """Return the top level paths that look like symlinks to the same path under /usr"""
+        return {p: "/usr" + p for p in packaged
+                if p.count("/") == 1 and p not in self._dirs and "/usr" + p in self._dirs}
+
+    def _match(self, pattern, aliases):
+        """Return the packaged paths matching a glob, or the path itself without any magic"""
+        pattern = self._normalize(pattern)
+        top = "/" + pattern.split("/")[1]
+        if top in aliases:
+            pattern = aliases[top] + pattern[len(top):]
+        if not glob.has_magic(pattern):
+            return [pattern]
+        pattern_re = re.compile(glob_re(pattern) + "$")
+        return [p for p in self._packaged if pattern_re.match(p)]
+
+    def _subtree(self, path):
+        start = bisect_left(self._packaged, path)
+        for p in self._packaged[start:]:
+            if p == path or p.startswith(path + "/"):
+                yield p
+            elif p > path + "/":
+                break
+
+    @staticmethod
+    def _strings(args):
+        for a in args:
+            if isinstance(a, str):
+                yield a
+            elif isinstance(a, (list, tuple)):
+                yield from InstallExcludes._strings(a)
+
+    def _removed(self, index, aliases):
+        """Return the packaged paths that the removal commands remove"""
+        removed = set()
+        for c in self.commands:
+            if c.name == "remove":
+                for g in c.args:
+                    for m in self._match(g, aliases):
+                        removed.update(self._subtree(m))
+            elif c.name == "removepkg":
+                removed.update(f for n in index.names(*c.args) for f in index.pkgfiles[n]
+                               if f not in self._dirs)
+            elif c.name == "removefrom":
+                pkg, globs, keepmatches, _cmd = c.args
+                filelist = set(f for n in index.names(pkg) for f in index.pkgfiles[n]
+                               if f not in self._dirs)
+                globs_re = re.compile("|".join("(?:%s)" % fnmatch.translate(g) for g in globs))
+                matches = set(f for f in filelist if globs_re.match(f))
+                removed.update(filelist.difference(matches) if keepmatches else matches)
+        return removed
+
+    @classmethod
+    def script_paths(cls, scripts):
+        """
+        Return the paths mentioned by package scriptlets and file triggers
+
+        :param scripts: The text of the scriptlets and the file trigger prefixes
+        :type scripts: list of str
+        :returns: The absolute paths in them, without the top level directories
+        :rtype: set of str
+        """
+        paths = set()
+        for text in scripts:
+            paths.update(os.path.normpath(p) for p in cls._script_path_re.findall(text))
+        return set(p for p in paths if p.count("/") > 1)
+
+    def _referenced(self, aliases, scripts):
+        """Return the paths that the other commands, the protect globs, and the scriptlets mention"""
+        referenced = set()
+        for c in self.commands + self.readers:
+            if c.name in self._removals or c.name in self._ignored:
+                continue
+            for arg in self._strings(c.args):
+                if arg:
+                    referenced.update(self._match(arg, aliases))
+        for g in self.protect:
+            referenced.update(self._match(g, aliases))
+        for p in self.script_paths(scripts):
+            referenced.update(self._match(glob.escape(p), aliases))
+        return referenced
+
+    def find(self, index, scripts=None):
+        """
+        Work out the paths to leave out of the transaction
+
+        :param index: The file lists of the packages in the transaction
+        :type index: PkgFileIndex
+        :param scripts: The text of the packages' scriptlets and their file trigger prefixes
+        :type scripts: list of str
+        :returns: The paths to pass to rpm, each one excludes everything under it too
+        :rtype: list of str
+        """
+        self._packaged = sorted(index.owners)
+        self._dirs = set(os.path.dirname(p) for p in self._packaged)
+        aliases = self._aliases(self._packaged)
+        removed = self._removed(index, aliases)
+        referenced = self._referenced(aliases, scripts or [])
+        # Everything above a referenced path is needed too
+        needed = set()
+        for r in referenced:
+            while r not in needed and r != "/":
+                needed.add(r)
+                r = os.path.dirname(r)
+
+        # Work up from the deepest paths, a directory is complete when it and
+        # everything under it is removed, and none of it is needed
+        complete = set()
+        children = {}
+        for p in self._packaged:
+            children.setdefault(os.path.dirname(p), []).append(p)
+        for p in sorted(self._packaged, key=lambda p: -p.count("/")):
+            if p in removed and p not in needed and \
+               all(c in complete for c in children.get(p, [])):
+                complete.add(p)
+        # rpm splits the paths on :
+        candidates = [p for p in complete if os.path.dirname(p) not in complete and ":" not in p and
+                      not any(a in referenced for a in self._ancestors(p))]
+
+        sizes = {p: sum(1 for _ in self._subtree(p)) for p in candidates}
+        candidates.sort(key=lambda p: (-sizes[p], p))
+        self.paths = sorted(candidates[:self.max_paths])
+        self.excluded = set(f for p in self.paths for f in self._subtree(p))
+        logger.info("excluding %d paths, with %d files, of the %d files from the packages",
+                    len(self.paths), len(self.excluded), len(self._packaged))
+        return self.paths
+
+    @staticmethod
+    def _ancestors(path):
+        while path != "/":
+            path = os.path.dirname(path)
+            yield path
+
+    def add_placeholders(self):
+        """Create empty files and directories for the excluded paths"""
+        for p in sorted(self.excluded):
+            path = joinpaths(self.root, p)
+            if os.path.lexists(path):
+                continue
+            if p in self._dirs:
+                os.makedirs(path, exist_ok=True)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "w"):
+                    pass
+
+    def leftovers(self):
+        """
+        Return the excluded paths that are still in the root
+
+        :returns: The paths that the cleanup did not remove, these would be in
+                  the tree if they had been installed
+        :rtype: list of str
+        """
+        return sorted(p for p in self.excluded if os.path.lexists(joinpaths(self.root, p)))
+
+class TemplateJournal(object):
+    """
+    A record of the template lines, and other build steps, that have completed
+
+    Set the runner's journal attribute to one of these to append an entry to
+    path after each line completes. When resuming, the entries already in the
+    file are loaded and a template that renders to the same lines as before
+    skips the lines that completed last time, up to the first one that didn't.
+    The lines are hashed with the template name and the runner's roots, so a
+    change to the template text or to its variables runs it from the start.
+
+    The file is kept open until close() is called, each entry is flushed as
+    it is written.
+    """
+    def __init__(self, path, resume=False):
+        """
+        :param path: The file to write the journal to
+        :type path: str
+        :param resume: Load the entries already in path instead of starting a new journal
+        :type resume: bool
+        """
+        self.path = path
+        self._lines = {}
+        self._steps = set()
+        self._runs = Counter()
+        if resume and os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last entry may not have been written completely
+                        continue
+                    if "step" in entry:
+                        self._steps.add(entry["step"])
+                    else:
+                        self._lines.setdefault(entry["run"], set()).add((entry["line"], entry["args"]))
+            logger.info("resuming from %s", path)
+            self._file = open(path, "a")
+        else:
+            self._file = open(path, "w")
+
+    def _append(self, entry):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def close(self):
+        """Close the journal's file"""
+        self._file.close()
+
+    @staticmethod
+    def args_hash(command):
+        """Return a hash of the command and its arguments"""
+        return hashlib.sha256(repr((command.name, command.args)).encode("utf-8")).hexdigest()
+
+    def begin(self, templatefile, commands, *extra):
+        """
+        Start a run of a template
+
+        :param templatefile: The name of the template
+        :type templatefile: str
+        :param commands: The compiled commands of the template
+        :type commands: list of TemplateCommand
+        :param extra: Anything else that changes what the commands do, eg. the roots
+        :returns: The id of this run of the template, and the number of lines at
+                  the start of it that completed when it was last run
+        :rtype: tuple of (str, int)
+        """
+        h = hashlib.sha256()
+        for part in [templatefile or ""] + [str(e) for e in extra] + [str(c) for c in commands]:
+            h.update(part.encode("utf-8") + b"\0")
+        digest = h.hexdigest()
+        # The same template can be run more than once with the same lines
+        self._runs[digest] += 1
+        run = "%s-%d" % (digest, self._runs[digest])
+
+        done = self._lines.get(run, set())
+        completed = 0
+        for c in commands:
+            if (c.num, self.args_hash(c)) not in done:
+                break
+            completed += 1
+        return (run, completed)
+
+    def record(self, run, command):
+        """Record that a line of a template run has completed"""
+        self._append({"run": run, "line": command.num, "args": self.args_hash(command)})
+
+    def step_done(self, step):
+        """Return True if the step was recorded before resuming"""
+        return step in self._steps
+
+    def record_step(self, step):
+        """Record that a build step, outside of the templates, has completed"""
+        self._steps.add(step)
+        self._append({"step": step})
+
 class TemplateRunner(object):
     '''
     This class parses and executes Lorax templates. Sample usage:
@@ -122,6 +1770,11 @@ class TemplateRunner(object):
       runner = LoraxTemplateRunner(inroot=rundir, outroot=rundir, dbo=dnf_obj, basearch="x86_64")
       runner.run("install-packages.ltmpl")
 
+      # parse a template once and run it in a different root
+      compiled = runner.compile("runtime-cleanup.tmpl")
+      runner.run_compiled(compiled)
+      LoraxTemplateRunner(inroot=otherdir, outroot=otherdir).run_compiled(compiled)
+
     NOTES:
 
     * Parsing procedure is roughly:
@@ -130,68 +1783,379 @@ class TemplateRunner(object):
 
         a. Whitespace splitting (using shlex.split())
         b. Brace expansion (using brace_expand())
-        c. If the first token is the name of a function, call that function
-           with the rest of the line as arguments
+        c. Check that the first token is the name of a command, that the
+           rest of the line are valid arguments for it, and parse its options
+        d. Combine it with the previous command if they can be run as one,
+           using the command's _merge_<cmd> method
+
+      3. If any line had an error, report all of them and stop
+      4. Call each command with the rest of the line as arguments
+
+    * A line ending with a '&' argument runs in the background, in a worker
+      thread, and the next line starts right away. The wait command waits
+      for all of the background lines to finish and reports their errors,
+      and the end of the template waits for any that are still running.
+      The lines before the wait must not depend on what a background line
+      changes. Commands that change the state of the runner cannot be run in
+      the background, and a runner may limit which of the others can be.
+      Lorax's runner only runs installimg and runcmd in the background, their
+      changes to its view of the tree are made when they are waited for, and
+      a '&' after any other command is an error.
+
+      The '&' is checked after the line is split, so a literal '&' cannot be
+      passed as the last argument of a command, quoting it does not help.
 
     * Parsing and execution are *separate* passes - so you can't use the result
       of a command in an %if statement (or any other control statements)!
+      This also means that a compiled template run in a different root uses
+      the results of the exists() and glob() builtins from the original root.
     '''
-    def __init__(self, fatalerrors=True, templatedir=None, defaults=None, builtins=None):
+    # Public methods that are not template commands
+    _not_commands = ("run", "compile", "run_compiled")
+    # Commands that only change the state of the runner, they are run again when resuming
+    _replayed_commands = ()
+    # Commands whose state cannot be restored, a template that ran them is not resumed
+    _unresumable_commands = ()
+    # Any command but the ones above can be run in the background
+    _background_any = True
+    # The commands that can be run in the background when _background_any is False
+    _background_commands = ()
+
+    def __init__(self, fatalerrors=True, templatedir=None, defaults=None, builtins=None,
+                 cachedir=None):
         self.fatalerrors = fatalerrors
         self.templatedir = templatedir or "/usr/share/lorax"
+        self.cachedir = cachedir
         self.templatefile = None
         self.builtins = builtins or {}
         self.defaults = defaults or {}
+        self.profile = None
+        self.journal = None
+        self._templates = None
+        self._dispatch = None
+        self._jobs = []
+        self._executor = None
+        self._job_state = threading.local()
 
 
     def run(self, templatefile, **variables):
+        self.run_compiled(self.compile(templatefile, **variables))
+
+    def compile(self, templatefile, **variables):
+        """
+        Parse a template and check its commands without running them
+
+        :param templatefile: The template to parse
+        :type templatefile: str
+        :param variables: Variables to pass to the template, in addition to the defaults
+        :returns: The compiled template
+        :rtype: CompiledTemplate
+        :raises: ValueError if any of the lines have an unknown command or bad arguments
+        """
         for k,v in list(self.defaults.items()) + list(self.builtins.items()):
             variables.setdefault(k,v)
         logger.debug("executing %s with variables=%s", templatefile, variables)
         self.templatefile = templatefile
-        t = LoraxTemplate(directories=[self.templatedir])
-        commands = t.parse(templatefile, variables)
-        self._run(commands)
+        if self._templates is None or self._templates.directories != ["/", self.templatedir] \
+           or self._templates.cachedir != self.cachedir:
+            self._templates = LoraxTemplate(directories=[self.templatedir], cachedir=self.cachedir)
+        return self._compile(self._templates.parse_lines(templatefile, variables))
 
+    def run_compiled(self, compiled):
+        """
+        Run a compiled template
+
+        :param compiled: The template returned by compile()
+        :type compiled: CompiledTemplate
+        """
+        compiled.bind(self)
+        self.templatefile = compiled.templatefile
+        self._run_commands(compiled.commands)
 
     def _run(self, parsed_template):
-        logger.info("running %s", self.templatefile)
-        for (num, line) in enumerate(parsed_template,1):
-            logger.debug("template line %i: %s", num, " ".join(line))
-            skiperror = False
-            (cmd, args) = (line[0], line[1:])
-            # Following Makefile convention, if the command is prefixed with
-            # a dash ('-'), we'll ignore any errors on that line.
-            if cmd.startswith('-'):
-                cmd = cmd[1:]
-                skiperror = True
-            try:
-                # grab the method named in cmd and pass it the given arguments
-                f = getattr(self, cmd, None)
-                if cmd[0] == '_' or cmd == 'run' or not isinstance(f, collections.abc.Callable):
-                    raise ValueError("unknown command %s" % cmd)
-                f(*args)
-            except Exception: # pylint: disable=broad-except
-                if skiperror:
-                    logger.debug("ignoring error")
+        """Compile and run a list of already parsed template lines"""
+        self._run_commands(self._compile((num, None, line) for num, line in enumerate(parsed_template, 1)).commands)
+
+    def _commands(self):
+        """Return a dict of the template commands and their signatures"""
+        if self._dispatch is None:
+            self._dispatch = {}
+            for name in dir(self):
+                if name[0] == '_' or name in self._not_commands:
                     continue
-                logger.error("template command error in %s:", self.templatefile)
+                f = getattr(self, name, None)
+                if isinstance(f, collections.abc.Callable):
+                    self._dispatch[name] = (f, inspect.signature(f))
+        return self._dispatch
+
+    def _compile_line(self, num, line, source=None):
+        """Return a TemplateCommand for a line, raises an error if it is not valid"""
+        skiperror = False
+        (cmd, args) = (line[0], line[1:])
+        # Following Makefile convention, if the command is prefixed with
+        # a dash ('-'), we'll ignore any errors on that line.
+        if cmd.startswith('-'):
+            cmd = cmd[1:]
+            skiperror = True
+        # Like the shell, a trailing '&' runs the command in the background
+        background = bool(args) and args[-1] == "&"
+        if background:
+            args = args[:-1]
+        try:
+            if cmd not in self._commands():
+                raise ValueError("unknown command %s" % cmd)
+            if background and (cmd in ("wait",) + self._replayed_commands + self._unresumable_commands
+                               or not self._background_any and cmd not in self._background_commands):
+                raise ValueError("%s cannot be run in the background" % cmd)
+            f, sig = self._commands()[cmd]
+            try:
+                sig.bind(*args)
+            except TypeError as e:
+                raise ValueError("%s: %s" % (cmd, e)) from None
+
+            parse = getattr(self, "_parse_"+cmd, None)
+            if parse:
+                target = "_do_"+cmd
+                return TemplateCommand(num, line, cmd, target, getattr(self, target),
+                                       parse(*args), skiperror, background, source)
+            return TemplateCommand(num, line, cmd, cmd, f, args, skiperror, background, source)
+        except Exception: # pylint: disable=broad-except
+            if not skiperror:
+                raise
+            logger.debug("ignoring error on %s: %s", _template_location(self.templatefile, num, source),
+                         " ".join(line))
+            return None
+
+    def _merge(self, commands, command):
+        """Combine command with the previous command, if it has a _merge_<cmd> method that allows it"""
+        merge = getattr(self, "_merge_"+command.name, None)
+        if not merge or not commands:
+            return False
+        prev = commands[-1]
+        if prev.name != command.name or prev.skiperror != command.skiperror:
+            return False
+        if prev.background or command.background:
+            return False
+        args = merge(prev.args, command.args)
+        if args is None:
+            return False
+        prev.args = args
+        prev.line = prev.line + [";"] + command.line
+        return True
+
+    def _compile(self, parsed_lines):
+        """Check all the lines and return a CompiledTemplate
+
+        All of the errors are logged before raising the first one
+        """
+        commands = []
+        errors = []
+        for (num, source, line) in parsed_lines:
+            try:
+                c = self._compile_line(num, line, source)
+                if c and not self._merge(commands, c):
+                    commands.append(c)
+            except Exception as e: # pylint: disable=broad-except
+                errors.append(e)
+                logger.error("template error in %s:", _template_location(self.templatefile, num, source))
                 logger.error("  %s", " ".join(line))
-                # format the exception traceback
-                exclines = traceback.format_exception(*sys.exc_info())
-                # skip the bit about "ltmpl.py, in _run()" - we know that
-                exclines.pop(1)
-                # log the "ErrorType: this is what happened" line
-                logger.error("  %s", exclines[-1].strip())
-                # and log the entire traceback to the debug log
-                for _line in ''.join(exclines).splitlines():
-                    logger.debug("  %s", _line)
-                if self.fatalerrors:
-                    raise
+                logger.error("  %s", str(e))
+
+        if errors:
+            logger.error("%s has %d bad lines", self.templatefile, len(errors))
+            if self.fatalerrors:
+                raise errors[0]
+        return CompiledTemplate(self.templatefile, commands, self)
+
+    def _skip_command(self, command):
+        """Called before each command is run, returns True if it should be skipped"""
+
+    def _pre_commands(self, commands):
+        """Called with all of the commands before the first one is run"""
+
+    def _pre_command(self, command):
+        """Called before each command is run"""
+
+    def _post_commands(self):
+        """Called after the last command has run, or when a command failed"""
+
+    def _can_background(self):
+        """Return False if the background commands need to be run in the foreground"""
+        return True
+
+    def _jobs_finished(self):
+        """Called after the background commands have finished, they may have changed anything"""
+
+    def _profile_root(self):
+        """The directory whose filesystem's free space is recorded by the profile"""
+        return None
+
+    def _journal_id(self):
+        """Return what, other than the template lines, changes the result of a template run"""
+        return ()
+
+    def _resume_from(self, completed, commands):
+        """Return the number of commands to skip when resuming a run of a template"""
+        if not completed:
+            return 0
+        for c in commands[:completed]:
+            if c.name in self._unresumable_commands:
+                logger.warning("%s cannot be resumed after %s, running all of it",
+                               self.templatefile, c.name)
+                return 0
+        logger.info("resuming %s after line %d", self.templatefile, commands[completed-1].num)
+        return completed
+
+    def wait(self):
+        '''
+        wait
+          Wait for the commands started in the background, by ending their
+          lines with '&', to finish. If any of them failed the error is
+          reported with the line it came from.
+
+          Example:
+            installimg ${LORAXDIR}/product/ images/product.img &
+            runcmd grub2-mkimage -O i386-pc-eltorito -o ${outroot}/images/eltorito.img \\
+                   iso9660 biosdisk &
+            wait
+        '''
+        self._wait_jobs()
+
+    def _start_job(self, command, run):
+        """Run a command in a worker thread"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(thread_name_prefix="lorax-template")
+        updates = []
+        job = self._executor.submit(self._run_job, command, self.templatefile, updates)
+        logger.debug("started line %d in the background", command.num)
+        self._jobs.append((command, run, self.templatefile, job, updates))
+
+    def _run_job(self, command, templatefile, updates):
+        """Run a background command, its updates of the runner's state are queued on updates"""
+        self._job_state.updates = updates
+        try:
+            if self.profile:
+                with self.profile.measure(templatefile, command.num, command.name, str(command), self._profile_root()):
+                    command.handler(*command.args)
+            else:
+                command.handler(*command.args)
+        finally:
+            self._job_state.updates = None
+
+    def _queue_update(self, func, *args):
+        """
+        Queue a call that updates the runner's state if it is made by a background command
+
+        :returns: True if it was queued, False if it should be called now
+        :rtype: bool
+
+        The queued calls are made by the template's thread when the background
+        commands are waited for.
+        """
+        updates = getattr(self._job_state, "updates", None)
+        if updates is None:
+            return False
+        updates.append((func, args))
+        return True
+
+    def _wait_jobs(self, fatal=True):
+        """Wait for the background commands, and raise the first error if fatal is True"""
+        if not self._jobs:
+            return
+        jobs, self._jobs = self._jobs, []
+        errors = []
+        for command, run, templatefile, job, _updates in jobs:
+            e = job.exception()
+            if e is None:
+                logger.debug("background line %d finished", command.num)
+                if self.journal:
+                    self.journal.record(run, command)
+                continue
+            if command.skiperror:
+                logger.debug("ignoring error on background line %d", command.num)
+                if self.journal:
+                    self.journal.record(run, command)
+                continue
+            exclines = traceback.format_exception(type(e), e, e.__traceback__)
+            logger.error("template command error in %s:", command.location(templatefile))
+            logger.error("  %s", command)
+            logger.error("  %s", exclines[-1].strip())
+            for _line in ''.join(exclines).splitlines():
+                logger.debug("  %s", _line)
+            errors.append("%s: %s" % (command.location(templatefile), exclines[-1].strip()))
+        self._executor.shutdown()
+        self._executor = None
+        # Failed commands may also have changed things
+        for _command, _run, _templatefile, _job, updates in jobs:
+            for func, args in updates:
+                func(*args)
+        self._jobs_finished()
+        if errors and fatal and self.fatalerrors:
+            raise RuntimeError("background command failed in " + "; ".join(errors))
+
+    def _run_commands(self, commands):
+        logger.info("running %s", self.templatefile)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        run, skip = None, 0
+        if self.journal:
+            run, completed = self.journal.begin(self.templatefile, commands, *self._journal_id())
+            skip = self._resume_from(completed, commands)
+        self._pre_commands(commands)
+        try:
+            for i, c in enumerate(commands):
+                if debug:
+                    logger.debug("template line %i: %s", c.num, c)
+                if i < skip and c.name not in self._replayed_commands:
+                    logger.debug("skipping completed line %i", c.num)
+                    continue
+                try:
+                    if self._skip_command(c):
+                        continue
+                    self._pre_command(c)
+                    if c.background and self._can_background():
+                        self._start_job(c, run)
+                        continue
+                    if self.profile:
+                        with self.profile.measure(self.templatefile, c.num, c.name, str(c), self._profile_root()):
+                            c.handler(*c.args)
+                    else:
+                        c.handler(*c.args)
+                    if self.journal:
+                        self.journal.record(run, c)
+                except Exception: # pylint: disable=broad-except
+                    if c.skiperror:
+                        logger.debug("ignoring error")
+                        if self.journal:
+                            self.journal.record(run, c)
+                        continue
+                    logger.error("template command error in %s:", c.location(self.templatefile))
+                    logger.error("  %s", c)
+                    # format the exception traceback
+                    exclines = traceback.format_exception(*sys.exc_info())
+                    # skip the bit about "ltmpl.py, in _run_commands()" - we know that
+                    exclines.pop(1)
+                    # log the "ErrorType: this is what happened" line
+                    logger.error("  %s", exclines[-1].strip())
+                    # and log the entire traceback to the debug log
+                    for _line in ''.join(exclines).splitlines():
+                        logger.debug("  %s", _line)
+                    if self.fatalerrors:
+                        raise
+            # Lines still running in the background are part of the template
+            self._wait_jobs()
+        finally:
+            # Let the background lines finish after a failure, before cleaning up
+            self._wait_jobs(fatal=False)
+            self._post_commands()
+            if self.profile:
+                self.profile.save()
 
 
 class InstallpkgMixin:
     """Helper class used with *Runner classes"""
+    # Specs that can only be package names or globs of them, without a version or arch
+    _pkgname_re = re.compile(r"^[A-Za-z0-9_+*?-]+$")
+
     def _pkgver(self, pkg_spec):
         """
         Helper to parse package version compare operators
@@ -203,7 +2167,7 @@ class InstallpkgMixin:
           "tmux>=3.1.4-5"
           "grub2<2.06"
         """
-        query = dnf5.rpm.PackageQuery(self.dbo)
+        query = self._pkgquery()
 
         # Use default settings - https://dnf5.readthedocs.io/en/latest/api/c%2B%2B/libdnf5_goal_elements.html#goal-structures-and-enums
         settings = dnf5.base.ResolveSpecSettings()
@@ -234,9 +2198,6 @@ class InstallpkgMixin:
 
         query.resolve_pkg_spec(pkg_spec, settings, False)
 
-        # Filter out other arches, list should include basearch and noarch
-        query.filter_arch(self._filter_arches)
-
         # MUST be after the comparison filters. Otherwise it will only return
         # the latest, not the latest of the filtered results.
         query.filter_latest_evr()
@@ -246,6 +2207,81 @@ class InstallpkgMixin:
         query.filter_priority()
         return list(query)
 
+    def _pkgquery(self):
+        """
+        Return a new query of the packages that can be installed
+
+        The arch filtering is only done once, each query is a copy of the first one.
+        """
+        if self._pkgquery_base is None:
+            query = dnf5.rpm.PackageQuery(self.dbo)
+            # Filter out other arches, list should include basearch and noarch
+            query.filter_arch(self._filter_arches)
+            self._pkgquery_base = query
+        return dnf5.rpm.PackageQuery(self._pkgquery_base)
+
+    def _pkgnames(self, names):
+        """
+        Return a dict of package names, or globs of them, and their latest packages
+
+        All of the names are looked up with one query, filtered the same way
+        as the results of _pkgver.
+        """
+        query = self._pkgquery()
+        query.filter_name(names, GLOB)
+        query.filter_latest_evr()
+        query.filter_priority()
+
+        matched = {name: [] for name in names}
+        globs = [(name, re.compile(fnmatch.translate(name))) for name in names if "*" in name or "?" in name]
+        for p in query:
+            name = p.get_name()
+            if name in matched:
+                matched[name].append(p)
+            for glob_name, glob_re in globs:
+                if glob_name != name and glob_re.match(name):
+                    matched[glob_name].append(p)
+        return matched
+
+    def _pkgvers(self, pkg_specs):
+        """
+        Resolve several package specs
+
+        Returns a dict of each spec and its list of package objects, or the
+        exception raised when resolving it. The specs that are package names,
+        or globs of them, are looked up together with _pkgnames, the others,
+        and the names that don't match any packages, are resolved with _pkgver.
+
+        The specs that match packages are cached, so specs used by more than
+        one installpkg are only resolved once. The ones that don't are resolved
+        again by the next call.
+        """
+        results = {}
+        specs = [s for s in dict.fromkeys(pkg_specs) if s not in self._pkgspecs]
+        names = [s for s in specs if self._pkgname_re.match(s)]
+        matched = self._pkgnames(names) if names else {}
+        for pkg_spec in specs:
+            if matched.get(pkg_spec):
+                results[pkg_spec] = matched[pkg_spec]
+            else:
+                try:
+                    results[pkg_spec] = self._pkgver(pkg_spec)
+                except Exception as e: # pylint: disable=broad-except
+                    results[pkg_spec] = e
+            if isinstance(results[pkg_spec], list) and results[pkg_spec]:
+                self._pkgspecs[pkg_spec] = results[pkg_spec]
+        return {pkg_spec: self._pkgspecs.get(pkg_spec, results.get(pkg_spec)) for pkg_spec in pkg_specs}
+
+    def _resolve_installpkgs(self, commands):
+        """Resolve the package specs of all the installpkg commands in a template together"""
+        if self.dbo is None:
+            return
+        specs = [p for c in commands if c.name == "installpkg" for p in c.args[0]
+                 if p and p[0] not in ['=', '<', '>', '!']]
+        if specs:
+            self._pkgvers(specs)
+            logger.debug("resolved %d installpkg specs", len(set(specs)))
+
 
     def installpkg(self, *pkgs):
         '''
@@ -273,6 +2309,12 @@ class InstallpkgMixin:
 
           --required is now the default. If the PKGGLOB can be missing pass --optional
         '''
+        self._do_installpkg(*self._parse_installpkg(*pkgs))
+
+    def _parse_installpkg(self, *pkgs):
+        """Return the package globs, required flag, and excludes from the installpkg args"""
+        if not pkgs:
+            raise ValueError("installpkg needs at least one PKGGLOB")
         if pkgs[0] == '--optional':
             pkgs = pkgs[1:]
             required = False
@@ -292,27 +2334,31 @@ class InstallpkgMixin:
             excludes.append(pkgs[idx+1])
             pkgs = pkgs[:idx] + pkgs[idx+2:]
 
+        return (pkgs, required, excludes)
+
+    def _do_installpkg(self, pkgs, required, excludes):
         errors = False
+        resolved = self._pkgvers([p for p in pkgs if p and p[0] not in ['=', '<', '>', '!']])
+        # Match the package names against all of the excludes at once
+        if excludes:
+            excludes_re = re.compile("|".join(fnmatch.translate(e) for e in excludes))
         for pkg in pkgs:
             # Did a version compare operatore end up in the list?
             if pkg[0] in ['=', '<', '>', '!']:
                 raise RuntimeError("Version compare operators cannot be surrounded by spaces")
 
             try:
-## XXX TODO Update the description here
-                # Start by using Subject to generate a package query, which will
-                # give us a query object similar to what dbo.install would select,
-                # minus the handling for multilib. This query may contain
-                # multiple arches. Pull the package names out of that, filter any
-                # that match the excludes patterns, and pass those names back to
-                # dbo.install to do the actual, arch and version and multilib
-                # aware, package selction.
+                # The specs were resolved by _pkgvers to the latest packages, or
+                # the ones matching the selected version. These may contain
+                # multiple arches. Filter any that match the excludes patterns,
+                # and pass their NEVRAs to the goal to do the actual, arch and
+                # multilib aware, package selection.
 
                 # dnf queries don't have a concept of negative globs which is why
                 # the filtering is done the hard way.
-
-                # Get the latest package, or package matching the selected version
-                pkgobjs = self._pkgver(pkg)
+                pkgobjs = resolved[pkg]
+                if isinstance(pkgobjs, Exception):
+                    raise pkgobjs
                 if not pkgobjs:
                     raise RuntimeError(f"no package matched {pkg}")
 
@@ -327,14 +2373,17 @@ class InstallpkgMixin:
                 pkgobjs = nodupes.values()
 
                 # Apply excludes to the name only
-                for exclude in excludes:
-                    pkgobjs = [p for p in pkgobjs if not fnmatch.fnmatch(p.get_name(), exclude)]
+                if excludes:
+                    pkgobjs = [p for p in pkgobjs if not excludes_re.match(p.get_name())]
 
                 # If the request is a glob or returns more than one package, expand it in the log
                 if len(pkgobjs) > 1 or any(g for g in ['*','?','.'] if g in pkg):
                     logger.info("installpkg: %s expands to %s", pkg, ",".join(p.get_nevra() for p in pkgobjs))
 
                 for p in pkgobjs:
+                    # Packages already added by an earlier installpkg are skipped
+                    if p.get_full_nevra() in self._goal_nevras:
+                        continue
                     try:
                         # Pass them to dnf as NEVRA strings, duplicates are handled differntly
                         # than when they are passed as objects. See:
@@ -343,6 +2392,7 @@ class InstallpkgMixin:
                         # prevent problems if two separate install commands try to add the same
                         # package.
                         self.goal.add_rpm_install(p.get_full_nevra())
+                        self._goal_nevras.add(p.get_full_nevra())
                     except Exception as e: # pylint: disable=broad-except
                         if required:
                             raise
@@ -372,7 +2422,7 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
 
     NOTES:
 
-    * Commands that run external programs (e.g. systemctl) currently use
+    * Commands that run external programs (e.g. runcmd) currently use
       the *host*'s copy of that program, which may cause problems if there's a
       big enough difference between the host and the image you're modifying.
 
@@ -388,19 +2438,103 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
       on that line (after word splitting and brace expansion)
 
     * Commands should raise exceptions for errors - don't use sys.exit()
+
+    TREE INDEX:
+
+    * When treeindex is True the globs used by the commands and by the
+      exists() and glob() builtins are matched against a TreeIndex of the
+      root instead of listing the directories on disk each time. Commands
+      that change the tree update the index, runcmd throws it away.
+      ** matches any number of directories, with or without the index.
+
+    * When checktree is True the index results are compared with the disk
+      and a RuntimeError is raised if they are different.
+
+    SYSTEMCTL:
+
+    * The systemctl command creates and removes the unit symlinks itself,
+      using the [Install] sections of the unit files in the outroot. Set
+      systemctlmode to "subprocess" to run the host's systemctl instead, or
+      to "verify" to check the result with the host's systemctl is-enabled.
+
+    BATCHED REMOVALS:
+
+    * When batchremove is True the files found by consecutive remove,
+      removefrom, removepkg and removekmod commands are queued and removed
+      together, in parallel, before the next command that isn't one of
+      those, or the flush command, or the end of the template.
+
+    JOURNAL:
+
+    * When journal is set to a TemplateJournal each line that completes is
+      recorded in it. When the journal was loaded to resume a build, the
+      lines that completed the last time the template ran with the same
+      lines and roots are skipped, except for the commands that only change
+      the runner's state (installpkg, treeinfo, and installkernel and its
+      friends), which are run again. A template that had already run
+      run_pkg_transaction is run from the start.
+
+    PLANNING:
+
+    * When plan is set to a CleanupPlan the removal commands record what
+      they would remove in it and nothing on disk is changed. The other
+      commands, except for flush and log, are skipped. The tree index is
+      always used while planning so that later lines see the planned tree.
+      Use load_pkglists() to plan against a saved root without a
+      package transaction.
+
+    INSTALL EXCLUDES:
+
+    * When excludes is set to an InstallExcludes run_pkg_transaction leaves
+      the package files that its cleanup template would remove out of the
+      transaction. This needs the rpm python module.
     '''
+    # Public methods that are not template commands
+    _not_commands = TemplateRunner._not_commands + ("load_pkglists", "invalidate")
+    # Commands that queue their removals when batchremove is True
+    _batched_commands = ("remove", "removefrom", "removepkg", "removekmod")
+    # Commands that change the state of the runner, they are run again when resuming
+    _replayed_commands = ("installpkg", "treeinfo", "installkernel", "installinitrd",
+                          "installupgradeinitrd")
+    # The package transaction cannot be restored without running it again
+    _unresumable_commands = ("run_pkg_transaction",)
+    # Commands that are run when planning, the others are skipped. The removal commands
+    # record the paths they would remove instead of removing them.
+    _removal_commands = _batched_commands + ("find",)
+    _planned_commands = _removal_commands + ("flush", "log")
+    # Commands that don't use the indexes, their _changed calls are queued when run in the background.
+    # A '&' after the others is an error.
+    _background_any = False
+    _background_commands = ("installimg", "runcmd")
+
     def __init__(self, inroot, outroot, dbo=None, fatalerrors=True,
-                                        templatedir=None, defaults=None, basearch=None):
+                                        templatedir=None, defaults=None, basearch=None,
+                                        cachedir=None, batchremove=False, treeindex=False,
+                                        checktree=False, systemctlmode="native"):
         self.inroot = inroot
         self.outroot = outroot
         self.dbo = dbo
         self.transaction = None
+        self.batchremove = batchremove
+        self.treeindex = treeindex
+        self.checktree = checktree
+        self.systemctlmode = systemctlmode
+        self.plan = None
+        self.excludes = None
+        self.copystats = None
+        self._pkgquery_base = None
+        self._pkgspecs = {}
+        self._goal_nevras = set()
+        self._pkgindex = None
+        self._kmodindex = None
+        self._trees = {}
+        self._pending = PendingRemovals()
+        self._batching = False
         if dbo:
             self.goal = dnf5.base.Goal(self.dbo)
         else:
             self.goal = None
-        builtins = DataHolder(exists=lambda p: rexists(p, root=inroot),
-                              glob=lambda g: list(rglob(g, root=inroot)))
+        builtins = DataHolder(exists=self._exists_in, glob=self._glob_in)
         self.results = DataHolder(treeinfo=dict()) # just treeinfo for now
 
         # Setup arch filter for package query
@@ -408,7 +2542,8 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         if basearch:
             self._filter_arches.append(basearch)
 
-        super(LoraxTemplateRunner, self).__init__(fatalerrors, templatedir, defaults, builtins)
+        super(LoraxTemplateRunner, self).__init__(fatalerrors, templatedir, defaults, builtins,
+                                                  cachedir)
         # TODO: set up custom logger with a filter to add line info
 
     def _out(self, path):
@@ -416,28 +2551,190 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
     def _in(self, path):
         return joinpaths(self.inroot, path)
 
-    def _filelist(self, *pkg_specs):
-        """ Return the list of files in the packages matching the globs """
+    def compile(self, templatefile, **variables):
+        # The tree may have been changed by something other than a template
+        self._changed()
+        return super(LoraxTemplateRunner, self).compile(templatefile, **variables)
+
+    def run_compiled(self, compiled):
+        self._changed()
+        super(LoraxTemplateRunner, self).run_compiled(compiled)
+
+    def _tree(self, root):
+        """ Return the TreeIndex for root, or None if the tree index is not being used """
+        if not self.treeindex and self.plan is None:
+            return None
+        if root not in self._trees:
+            self._trees[root] = TreeIndex(root, check=self.checktree)
+        return self._trees[root]
+
+    def _rglob(self, root, pattern, fatal=False):
+        """ Return the paths in root matching pattern, with the root prepended """
+        tree = self._tree(root)
+        if tree is None:
+            return list(rglob(joinpaths(root, pattern), fatal=fatal))
+        matches = [joinpaths(root, f) for f in tree.glob(pattern)]
+        if fatal and not matches:
+            raise IOError("nothing matching %s in %s" % (pattern, root))
+        return matches
+
+    def _rexists(self, root, pattern):
+        tree = self._tree(root)
+        if tree is None:
+            return rexists(joinpaths(root, pattern))
+        return tree.exists(pattern)
+
+    def _exists_in(self, pattern):
+        """ The exists() template builtin """
+        tree = self._tree(self.inroot)
+        if tree is None:
+            return rexists(pattern, root=self.inroot)
+        return tree.exists(pattern)
+
+    def _glob_in(self, pattern):
+        """ The glob() template builtin, paths are relative to the inroot """
+        tree = self._tree(self.inroot)
+        if tree is None:
+            return list(rglob(pattern, root=self.inroot))
+        # rglob keeps the leading / of the pattern
+        prefix = "/" if pattern.startswith("/") else ""
+        return [prefix + f for f in tree.glob(pattern)]
+
+    def _pkgfiles(self):
+        """ Return the PkgFileIndex of the packages installed by the transaction """
         # libdnf5's filter_installed query will not work unless the base it reset and reloaded.
         # Instead we use the transaction that was run, and examine the inbound transaction
         # packages from get_transaction_packages()
-        if self.transaction is None:
-            raise RuntimeError("Transaction needs to be run before calling _filelists")
+        if self._pkgindex is None:
+            if self.transaction is None:
+                raise RuntimeError("Transaction needs to be run before using the package file index")
+            pkglist = [tp.get_package() for tp in self.transaction.get_transaction_packages()
+                       if action_is_inbound(tp.get_action())]
+            self._pkgindex = PkgFileIndex(self.outroot, pkglist)
+            logger.debug("indexed %d files from %d packages",
+                         len(self._pkgindex.owners), len(pkglist))
+        return self._pkgindex
+
+    def load_pkglists(self, pkglistdir):
+        """ Use the package file lists written by _writepkglists instead of a transaction """
+        self._pkgindex = PkgFileIndex.from_pkglists(self.outroot, pkglistdir)
+        logger.debug("loaded %d files from %d package lists",
+                     len(self._pkgindex.owners), len(self._pkgindex.packages))
+
+    def invalidate(self):
+        """ Forget what the indexes know about the tree, after it was changed outside of a template """
+        self._changed()
+
+    def _kmods(self):
+        """ Return the ModuleIndex of the kernel modules in the outroot """
+        if self._kmodindex is None:
+            self._kmodindex = ModuleIndex(self.outroot)
+            logger.debug("indexed %d kernel module files", len(self._kmodindex.files))
+        return self._kmodindex
+
+    def _profile_root(self):
+        return self.outroot
+
+    def _journal_id(self):
+        return (self.inroot, self.outroot)
+
+    def _changed(self, path=None):
+        """ Tell the indexes that path, or everything if path is None, changed """
+        if self.profile and path is not None:
+            self.profile.touched()
+        if self._queue_update(self._indexes_changed, path):
+            return
+        self._indexes_changed(path)
+
+    def _indexes_changed(self, path):
+        if self._pkgindex is not None:
+            self._pkgindex.invalidate(path)
+        if self._kmodindex is not None:
+            if path is None or self._kmodindex.related(path):
+                self._kmodindex = None
+        for tree in self._trees.values():
+            tree.changed(path)
+
+    def _removed(self, path):
+        """ Tell the indexes that path has been removed """
+        if self.profile:
+            self.profile.touched()
+        if self._queue_update(self._indexes_removed, path):
+            return
+        self._indexes_removed(path)
+
+    def _indexes_removed(self, path):
+        if self._pkgindex is not None:
+            self._pkgindex.removed(path)
+        if self._kmodindex is not None:
+            self._kmodindex.removed(path)
+        for tree in self._trees.values():
+            tree.removed(path)
+
+    def _remove(self, path):
+        """ Remove a file or directory, or queue it if removals are being batched """
+        if self.plan is not None:
+            if os.path.lexists(path) and self.plan.add(path):
+                self._removed(path)
+        elif self._batching:
+            if os.path.lexists(path) and self._pending.add(path):
+                self._removed(path)
+        elif os.path.lexists(path):
+            # A ** glob can match a directory and the files under it
+            remove(path)
+            self._removed(path)
+
+    def _flush_removals(self):
+        """ Remove all the queued files and directories """
+        if not len(self._pending):
+            return
+        if self.profile:
+            # Removals are batched by the commands before this one
+            with self.profile.measure(self.templatefile, 0, "flush", "(batched removals)", self.outroot):
+                logger.debug("removing %d queued paths", self._pending.flush())
+        else:
+            logger.debug("removing %d queued paths", self._pending.flush())
+
+    def _skip_command(self, command):
+        if self.plan is None:
+            return False
+        if command.name not in self._planned_commands:
+            logger.debug("plan: skipping %s", command)
+            self.plan.skip(self.templatefile, command.num, command.name, str(command))
+            return True
+        if command.name in self._removal_commands:
+            self.plan.start(self.templatefile, command.num, command.name, str(command))
+        return False
+
+    def _pre_commands(self, commands):
+        self._resolve_installpkgs(commands)
+
+    def _pre_command(self, command):
+        if self._batching and command.name in self._batched_commands:
+            return
+        self._flush_removals()
+        self._batching = self.batchremove and command.name in self._batched_commands
 
-        pkglist = []
-        for tp in self.transaction.get_transaction_packages():
-            if not action_is_inbound(tp.get_action()):
-                continue
+    def _post_commands(self):
+        self._batching = False
+        self._flush_removals()
+
+    def _can_background(self):
+        # Planning reads the plan and pending removals while the template's thread is updating them
+        return self.plan is None
 
-            pkg = tp.get_package()
-            if any(fnmatch.fnmatch(pkg.get_name(), spec) for spec in pkg_specs):
-                pkglist.append(pkg)
+    def _filelist(self, *pkg_specs):
+        """ Return the list of files in the packages matching the globs """
+        if self.transaction is None and self._pkgindex is None:
+            raise RuntimeError("Transaction needs to be run before calling _filelists")
 
         # dnf/hawkey doesn't make any distinction between file, dir or ghost like yum did
         # so only return the files.
-        return set(f for pkg in pkglist for f in pkg.get_files() if not os.path.isdir(self._out(f)))
+        return self._pkgfiles().filelist(*pkg_specs)
 
     def _getsize(self, *files):
+        if self._pkgindex is not None:
+            return sum(self._pkgindex.getsize(f) for f in files)
         return sum(os.path.getsize(self._out(f)) for f in files if os.path.isfile(self._out(f)))
 
     def _write_package_log(self):
@@ -447,13 +2744,29 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         If lorax is called with a debug repo find the corresponding debuginfo package
         names and write them to /root/debug-pkgs.log on the boot.iso
         The non-debuginfo packages are written to /root/lorax-packages.log
+
+        The same details are written to /root/lorax-packages.json, a list with
+        the nevra, repo, size (installed size) and debuginfo of each package.
+        debuginfo is the nevra of the available debuginfo package with the same
+        epoch, version and release, or null if there isn't one.
         """
         if self.transaction is None:
             raise RuntimeError("Transaction needs to be run before calling _write_package_log")
 
+        # Look up all of the available debuginfo packages at once
+        debuginfo = {}
+        q = dnf5.rpm.PackageQuery(self.dbo)
+        q.filter_available()
+        q.filter_name(["*-debuginfo"], GLOB)
+        for d in q:
+            evrs = debuginfo.setdefault(d.get_name(), {})
+            # Prefer the same arch as the package, but use any of them
+            evrs.setdefault(d.get_evr(), {})[d.get_arch()] = d.get_nevra()
+
         os.makedirs(self._out("root/"), exist_ok=True)
         pkgs = []
         debug_pkgs = []
+        manifest = []
         for tp in self.transaction.get_transaction_packages():
             if not action_is_inbound(tp.get_action()):
                 continue
@@ -463,16 +2776,23 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
             pkgs.append(p.get_nevra())
 
             # Is a corresponding debuginfo package available?
-            q = dnf5.rpm.PackageQuery(self.dbo)
-            q.filter_available()
-            q.filter_name([f"{p.get_name()}-debuginfo"], EQ)
-            if len(list(q)) > 0:
-                debug_pkgs.append(f"{p.get_name()}-debuginfo-{p.get_evr()}")
+            debug_nevra = None
+            debug_name = f"{p.get_name()}-debuginfo"
+            if debug_name in debuginfo:
+                debug_pkgs.append(f"{debug_name}-{p.get_evr()}")
+                arches = debuginfo[debug_name].get(p.get_evr(), {})
+                debug_nevra = arches.get(p.get_arch()) or next(iter(sorted(arches.values())), None)
+
+            manifest.append({"nevra": p.get_nevra(), "repo": p.get_repo_id(),
+                             "size": p.get_install_size(), "debuginfo": debug_nevra})
 
         with open(self._out("root/lorax-packages.log"), "w") as f:
             f.write("\n".join(sorted(pkgs)))
             f.write("\n")
 
+        with open(self._out("root/lorax-packages.json"), "w") as f:
+            json.dump(sorted(manifest, key=lambda m: m["nevra"]), f, indent=2)
+
         if debug_pkgs:
             with open(self._out("root/debug-pkgs.log"), "w") as f:
                 f.write("\n".join(sorted(debug_pkgs)))
@@ -496,20 +2816,17 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
                 for fname in pkgobj.get_files():
                     fobj.write("{0}\n".format(fname))
 
-    def _writepkgsizes(self, pkgsizefile):
-        """Write a file with the size of the files installed by the package"""
+    def _writepkgsizes(self, pkgsizefile, compression="xz"):
+        """Write a file with the size of the files installed by the package
+
+        A JSON report, with the allocated and estimated compressed size of each
+        package, is written next to it.
+        """
         if self.transaction is None:
             raise RuntimeError("Transaction needs to be run before calling _writepkgsizes")
 
-        with open(pkgsizefile, "w") as fobj:
-            for tp in sorted(self.transaction.get_transaction_packages(),
-                             key=lambda x: x.get_package().get_name()):
-                if not action_is_inbound(tp.get_action()):
-                    continue
-
-                pkgobj = tp.get_package()
-                pkgsize = self._getsize(*pkgobj.get_files())
-                fobj.write(f"{pkgobj.get_name()}.{pkgobj.get_arch()}: {pkgsize}\n")
+        sizes = PackageSizes(self.outroot, self._pkgfiles().packages, compression)
+        sizes.write(pkgsizefile, os.path.splitext(pkgsizefile)[0] + ".json")
 
     def install(self, srcglob, dest):
         '''
@@ -526,15 +2843,15 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
             install usr/share/myconfig/grub.conf /boot
             install /usr/share/myconfig/grub.conf.in /boot/grub.conf
         '''
-        for src in rglob(self._in(srcglob), fatal=True):
+        for src in self._rglob(self.inroot, srcglob, fatal=True):
             try:
-                cpfile(src, self._out(dest))
+                self._changed(cpfile(src, self._out(dest), self.copystats))
             except shutil.Error as e:
                 logger.error(e)
 
     def installimg(self, *args):
         '''
-        installimg [--xz|--gzip|--bzip2|--lzma] [-ARG|--ARG=OPTION] SRCDIR DESTFILE
+        installimg [--xz|--gzip|--bzip2|--lzma|--zstd|--lz4] [-ARG|--ARG=OPTION] SRCDIR DESTFILE
           Create a compressed cpio archive of the contents of SRCDIR and place
           it in DESTFILE.
 
@@ -545,18 +2862,21 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
             installimg ${LORAXDIR}/updates/ images/updates.img
             installimg --xz -6 ${LORAXDIR}/updates/ images/updates.img
             installimg --xz -9 --memlimit-compress=3700MiB ${LORAXDIR}/updates/ images/updates.img
+            installimg --zstd -19 --long ${LORAXDIR}/updates/ images/updates.img
 
           Optionally use a different compression type and override the default args
-          passed to it. The default is xz -9
+          passed to it. The default is xz -9. zstd runs with a thread per cpu.
         '''
-        COMPRESSORS = ("--xz", "--gzip", "--bzip2", "--lzma")
+        self._do_installimg(*self._parse_installimg(*args))
+
+    def _parse_installimg(self, *args):
+        """Return the compression, compression args, source and destination from the installimg args"""
+        COMPRESSORS = ("--xz", "--gzip", "--bzip2", "--lzma", "--zstd", "--lz4")
         if len(args) < 2:
             raise ValueError("Not enough args for installimg.")
 
         srcdir = args[-2]
         destfile = args[-1]
-        if not os.path.isdir(self._in(srcdir)) or not os.listdir(self._in(srcdir)):
-            return
 
         compression = "xz"
         compressargs = []
@@ -569,9 +2889,16 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
             else:
                 raise ValueError("Argument is missing -")
 
+        return (compression, compressargs, srcdir, destfile)
+
+    def _do_installimg(self, compression, compressargs, srcdir, destfile):
+        if not os.path.isdir(self._in(srcdir)) or not os.listdir(self._in(srcdir)):
+            return
+
         logger.info("Creating image file %s from contents of %s", self._out(destfile), self._in(srcdir))
         logger.debug("Using %s %s compression", compression, compressargs or "")
         mkcpio(self._in(srcdir), self._out(destfile), compression=compression, compressargs=compressargs)
+        self._changed(self._out(destfile))
 
     def mkdir(self, *dirs):
         '''
@@ -584,24 +2911,62 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         for d in dirs:
             d = self._out(d)
             if not isdir(d):
+                # Find the top-most directory that will be created
+                top = d
+                while not os.path.exists(os.path.dirname(top)):
+                    top = os.path.dirname(top)
                 os.makedirs(d)
+                self._changed(top)
 
     def replace(self, pat, repl, *fileglobs):
         '''
         replace PATTERN REPLACEMENT FILEGLOB [FILEGLOB ...]
+        replace PATTERN REPLACEMENT [PATTERN REPLACEMENT ...] --files FILEGLOB [FILEGLOB ...]
           Find-and-replace the given PATTERN (Python-style regex) with the given
           REPLACEMENT string for each of the files listed.
+          With --files several PATTERN REPLACEMENT pairs are applied, in order,
+          to each line of the files.
+
+          Consecutive replace commands with the same FILEGLOBs are combined, so
+          each file is only read and written once.
 
           Example:
             replace @VERSION@ ${product.version} /boot/grub.conf /boot/isolinux.cfg
+            replace @VERSION@ ${product.version} @PRODUCT@ '${product.name}' --files /boot/grub.conf
         '''
-        match = False
+        self._do_replace(*self._parse_replace(pat, repl, *fileglobs))
+
+    def _parse_replace(self, *args):
+        if "--files" in args:
+            idx = args.index("--files")
+            pairs, fileglobs = args[:idx], args[idx+1:]
+            if not pairs or len(pairs) % 2:
+                raise ValueError("replace needs PATTERN REPLACEMENT pairs before --files")
+            if not fileglobs:
+                raise ValueError("replace needs at least one FILEGLOB after --files")
+        else:
+            pairs, fileglobs = args[:2], args[2:]
+        substitutions = list(zip(pairs[::2], pairs[1::2]))
+        for pat, _repl in substitutions:
+            try:
+                re.compile(pat)
+            except re.error as e:
+                raise ValueError("replace: bad PATTERN %s: %s" % (pat, e)) from None
+        return (substitutions, list(fileglobs))
+
+    def _merge_replace(self, args, next_args):
+        if args[1] != next_args[1]:
+            return None
+        return (args[0] + next_args[0], args[1])
+
+    def _do_replace(self, substitutions, fileglobs):
+        files = []
         for g in fileglobs:
-            for f in rglob(self._out(g)):
-                match = True
-                replace(f, pat, repl)
-        if not match:
+            files.extend(self._rglob(self.outroot, g))
+        if not files:
             raise IOError("no files matched %s" % " ".join(fileglobs))
+        for f in multi_replace(files, substitutions):
+            self._changed(f)
 
     def append(self, filename, data):
         '''
@@ -617,6 +2982,7 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         '''
         with open(self._out(filename), "a") as fobj:
             fobj.write(bytes(data, "utf8").decode('unicode_escape')+"\n")
+        self._changed(self._out(filename))
 
     def treeinfo(self, section, key, *valuetoks):
         '''
@@ -672,15 +3038,17 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         if isdir(self._out(dest)):
             dest = joinpaths(dest, basename(src))
         os.link(self._out(src), self._out(dest))
+        self._changed(self._out(dest))
 
     def symlink(self, target, dest):
         '''
         symlink SRC DEST
           Create a symlink at DEST which points to SRC.
         '''
-        if rexists(self._out(dest)):
+        if self._rexists(self.outroot, dest):
             self.remove(dest)
         os.symlink(target, self._out(dest))
+        self._changed(self._out(dest))
 
     def copy(self, src, dest):
         '''
@@ -691,7 +3059,7 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
           that name, if the path leading to it exists.
         '''
         try:
-            cpfile(self._out(src), self._out(dest))
+            self._changed(cpfile(self._out(src), self._out(dest), self.copystats))
         except shutil.Error as e:
             logger.error(e)
 
@@ -700,7 +3068,9 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         move SRC DEST
           Move SRC to DEST.
         '''
-        mvfile(self._out(src), self._out(dest))
+        dest = mvfile(self._out(src), self._out(dest))
+        self._removed(self._out(src))
+        self._changed(dest)
 
     def remove(self, *fileglobs):
         '''
@@ -709,16 +3079,25 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
           Will *not* raise exceptions if the file(s) are not found.
         '''
         for g in fileglobs:
-            for f in rglob(self._out(g)):
-                remove(f)
+            for f in self._rglob(self.outroot, g):
+                self._remove(f)
                 logger.debug("removed %s", f)
 
+    def flush(self):
+        '''
+        flush
+          Finish removing the files queued by remove, removefrom, removepkg,
+          and removekmod. This only does something when removals are being
+          batched, and any other command does it first anyway.
+        '''
+        self._flush_removals()
+
     def chmod(self, fileglob, mode):
         '''
         chmod FILEGLOB OCTALMODE
           Change the mode of all the files matching FILEGLOB to OCTALMODE.
         '''
-        for f in rglob(self._out(fileglob), fatal=True):
+        for f in self._rglob(self.outroot, fileglob, fatal=True):
             os.chmod(f, int(mode,8))
 
     def log(self, msg):
@@ -731,7 +3110,77 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         '''
         logger.info(msg)
 
-    # TODO: add ssh-keygen, mkisofs(?), find, and other useful commands
+    def find(self, *args):
+        '''
+        find PATH [PATH...] [TEST...] ACTION [ACTION...] [, PATH [PATH...] [TEST...] ACTION...]
+          Search the outroot and run the actions on the paths that pass all
+          of the tests, like find does. The PATHs are relative to the outroot.
+
+          Several clauses, separated by a ',' argument, can be given. They are
+          all run in one pass over the tree, each path is checked against the
+          clauses in order, and a path deleted by one clause is not seen by
+          the clauses after it. Nothing is deleted until the whole tree has
+          been checked, so -broken does not see the symlinks that the
+          deletions will break. Use a separate find line after the one that
+          deletes their targets.
+
+          Tests, any of them can be negated with a '!' before it:
+            -name GLOB     The name of the path matches GLOB
+            -type f|d|l    The path is a file, directory or symlink
+            -newer SECONDS The path was modified after SECONDS since the epoch
+            -broken        The path is a symlink that doesn't resolve, with
+                           the outroot as /
+
+          Actions:
+            -log           Log the path, and the target of symlinks
+            -setmtime SECONDS
+                           Set the time of the path, without following symlinks
+            -delete        Remove the path. Like find, directories are only
+                           removed when everything in them is removed too.
+
+          With -xdev the clause does not go onto other filesystems.
+
+          Examples:
+            find /boot ! -name "vmlinuz*" ! -name boot -delete , \\
+                 / -name "*.pyc" -type f -delete
+            find /etc /usr -xdev -broken ! -name mtab -log -delete
+        '''
+        self._do_find(*self._parse_find(*args))
+
+    def _parse_find(self, *args):
+        """Return the clauses of the find args"""
+        clauses = [[]]
+        for arg in args:
+            if arg == ",":
+                clauses.append([])
+            else:
+                clauses[-1].append(arg)
+        return [FindClause(c) for c in clauses]
+
+    def _do_find(self, *clauses):
+        # In plan mode the tree still has the paths the earlier lines would remove
+        skip = self.plan.planned() if self.plan is not None else None
+        matches = TreeFind(self.outroot, clauses, skip=skip).run()
+        deleted = 0
+        for clause, relpath, delete in matches:
+            path = joinpaths(self.outroot, relpath)
+            for action, value in clause.actions:
+                if action == "-log":
+                    if os.path.islink(path):
+                        logger.info("find: %s -> %s", "/" + relpath, os.readlink(path))
+                    else:
+                        logger.info("find: %s", "/" + relpath)
+                elif action == "-setmtime":
+                    if self.plan is None:
+                        os.utime(path, (value, value), follow_symlinks=False)
+                elif delete:
+                    self._remove(path)
+                    deleted += 1
+                else:
+                    logger.debug("find: not removing %s, it isn't empty", "/" + relpath)
+        logger.debug("find: %d matches, %d removed", len(matches), deleted)
+
+    # TODO: add ssh-keygen, mkisofs(?), and other useful commands
     def runcmd(self, *cmdlist):
         '''
         runcmd CMD [ARG ...]
@@ -746,11 +3195,8 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
           If the existing commands don't do what you need, fix them!
 
           Examples:
-            (this should be replaced with a "find" function)
+            (use the find command for this instead)
             runcmd find ${root} -name "*.pyo" -type f -delete
-            %for f in find(root, name="*.pyo"):
-            remove ${f}
-            %endfor
         '''
         cmd = cmdlist
         logger.debug('running command: %s', cmd)
@@ -768,6 +3214,9 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
                 logger.error('command output:\n%s', e.output)
             logger.error('command returned failure (%d)', e.returncode)
             raise
+        finally:
+            # There is no way to know what the command changed
+            self._changed()
 
     def removepkg(self, *pkgs):
         '''
@@ -819,10 +3268,16 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
 
         logger.info("Preparing transaction from installation source")
 
+        netshared = []
+        if self.excludes is not None:
+            netshared = self._find_excludes()
+
         display = LoraxRpmCallback()
         self.transaction.set_callbacks(dnf5.rpm.TransactionCallbacksUniquePtr(display))
         with ProcMount(self.outroot):
             try:
+                if netshared:
+                    rpm.addMacro("_netsharedpath", ":".join(netshared))
                 result = self.transaction.run()
                 if result != dnf5.base.Transaction.TransactionRunResult_SUCCESS:
                     err = "\n".join(self.transaction.get_transaction_problems())
@@ -830,11 +3285,50 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
             except Exception as e:
                 logger.error("The transaction process has ended abruptly: %s", e)
                 raise
+            finally:
+                if netshared:
+                    rpm.delMacro("_netsharedpath")
+        if netshared and self.excludes.verify:
+            self.excludes.add_placeholders()
+
+        # Index the installed files, this answers removefrom, removepkg, and the size logs
+        self._pkgindex = None
+        self._changed()
+        self._pkgfiles()
 
         # At this point dnf should know about the installed files. Double check that it really does.
         if len(self._filelist("anaconda-core")) == 0:
             raise RuntimeError("Failed to reset dbo to installed package set")
 
+    def _find_excludes(self):
+        """ Return the paths to leave out of the transaction, using the cleanup template in excludes """
+        if rpm is None:
+            logger.warning("python3-rpm is not installed, installing all of the package files")
+            self.excludes = None
+            return []
+        pkglist = [tp.get_package() for tp in self.transaction.get_transaction_packages()
+                   if action_is_inbound(tp.get_action())]
+        return self.excludes.find(PkgFileIndex(self.outroot, pkglist), self._package_scripts(pkglist))
+
+    def _package_scripts(self, pkglist):
+        """ Return the install scriptlets and file trigger prefixes of the downloaded packages """
+        tags = [rpm.RPMTAG_PRETRANS, rpm.RPMTAG_PREIN, rpm.RPMTAG_POSTIN, rpm.RPMTAG_POSTTRANS,
+                rpm.RPMTAG_TRIGGERSCRIPTS, rpm.RPMTAG_FILETRIGGERSCRIPTS, rpm.RPMTAG_TRANSFILETRIGGERSCRIPTS,
+                rpm.RPMTAG_FILETRIGGERNAME, rpm.RPMTAG_TRANSFILETRIGGERNAME]
+        ts = rpm.TransactionSet()
+        # dnf has already checked the downloaded packages
+        ts.setVSFlags(rpm.RPMVSF_MASK_NOSIGNATURES | rpm.RPMVSF_MASK_NODIGESTS)
+        scripts = []
+        for pkg in pkglist:
+            with open(pkg.get_package_path(), "rb") as f:
+                hdr = ts.hdrFromFdno(f.fileno())
+            for tag in tags:
+                values = hdr[tag]
+                if not isinstance(values, list):
+                    values = [values]
+                scripts.extend(v.decode("utf-8", "replace") if isinstance(v, bytes) else v for v in values if v)
+        return scripts
+
     def removefrom(self, pkg, *globs):
         '''
         removefrom PKGGLOB [--allbut] FILEGLOB [FILEGLOB...]
@@ -847,11 +3341,20 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
             removefrom usbutils /usr/bin/*
             removefrom xfsprogs --allbut /sbin/*
         '''
+        self._do_removefrom(*self._parse_removefrom(pkg, *globs))
+
+    def _parse_removefrom(self, pkg, *globs):
+        """Return the package glob, file globs, --allbut flag, and log string from the removefrom args"""
         cmd = "%s %s" % (pkg, " ".join(globs)) # save for later logging
         keepmatches = False
-        if globs[0] == '--allbut':
+        if globs and globs[0] == '--allbut':
             keepmatches = True
             globs = globs[1:]
+        if not globs:
+            raise ValueError("removefrom needs at least one FILEGLOB")
+        return (pkg, globs, keepmatches, cmd)
+
+    def _do_removefrom(self, pkg, globs, keepmatches, cmd):
         # get pkg filelist and find files that match the globs
         filelist = self._filelist(pkg)
         matches = set()
@@ -879,7 +3382,7 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
     # pylint: disable=anomalous-backslash-in-string
     def removekmod(self, *globs):
         '''
-        removekmod GLOB [GLOB...] [--allbut] KEEPGLOB [KEEPGLOB...]
+        removekmod [--keepdeps] GLOB [GLOB...] [--allbut] KEEPGLOB [KEEPGLOB...]
           Remove all files and directories matching the given file globs from the kernel
           modules directory.
 
@@ -888,13 +3391,25 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
           to search and one KEEPGLOB to keep. The KEEPGLOB is expanded to be *KEEPGLOB*
           so that it will match anywhere in the path.
 
+          If '--keepdeps' is used the modules needed by the modules that are kept,
+          according to the kernel's modules.dep, are not removed either.
+
           This only removes files from under /lib/modules/\\*/kernel/
 
           Examples:
             removekmod sound drivers/media drivers/hwmon drivers/video
             removekmod drivers/char --allbut virtio_console hw_random
+            removekmod --keepdeps drivers/net --allbut virtio_net
         '''
+        self._do_removekmod(*self._parse_removekmod(*globs))
+
+    def _parse_removekmod(self, *globs):
+        """Return the globs, keep globs, keepdeps flag, and log string from the removekmod args"""
         cmd = " ".join(globs)
+        keepdeps = False
+        if globs and globs[0] == "--keepdeps":
+            keepdeps = True
+            globs = globs[1:]
         if "--allbut" in globs:
             idx = globs.index("--allbut")
             if idx == 0:
@@ -909,27 +3424,38 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         else:
             # Nothing to keep
             keepglobs = []
+        if not globs:
+            raise ValueError("removekmod needs at least one GLOB")
 
-        filelist = set()
-        for g in globs:
-            for top_dir in rglob(self._out("/lib/modules/*/kernel/"+g)):
-                for root, _dirs, files in os.walk(top_dir):
-                    filelist.update(root+"/"+f for f in files)
+        return (globs, keepglobs, keepdeps, cmd)
+
+    def _do_removekmod(self, globs, keepglobs, keepdeps, cmd):
+        kmods = self._kmods()
+        filelist = kmods.match(globs)
 
         # Remove anything matching keepglobs from the list
         matches = set()
-        for g in keepglobs:
-            globs_re = re.compile(fnmatch.translate("*"+g+"*"))
-            m = [f for f in filelist if globs_re.match(f)]
-            if m:
-                matches.update(m)
-            else:
-                logger.debug("removekmod %s: no files matched!", g)
+        if keepglobs:
+            keep_re = re.compile("|".join("(?:%s)" % fnmatch.translate("*"+g+"*") for g in keepglobs))
+            matches = set(f for f in filelist if keep_re.match(f))
+            for g in keepglobs:
+                globs_re = re.compile(fnmatch.translate("*"+g+"*"))
+                if not any(globs_re.match(f) for f in matches):
+                    logger.debug("removekmod %s: no files matched!", g)
         remove_files = filelist.difference(matches)
 
+        if keepdeps and remove_files:
+            needed = kmods.needed_by(set(kmods.files).difference(remove_files))
+            if needed & remove_files:
+                logger.debug("removekmod %s: keeping %d modules needed by other modules",
+                             cmd, len(needed & remove_files))
+                remove_files.difference_update(needed)
+
         if remove_files:
-            logger.debug("removekmod: removing %d files", len(remove_files))
-            list(remove(f) for f in remove_files)
+            logger.debug("removekmod %s: removing %d files, %ikb", cmd,
+                         len(remove_files), kmods.getsize(*remove_files)/1024)
+            for f in sorted(remove_files):
+                self._remove(f)
         else:
             logger.debug("removekmod %s: no files to remove!", cmd)
 
@@ -945,11 +3471,13 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         addrsize_data = struct.pack(">iiii", 0, int(addr, 16), 0, os.stat(src).st_size)
         addrsize.write(addrsize_data)
         addrsize.close()
+        self._changed(dest)
 
     def systemctl(self, cmd, *units):
         '''
         systemctl [enable|disable|mask] UNIT [UNIT...]
           Enable, disable, or mask the given systemd units.
+          Units that don't exist are logged and skipped.
 
           Examples:
             systemctl disable lvm2-monitor.service
@@ -960,17 +3488,40 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         if not units:
             logger.debug("systemctl: no units given for %s, ignoring", cmd)
             return
+        if self.systemctlmode == "subprocess":
+            self._run_systemctl(cmd, units)
+        else:
+            unitfiles = UnitFiles(self.outroot)
+            missing = getattr(unitfiles, cmd)(units)
+            if missing:
+                logger.warning("systemctl %s: no unit files for %s", cmd, " ".join(missing))
+            if self.systemctlmode == "verify":
+                self._verify_systemctl(cmd, [u for u in units if u not in missing])
+        self._changed(self._out("/etc/systemd"))
+
+    def _run_systemctl(self, cmd, units):
+        """ Run the host's systemctl on the outroot """
         self.mkdir("/run/systemd/system") # XXX workaround for systemctl bug
         systemctl = ['systemctl', '--root', self.outroot, '--no-reload', cmd]
         # When a unit doesn't exist systemd aborts the command. Run them one at a time.
         # XXX for some reason 'systemctl enable/disable' always returns 1
         for unit in units:
             try:
-                cmd = systemctl + [unit]
-                runcmd(cmd)
+                runcmd(systemctl + [unit])
             except CalledProcessError:
                 pass
 
+    def _verify_systemctl(self, cmd, units):
+        """ Check the state of the units with the host's systemctl """
+        expected = {"enable": ("enabled", "static", "alias", "indirect"),
+                    "disable": ("disabled", "static", "alias", "indirect"),
+                    "mask": ("masked",)}[cmd]
+        for unit in units:
+            state = execWithCapture("systemctl", ["--root", self.outroot, "is-enabled", unit],
+                                    filter_stderr=True).strip()
+            if state not in expected:
+                raise RuntimeError("systemctl %s %s: systemctl says the unit is %s" % (cmd, unit, state))
+
 class LiveTemplateRunner(TemplateRunner, InstallpkgMixin):
     """
     This class parses and executes a limited Lorax template. Sample usage:
@@ -982,10 +3533,17 @@ class LiveTemplateRunner(TemplateRunner, InstallpkgMixin):
       It is meant to be used with the live-install.tmpl which lists the per-arch
       pacages needed to build the live-iso output.
     """
-    def __init__(self, dbo, fatalerrors=True, templatedir=None, defaults=None):
+    def __init__(self, dbo, fatalerrors=True, templatedir=None, defaults=None, cachedir=None):
         self.dbo = dbo
         self.transaction = None
         self.goal = dnf5.base.Goal(self.dbo)
         self.pkgs = []
         self.pkgnames = []
-        super(LiveTemplateRunner, self).__init__(fatalerrors, templatedir, defaults)
+        self._pkgquery_base = None
+        self._pkgspecs = {}
+        self._goal_nevras = set()
+        super(LiveTemplateRunner, self).__init__(fatalerrors, templatedir, defaults,
+                                                 cachedir=cachedir)
+
+    def _pre_commands(self, commands):
+        self._resolve_installpkgs(commands)
@@ -0,0 +1,212 @@
+#
+# pkgsizes.py
+#
+# Copyright (C) 2024 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+logger = logging.getLogger("pylorax.pkgsizes")
+
+import os
+import json
+import lzma
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_ISREG
+
+from pylorax.sysutils import joinpaths
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+# mksquashfs compresses files in blocks of this size
+BLOCK_SIZE = 128 * 1024
+
+def estimated_with(compression):
+    """
+    Return the compression type that the compressed sizes are estimated with
+
+    :param compression: The squashfs compression type
+    :type compression: str
+    :returns: xz, zstd or gzip
+    :rtype: str
+
+    Only xz, gzip and zstd (with Python 3.14) are available in Python, the
+    other types are estimated using gzip.
+    """
+    if compression == "xz" or (compression == "zstd" and zstd is not None):
+        return compression
+    return "gzip"
+
+def get_compressor(compression):
+    """
+    Return a function that compresses a block of data like mksquashfs does
+
+    :param compression: The squashfs compression type
+    :type compression: str
+    :returns: A function that takes bytes and returns the compressed bytes
+    """
+    estimate = estimated_with(compression)
+    if estimate == "xz":
+        return lambda data: lzma.compress(data, preset=6)
+    if estimate == "zstd":
+        return lambda data: zstd.compress(data, 15)
+    if compression != "gzip":
+        logger.warning("no %s compressor, estimating the compressed sizes with gzip", compression)
+    return lambda data: zlib.compress(data, 9)
+
+
+class PackageSizes(object):
+    """
+    The space used by each package's files
+
+    The files are stat'ed in parallel and the results are cached, so each path
+    is only stat'ed once even when it is owned by several packages. For each
+    package it counts:
+
+    * size, the apparent size of the regular files.
+    * disk, the space allocated to them, which is smaller for sparse files.
+    * compressed, an estimate of their size in the compressed runtime image.
+
+    Hardlinks to the same file are only counted once in each package, and once
+    in the totals. Symlinks and directories are not counted.
+
+    The compressed size is estimated by compressing up to BLOCK_SIZE bytes from
+    the start of the largest files, until sample_size bytes of the package have
+    been compressed, and using the compression ratio of the samples for the
+    rest of the package. The report's estimated_with is the compression type
+    that was really used, see estimated_with().
+    """
+    def __init__(self, root, packages, compression="xz", workers=None, sample_size=1024*1024):
+        """
+        :param root: The root directory the packages were installed into
+        :type root: str
+        :param packages: The name, arch, and list of files of each package
+        :type packages: list of tuples
+        :param compression: The squashfs compression type
+        :type compression: str
+        :param workers: The number of threads to use
+        :type workers: int
+        :param sample_size: The number of bytes to compress from each package
+        :type sample_size: int
+        """
+        self.root = root
+        self.packages = packages
+        self.compression = compression
+        self.estimated_with = estimated_with(compression)
+        self.workers = workers or min(16, (os.cpu_count() or 1) * 2)
+        self.sample_size = sample_size
+        self._compress = get_compressor(compression)
+        self._stat = {}
+
+    def _lstat(self, path):
+        try:
+            return os.lstat(joinpaths(self.root, path))
+        except OSError:
+            return None
+
+    def stat_all(self):
+        """Stat all of the files that haven't been stat'ed yet"""
+        paths = list(set(f for _name, _arch, files in self.packages for f in files
+                         if f not in self._stat))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for path, st in zip(paths, executor.map(self._lstat, paths, chunksize=256)):
+                self._stat[path] = st
+
+    def _files(self, files):
+        """Return the path and stat of each regular file, only including one link to each file"""
+        inodes = {}
+        for f in files:
+            st = self._stat.get(f)
+            if st is not None and S_ISREG(st.st_mode):
+                inodes.setdefault((st.st_dev, st.st_ino), (f, st))
+        return inodes
+
+    def _sample(self, path, size):
+        """Return the length of the sample read from the start of a file and its compressed size"""
+        try:
+            with open(joinpaths(self.root, path), "rb") as f:
+                data = f.read(size)
+        except OSError:
+            return (0, 0)
+        if not data:
+            return (0, 0)
+        return (len(data), len(self._compress(data)))
+
+    def _compressed(self, files):
+        """Estimate the compressed size of the files"""
+        sampled = 0
+        compressed = 0
+        unsampled = 0
+        for path, st in sorted(files, key=lambda f: -f[1].st_size):
+            if sampled < self.sample_size:
+                read, size = self._sample(path, min(BLOCK_SIZE, st.st_size))
+                if read:
+                    sampled += read
+                    compressed += size
+                    # Use the ratio of the sample for the rest of the file
+                    unsampled += st.st_size - read
+                    continue
+            unsampled += st.st_size
+        if not sampled:
+            return unsampled
+        return compressed + int(unsampled * compressed / sampled)
+
+    def _package(self, package):
+        name, arch, files = package
+        regular = self._files(files)
+        return {"name": name, "arch": arch, "files": len(regular),
+                "size": sum(st.st_size for _f, st in regular.values()),
+                "disk": sum(st.st_blocks * 512 for _f, st in regular.values()),
+                "compressed": self._compressed(regular.values())}
+
+    def report(self):
+        """
+        Return the sizes of the packages and the totals
+
+        :returns: The packages, sorted by their estimated compressed size, and the totals
+        :rtype: dict
+        """
+        self.stat_all()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            packages = list(executor.map(self._package, self.packages))
+        packages.sort(key=lambda p: (-p["compressed"], p["name"]))
+
+        regular = self._files(self._stat)
+        total = {"files": len(regular),
+                 "size": sum(st.st_size for _f, st in regular.values()),
+                 "disk": sum(st.st_blocks * 512 for _f, st in regular.values())}
+        return {"compression": self.compression, "estimated_with": self.estimated_with,
+                "packages": packages, "total": total}
+
+    def write(self, pkgsizefile, jsonfile=None):
+        """
+        Write the size of each package to a file
+
+        :param pkgsizefile: The file to write 'name.arch: size' lines to, sorted by name
+        :type pkgsizefile: str
+        :param jsonfile: The file to write the full report to
+        :type jsonfile: str
+        """
+        report = self.report()
+        with open(pkgsizefile, "w") as f:
+            for p in sorted(report["packages"], key=lambda p: p["name"]):
+                f.write(f"{p['name']}.{p['arch']}: {p['size']}\n")
+        if jsonfile:
+            with open(jsonfile, "w") as f:
+                json.dump(report, f, indent=2)
@@ -0,0 +1,293 @@
+#
+# systemdutils.py
+#
+# Copyright (C) 2024 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+logger = logging.getLogger("pylorax.systemdutils")
+
+import os
+import re
+
+from pylorax.sysutils import joinpaths
+
+# The system unit search path, in the order that systemctl --root uses to find unit files
+UNIT_PATHS = ["/etc/systemd/system", "/run/systemd/system", "/usr/local/lib/systemd/system",
+              "/usr/lib/systemd/system", "/lib/systemd/system"]
+
+# Where enable, disable, and mask create and remove symlinks
+CONFIG_PATH = "/etc/systemd/system"
+
+INSTALL_KEYS = ("WantedBy", "RequiredBy", "Alias", "Also", "DefaultInstance")
+
+
+def parse_install_section(path):
+    """
+    Return the settings from the [Install] section of a unit file
+
+    :param path: The path to the unit file
+    :type path: str
+    :returns: A dict of the install keys and a list of their values
+    :rtype: dict
+
+    An empty assignment clears the values set by earlier lines, like systemd does.
+    """
+    install = {k: [] for k in INSTALL_KEYS}
+    section = None
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        lines = f.read().replace("\\\n", " ").splitlines()
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        if line.startswith("[") and line.endswith("]"):
+            section = line[1:-1]
+            continue
+        if section != "Install" or "=" not in line:
+            continue
+        key, value = (s.strip() for s in line.split("=", 1))
+        if key not in install:
+            continue
+        if not value:
+            install[key] = []
+        else:
+            install[key].extend(value.split())
+    return install
+
+def split_unit_name(unit):
+    """
+    Split a unit name into its prefix, instance, and suffix
+
+    :param unit: The unit name, eg. getty@tty1.service
+    :type unit: str
+    :returns: (prefix, instance, suffix), instance is None if this is not a template unit
+    :rtype: tuple
+    """
+    name, dot, suffix = unit.rpartition(".")
+    if not dot:
+        name, suffix = unit, ""
+    if "@" not in name:
+        return (name, None, suffix)
+    prefix, instance = name.split("@", 1)
+    return (prefix, instance, suffix)
+
+def expand_specifiers(value, unit):
+    """Expand the %n, %N, %p, %i, %j, and %% specifiers that can be used in [Install]"""
+    prefix, instance, suffix = split_unit_name(unit)
+    specifiers = {"n": unit,
+                  "N": unit[:-len(suffix)-1] if suffix else unit,
+                  "p": prefix,
+                  "i": instance or "",
+                  "j": prefix.rsplit("-", 1)[-1],
+                  "%": "%"}
+    return re.sub(r"%(.)", lambda m: specifiers.get(m.group(1), m.group(0)), value)
+
+
+class UnitFiles(object):
+    """
+    Enable, disable, and mask systemd units in a root without running systemctl
+
+    This follows what systemctl --root does for system units: the [Install]
+    section of the unit file is used to create or remove the symlinks under
+    /etc/systemd/system. Each method handles all of the units it is passed and
+    returns the ones it could not find, instead of stopping at the first one.
+    Links that cannot be created because something else is already there are
+    logged as errors and skipped, like systemctl does without --force.
+    """
+    # Aliases can point to other aliases, but not forever
+    max_aliases = 8
+
+    def __init__(self, root):
+        """
+        :param root: The root directory containing the units
+        :type root: str
+        """
+        self.root = root
+        self.created = []
+        self.removed = []
+
+    def _path(self, path):
+        return joinpaths(self.root, path)
+
+    def _readlink(self, path):
+        """Return the target of a symlink as a path in the root"""
+        target = os.readlink(self._path(path))
+        if not target.startswith("/"):
+            target = joinpaths(os.path.dirname(path), target)
+        return os.path.normpath(target)
+
+    def find_unit(self, unit, depth=0):
+        """
+        Find the unit file for a unit
+
+        :param unit: The name of the unit
+        :type unit: str
+        :returns: (name, path) of the unit file, or None if it doesn't exist
+        :rtype: tuple or None
+        :raises: RuntimeError if the unit is masked
+
+        Aliases are resolved to the unit that they point to, and instances use
+        the template unit file if there isn't a file for the instance.
+        """
+        prefix, instance, suffix = split_unit_name(unit)
+        names = [unit]
+        if instance:
+            names.append("%s@.%s" % (prefix, suffix))
+        for name in names:
+            for d in UNIT_PATHS:
+                path = joinpaths(d, name)
+                if not os.path.islink(self._path(path)):
+                    if os.path.isfile(self._path(path)):
+                        return (name, path)
+                    continue
+                target = self._readlink(path)
+                if target == "/dev/null":
+                    raise RuntimeError("%s is masked" % unit)
+                if os.path.basename(target) != name and depth < self.max_aliases:
+                    # An alias, use the unit it points to
+                    return self.find_unit(os.path.basename(target), depth+1)
+                if os.path.isfile(self._path(target)):
+                    return (name, target)
+        return None
+
+    def _link(self, path, target):
+        """Create a symlink unless something else is already there"""
+        full = self._path(path)
+        if os.path.islink(full) and os.readlink(full) == target:
+            return
+        if os.path.lexists(full):
+            logger.error("systemctl: not linking %s to %s, it already exists", path, target)
+            return
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        os.symlink(target, full)
+        self.created.append(path)
+
+    def enable(self, units):
+        """
+        Create the symlinks listed in the [Install] section of the units
+
+        :param units: The units to enable
+        :type units: list of str
+        :returns: The units that could not be found
+        :rtype: list of str
+
+        Masked units are logged as errors and skipped.
+        """
+        missing = []
+        seen = set()
+        todo = list(units)
+        while todo:
+            unit = todo.pop(0)
+            if unit in seen:
+                continue
+            seen.add(unit)
+            try:
+                found = self.find_unit(unit)
+            except RuntimeError as e:
+                logger.error("systemctl: cannot enable %s: %s", unit, e)
+                continue
+            if found is None:
+                missing.append(unit)
+                continue
+            name, path = found
+            prefix, instance, suffix = split_unit_name(unit)
+            install = parse_install_section(self._path(path))
+            if instance is None:
+                # This may have been an alias
+                unit = name
+            elif instance == "":
+                # Enabling a template enables its default instance
+                if not install["DefaultInstance"]:
+                    logger.warning("systemctl: %s is a template without a DefaultInstance", unit)
+                    continue
+                unit = "%s@%s.%s" % (prefix, install["DefaultInstance"][-1], suffix)
+
+            if not any(install.values()):
+                logger.debug("systemctl: %s has no [Install] section, nothing to enable", unit)
+            for t in install["WantedBy"]:
+                self._link(joinpaths(CONFIG_PATH, expand_specifiers(t, unit) + ".wants", unit), path)
+            for t in install["RequiredBy"]:
+                self._link(joinpaths(CONFIG_PATH, expand_specifiers(t, unit) + ".requires", unit), path)
+            for a in install["Alias"]:
+                self._link(joinpaths(CONFIG_PATH, expand_specifiers(a, unit)), path)
+            todo.extend(expand_specifiers(u, unit) for u in install["Also"])
+        return missing
+
+    def disable(self, units):
+        """
+        Remove the symlinks to the units from /etc/systemd/system
+
+        :param units: The units to disable
+        :type units: list of str
+        :returns: The units that could not be found
+        :rtype: list of str
+
+        Links named after the unit or its aliases, or pointing to its unit file,
+        are removed in a single pass over the directory. Masks are not removed.
+        """
+        missing = []
+        names = set()
+        todo = list(units)
+        while todo:
+            unit = todo.pop(0)
+            if unit in names:
+                continue
+            names.add(unit)
+            try:
+                found = self.find_unit(unit)
+            except RuntimeError:
+                continue
+            if found is None:
+                missing.append(unit)
+                continue
+            name, path = found
+            if split_unit_name(unit)[1] is None:
+                names.add(name)
+            install = parse_install_section(self._path(path))
+            names.update(expand_specifiers(a, unit) for a in install["Alias"])
+            todo.extend(expand_specifiers(u, unit) for u in install["Also"])
+
+        config = self._path(CONFIG_PATH)
+        for dirpath, dirs, files in os.walk(config):
+            for f in files + dirs:
+                full = os.path.join(dirpath, f)
+                if not os.path.islink(full):
+                    continue
+                target = os.readlink(full)
+                if target != "/dev/null" and (f in names or os.path.basename(target) in names):
+                    os.unlink(full)
+                    self.removed.append(joinpaths(CONFIG_PATH, os.path.relpath(full, config)))
+        return missing
+
+    def mask(self, units):
+        """
+        Link the units to /dev/null
+
+        :param units: The units to mask
+        :type units: list of str
+        :returns: The units that could not be found, they are masked anyway
+        :rtype: list of str
+        """
+        missing = []
+        for unit in units:
+            try:
+                if self.find_unit(unit) is None:
+                    missing.append(unit)
+            except RuntimeError:
+                pass
+            self._link(joinpaths(CONFIG_PATH, unit), "/dev/null")
+        return missing
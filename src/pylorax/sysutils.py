@@ -19,21 +19,29 @@
 # Red Hat Author(s):  Martin Gracik <mgracik@redhat.com>
 #
 
-__all__ = ["joinpaths", "touch", "replace", "chown_", "chmod_", "remove",
-           "linktree"]
+__all__ = ["joinpaths", "touch", "replace", "multi_replace", "chown_", "chmod_", "remove",
+           "linktree", "PendingRemovals", "CopyStats", "TreeCopier"]
+
+import logging
+logger = logging.getLogger("pylorax.sysutils")
 
-import sys
 import os
+import errno
 import re
-import fileinput
+import tempfile
 import pwd
 import grp
 import glob
+import fnmatch
 import shutil
 import shlex
+import fcntl
+import threading
+import time
+from stat import S_ISDIR, S_ISREG, S_ISLNK, S_ISFIFO, S_IMODE
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 
-from pylorax.executils import runcmd
 
 def joinpaths(*args, **kwargs):
     path = os.path.sep.join(args)
@@ -50,14 +58,53 @@ def touch(fname):
 
 
 def replace(fname, find, sub):
-    fin = fileinput.input(fname, inplace=1)
-    pattern = re.compile(find)
-
-    for line in fin:
-        line = pattern.sub(sub, line)
-        sys.stdout.write(line)
-
-    fin.close()
+    multi_replace([fname], [(find, sub)])
+
+def _replace_file(fname, patterns):
+    """Apply the compiled patterns to each line of a file, return True if it was changed"""
+    with open(fname, "r") as f:
+        lines = f.readlines()
+    new_lines = lines
+    for pattern, sub in patterns:
+        new_lines = [pattern.sub(sub, line) for line in new_lines]
+    if new_lines == lines:
+        return False
+
+    fd, tmpname = tempfile.mkstemp(prefix="."+os.path.basename(fname)+".", dir=os.path.dirname(fname))
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.writelines(new_lines)
+        shutil.copymode(fname, tmpname)
+        os.replace(tmpname, fname)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+    return True
+
+def multi_replace(fnames, substitutions, workers=None):
+    """
+    Find and replace several patterns in several files
+
+    :param fnames: The files to change
+    :type fnames: list of str
+    :param substitutions: The (regex, replacement) pairs, applied in order to each line
+    :type substitutions: list of tuple
+    :param workers: The maximum number of files to change at the same time
+    :type workers: int
+    :returns: The files that were changed
+    :rtype: list of str
+
+    Each file is read once and written to a temporary file that is renamed
+    over it, files that don't change are not written.
+    """
+    patterns = [(re.compile(find), sub) for find, sub in substitutions]
+    fnames = list(dict.fromkeys(fnames))
+    if len(fnames) < 2:
+        results = [_replace_file(f, patterns) for f in fnames]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda f: _replace_file(f, patterns), fnames))
+    return [f for f, changed in zip(fnames, results) if changed]
 
 
 def chown_(path, user=None, group=None, recursive=False):
@@ -87,10 +134,142 @@ def chmod_(path, mode, recursive=False):
                 chmod_(nested, mode, recursive)
 
 
-def cpfile(src, dst):
-    shutil.copy2(src, dst)
+# Clone the extents of a file, from linux/fs.h
+FICLONE = 0x40049409
+
+class CopyStats(object):
+    """
+    Count the data copied by each method, for logging the copy throughput
+
+    The counts can be updated from several threads.
+    """
+    def __init__(self):
+        self.files = 0
+        self.links = 0
+        self.bytes = {"clone": 0, "copy_file_range": 0, "read/write": 0}
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, method, size):
+        """
+        Count a file
+
+        :param str method: "clone", "copy_file_range", "read/write" or "link"
+        :param int size: The number of bytes copied
+        """
+        with self._lock:
+            if method == "link":
+                self.links += 1
+            else:
+                self.files += 1
+                self.bytes[method] += size
+
+    def log(self, what):
+        """
+        Log the counts and the throughput since the stats were created
+
+        :param str what: Description of what was copied
+        """
+        elapsed = max(time.time() - self.start, 0.001)
+        total = sum(self.bytes.values())
+        logger.info("%s: copied %d files and linked %d in %.1fs, %.1f MiB/s", what,
+                    self.files, self.links, elapsed, total / 1024**2 / elapsed)
+        logger.info("%s: %s", what, ", ".join("%s %.1f MiB" % (m, b / 1024**2) for m, b in self.bytes.items()))
+
+def _copy_data(src_fd, dst_fd, size):
+    """
+    Copy the data of a file, cloning it if the filesystem supports it
+
+    :returns: The method that was used
+    :rtype: str
+
+    Only the data extents are copied, the holes are left as holes.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return "clone"
+    except OSError:
+        pass
+
+    method = "copy_file_range"
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(src_fd, offset, os.SEEK_DATA)
+            end = os.lseek(src_fd, start, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # Nothing but holes after offset
+                break
+            start, end = offset, size
+        while start < end:
+            if method == "copy_file_range":
+                try:
+                    copied = os.copy_file_range(src_fd, dst_fd, end - start, start, start)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    copied = 0
+                if not copied:
+                    # Some filesystems return 0 instead of an error, it doesn't mean EOF
+                    method = "read/write"
+                    continue
+            else:
+                data = os.pread(src_fd, min(end - start, 1024**2), start)
+                if not data:
+                    # The file got shorter, only keep what was copied
+                    size = start
+                    break
+                copied = os.pwrite(dst_fd, data, start)
+            start += copied
+        offset = end
+    os.ftruncate(dst_fd, size)
+    return method
+
+def _copy_xattrs(src, dst, follow_symlinks):
+    """Copy the extended attributes, including ACLs and SELinux labels, like cp -a does"""
+    try:
+        names = os.listxattr(src, follow_symlinks=follow_symlinks)
+    except OSError as e:
+        if e.errno in (errno.ENOTSUP, errno.ENODATA, errno.EINVAL):
+            return
+        raise
+    for name in names:
+        try:
+            value = os.getxattr(src, name, follow_symlinks=follow_symlinks)
+            os.setxattr(dst, name, value, follow_symlinks=follow_symlinks)
+        except OSError as e:
+            # cp -a doesn't report attributes it isn't allowed to set
+            if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.ENODATA, errno.EINVAL, errno.EACCES):
+                raise
+
+def copyfile(src, dst, stats=None, st=None):
+    """
+    Copy the data of a file
+
+    :param str src: The file to copy, symlinks are followed
+    :param str dst: The file to write, it is created or truncated
+    :param stats: The stats to count the copy in
+    :type stats: CopyStats
+    :param st: The stat of src, if it is already known
+
+    The data is cloned when src and dst are on a filesystem with reflinks,
+    otherwise copy_file_range is used to copy it in the kernel, and only if
+    that fails is it read and written.
+    """
+    with open(src, "rb") as fsrc:
+        st = st or os.fstat(fsrc.fileno())
+        with open(dst, "wb") as fdst:
+            method = _copy_data(fsrc.fileno(), fdst.fileno(), st.st_size)
+    if stats is not None:
+        stats.add(method, st.st_size)
+
+def cpfile(src, dst, stats=None):
     if os.path.isdir(dst):
         dst = joinpaths(dst, os.path.basename(src))
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.SameFileError("{!r} and {!r} are the same file".format(src, dst))
+    copyfile(src, dst, stats)
+    shutil.copystat(src, dst)
 
     return dst
 
@@ -106,8 +285,324 @@ def remove(target):
     else:
         os.unlink(target)
 
-def linktree(src, dst):
-    runcmd(["/bin/cp", "-alx", src, dst])
+class PendingRemovals(object):
+    """
+    Files and directories waiting to be removed by flush()
+
+    Paths are de-duplicated and anything inside a directory that is also being
+    removed is left to that directory's removal. Paths that would already be
+    gone if the earlier paths had been removed right away, including ones
+    reached through a symlink that is being removed, are ignored. So flushing
+    leaves the same tree as calling remove() on each path in order.
+
+    The removals are done in parallel, with one job per parent directory.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers or min(16, (os.cpu_count() or 1) * 2)
+        self._physical = {}
+        self._dirs = {}
+
+    def __len__(self):
+        return len(self._physical)
+
+    def __iter__(self):
+        """Iterate over the physical paths waiting to be removed"""
+        return iter(self._physical)
+
+    def _step(self, base, name, depth):
+        """Resolve one path component, following it if it is a symlink
+
+        base is a (physical path, paths passed through) tuple for the parent
+        and a new tuple for the component is returned.
+        """
+        physical = os.path.join(base[0], name)
+        visited = base[1] | {physical}
+        if not os.path.islink(physical):
+            return (physical, visited)
+
+        if depth > 40:
+            raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), physical)
+        target = os.readlink(physical)
+        current = ("/" if os.path.isabs(target) else base[0], visited)
+        for part in target.split("/"):
+            if part in ("", "."):
+                continue
+            elif part == "..":
+                current = (os.path.dirname(current[0]), current[1])
+            else:
+                current = self._step(current, part, depth+1)
+        return current
+
+    def _resolve_dir(self, path):
+        """Return the physical location of a directory and the paths passed through to reach it"""
+        if path not in self._dirs:
+            parent, name = os.path.split(path)
+            if not name:
+                self._dirs[path] = ("/", frozenset())
+            else:
+                self._dirs[path] = self._step(self._resolve_dir(parent), name, 0)
+        return self._dirs[path]
+
+    def add(self, path):
+        """
+        Add a path to be removed
+
+        :param path: The file or directory to remove
+        :type path: str
+        :returns: True if it was added, False if an earlier path already removes it
+        :rtype: bool
+        :raises: OSError if the path does not exist
+        """
+        path = os.path.abspath(path)
+        parent, visited = self._resolve_dir(os.path.dirname(path))
+        physical = os.path.join(parent, os.path.basename(path))
+        if physical in self._physical or not visited.isdisjoint(self._physical):
+            return False
+
+        # Directories (not symlinks to them) are removed with everything under them
+        self._physical[physical] = S_ISDIR(os.lstat(physical).st_mode)
+        return True
+
+    @staticmethod
+    def _remove_entries(parent, entries):
+        """Remove the entries, relative to their parent directory"""
+        dir_fd = os.open(parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for name, isdir in entries:
+                try:
+                    if isdir:
+                        shutil.rmtree(name, dir_fd=dir_fd)
+                    else:
+                        os.unlink(name, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    pass
+        finally:
+            os.close(dir_fd)
+
+    def flush(self):
+        """
+        Remove all of the pending paths
+
+        :returns: The number of paths that were removed
+        :rtype: int
+        """
+        dirs = set(p for p, isdir in self._physical.items() if isdir)
+        groups = {}
+        for path, isdir in self._physical.items():
+            # Skip it if one of its parent directories is being removed
+            parent = os.path.dirname(path)
+            while parent not in dirs and parent != "/":
+                parent = os.path.dirname(parent)
+            if parent in dirs:
+                continue
+            groups.setdefault(os.path.dirname(path), []).append((os.path.basename(path), isdir))
+        self._physical.clear()
+        self._dirs.clear()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            jobs = [executor.submit(self._remove_entries, parent, entries)
+                    for parent, entries in groups.items()]
+            for job in jobs:
+                job.result()
+        return sum(len(entries) for entries in groups.values())
+
+class TreeCopier(object):
+    """
+    Copy directory trees like cp -a
+
+    :param bool preserve: Preserve the ownership, modes, xattrs and hardlinks,
+                          otherwise only the timestamps are kept
+    :param bool follow: Copy what symlinks point to instead of the symlinks
+    :param bool link: Hardlink the files instead of copying them, like cp -al
+    :param bool one_fs: Don't copy the contents of directories on other filesystems
+    :param int workers: The maximum number of files to copy at the same time
+    :param stats: The stats to count the copies in, a new CopyStats if it is None
+    :type stats: CopyStats
+
+    File data is copied with copyfile(), so it is cloned or copied in the
+    kernel when it can be. The directories are created as the tree is
+    walked, and the files in all of them are copied by one pool of threads.
+    Hardlinked files are copied once and linked, and directory timestamps
+    are set after their contents have been copied.
+
+    Like cp -a the copy is merged into an existing tree, existing directories
+    are kept and get the metadata of the source, other existing entries are
+    removed and replaced.
+    """
+    def __init__(self, preserve=True, follow=False, link=False, one_fs=False, workers=None, stats=None):
+        self.preserve = preserve
+        self.follow = follow
+        self.link = link
+        self.one_fs = one_fs
+        self.workers = workers or min(16, (os.cpu_count() or 1) * 2)
+        self.stats = stats or CopyStats()
+        self._inodes = {}
+        self._lock = threading.Lock()
+
+    def copy(self, src, dst):
+        """
+        Copy the contents of src into dst, creating dst if it doesn't exist
+
+        :param str src: The directory to copy
+        :param str dst: The directory to copy it to
+        """
+        st = self._stat(src)
+        os.makedirs(dst, exist_ok=True)
+        dirs = [(src, dst, st)]
+        todo = [(src, dst)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            jobs = []
+            while todo:
+                srcdir, dstdir = todo.pop()
+                for name, est in self._entries(srcdir):
+                    srcpath, dstpath = joinpaths(srcdir, name), joinpaths(dstdir, name)
+                    if not S_ISDIR(est.st_mode):
+                        jobs.append(executor.submit(self._copy, srcpath, dstpath, est))
+                        continue
+                    self._mkdir(dstpath, est)
+                    dirs.append((srcpath, dstpath, est))
+                    if not self.one_fs or est.st_dev == st.st_dev:
+                        todo.append((srcpath, dstpath))
+            for job in jobs:
+                job.result()
+        # Each directory comes after its parent, set the children's metadata first
+        for srcpath, dstpath, est in reversed(dirs):
+            self._metadata(srcpath, dstpath, est)
+
+    def _stat(self, path):
+        return os.stat(path) if self.follow else os.lstat(path)
+
+    def _entries(self, path):
+        with os.scandir(path) as it:
+            return [(e.name, e.stat(follow_symlinks=self.follow)) for e in it]
+
+    @staticmethod
+    def _mkdir(dst, st):
+        try:
+            os.mkdir(dst, S_IMODE(st.st_mode) | 0o700)
+        except FileExistsError:
+            if not os.path.isdir(dst):
+                raise
+
+    def _copy(self, src, dst, st):
+        try:
+            # Replace an existing entry, instead of writing through its other links
+            os.unlink(dst)
+        except FileNotFoundError:
+            pass
+        if self.link:
+            os.link(src, dst, follow_symlinks=False)
+            self.stats.add("link", 0)
+            return
+        elif S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), dst)
+        elif S_ISREG(st.st_mode):
+            if self._hardlink(st, dst):
+                return
+            copyfile(src, dst, self.stats, st)
+        elif S_ISFIFO(st.st_mode):
+            os.mkfifo(dst, S_IMODE(st.st_mode))
+        else:
+            os.mknod(dst, st.st_mode, st.st_rdev)
+        self._metadata(src, dst, st)
+
+    def _hardlink(self, st, dst):
+        """
+        Link dst to an earlier copy of the same file, return True if it was linked
+
+        The first copy is created while holding the lock, so it exists when
+        the other links are made.
+        """
+        if not self.preserve or st.st_nlink < 2:
+            return False
+        with self._lock:
+            first = self._inodes.setdefault((st.st_dev, st.st_ino), dst)
+            if first == dst:
+                open(dst, "wb").close()
+                return False
+            os.link(first, dst)
+        self.stats.add("link", 0)
+        return True
+
+    def _metadata(self, src, dst, st):
+        symlink = S_ISLNK(st.st_mode)
+        if self.preserve:
+            try:
+                os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+            except PermissionError:
+                # cp -a only preserves the ownership when it can
+                pass
+            if not symlink:
+                os.chmod(dst, S_IMODE(st.st_mode))
+            _copy_xattrs(src, dst, not symlink)
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+def tree_manifest(root):
+    """
+    List the entries of a tree, to compare it with another one
+
+    :param str root: The top of the tree
+    :returns: The path of each entry under root mapped to its type and its size,
+              or the target of a symlink. The types are "f" for regular files, "d"
+              for directories, "l" for symlinks and "o" for everything else.
+    :rtype: dict
+    """
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = joinpaths(dirpath, name)
+            st = os.lstat(path)
+            relpath = "/" + os.path.relpath(path, root)
+            if S_ISLNK(st.st_mode):
+                manifest[relpath] = ["l", os.readlink(path)]
+            elif S_ISDIR(st.st_mode):
+                manifest[relpath] = ["d", None]
+            elif S_ISREG(st.st_mode):
+                manifest[relpath] = ["f", st.st_size]
+            else:
+                manifest[relpath] = ["o", None]
+    return manifest
+
+def compare_manifests(manifest, reference, ignore=None):
+    """
+    Compare two tree manifests from tree_manifest()
+
+    :param dict manifest: The manifest to check
+    :param dict reference: The manifest it should match
+    :param ignore: Globs of the paths to leave out of the comparison, with anything under them
+    :type ignore: list of str
+    :returns: The paths that are only in reference, only in manifest, and in both but
+              with a different type, size or symlink target
+    :rtype: tuple of sorted lists
+    """
+    ignore = ignore or []
+    def keep(path):
+        while path != "/":
+            if any(fnmatch.fnmatchcase(path, g) for g in ignore):
+                return False
+            path = os.path.dirname(path)
+        return True
+
+    missing = sorted(p for p in reference if p not in manifest and keep(p))
+    extra = sorted(p for p in manifest if p not in reference and keep(p))
+    changed = sorted(p for p in manifest if p in reference and keep(p)
+                     and list(manifest[p]) != list(reference[p]))
+    return (missing, extra, changed)
+
+def linktree(src, dst, stats=None):
+    """
+    Make a copy of src at dst with hardlinks, like cp -alx
+
+    :param str src: The directory to copy
+    :param str dst: The new directory, or an existing directory to put it in
+    :param stats: The stats to count the links in
+    :type stats: CopyStats
+    """
+    if os.path.isdir(dst):
+        dst = joinpaths(dst, os.path.basename(src.rstrip("/")))
+    copier = TreeCopier(link=True, one_fs=True, stats=stats)
+    copier.copy(src, dst)
+    return copier.stats
 
 def unquote(s):
     return ' '.join(shlex.split(s))
@@ -22,16 +22,17 @@ logger = logging.getLogger("pylorax.treebuilder")
 
 import os, re
 from os.path import basename
-from shutil import copytree, copy2
+from shutil import copy2
 from subprocess import CalledProcessError
 from pathlib import Path
 import itertools
+import json
 import libdnf5 as dnf5
 from libdnf5.common import QueryCmp_EQ as EQ
 
-from pylorax.sysutils import joinpaths, remove
+from pylorax.sysutils import joinpaths, remove, CopyStats, tree_manifest, compare_manifests
 from pylorax.base import DataHolder
-from pylorax.ltmpl import LoraxTemplateRunner
+from pylorax.ltmpl import LoraxTemplateRunner, CleanupPlan, InstallExcludes
 import pylorax.imgutils as imgutils
 from pylorax.imgutils import DracutChroot
 from pylorax.executils import runcmd, runcmd_output, execWithCapture
@@ -43,6 +44,32 @@ templatemap = {
     'aarch64': 'aarch64.tmpl',
 }
 
+# The boot images and initrds are made from a copy of the runtime tree before
+# runtime-cleanup.tmpl runs, dracut and the arch templates need these paths in it.
+# The arch templates can't be compiled before the packages are installed, they
+# need the kernels, so their paths can't be found the way get_excludes() finds
+# the paths of the runtime templates.
+INSTALLROOT_PATHS = [
+    "/boot",                # kernels, and the EFI and grub2 files the arch templates install
+    "/etc",                 # dracut.conf.d, vconsole.conf, locale.conf and the ld.so cache for dracut
+    "/usr/bin",             # binaries dracut puts in the initrd, mk-s390image on s390x
+    "/usr/sbin",            # the same, like dracut's own tools
+    "/usr/lib",             # kernel modules, firmware, dracut modules, systemd units, grub platform files
+    "/usr/lib64",           # the libraries of the binaries in the initrd
+    "/usr/libexec",         # helpers dracut modules install, like plymouth and systemd ones
+    "/usr/share/fonts",     # fonts for plymouth in the initrd
+    "/usr/share/grub",      # unicode.pf2 for the EFI and iso grub
+    "/usr/share/kbd",       # console keymaps and fonts for the initrd
+    "/usr/share/licenses",  # the *-release-common licenses x86.tmpl copies to the iso
+    "/usr/share/lorax",     # the product and updates images made with installimg
+    "/usr/share/pixmaps",   # the Mac EFI bootloader icons used by efi.tmpl
+    "/usr/share/plymouth",  # the plymouth theme in the initrd
+]
+
+# Paths that are different in a tree installed with excludes, by design. The rpm
+# database records the files that were left out as not installed.
+EXCLUDES_VERIFY_IGNORE = ["/usr/lib/sysimage/rpm", "/var/lib/rpm", "/var/lib/dnf"]
+
 def generate_module_info(moddir, outfile=None):
     def module_desc(mod):
         output = runcmd_output(["modinfo", "-F", "description", mod])
@@ -75,7 +102,12 @@ class RuntimeBuilder(object):
                  add_templates=None,
                  add_template_vars=None,
                  skip_branding=False,
-                 root=None):
+                 root=None,
+                 templatecache=None,
+                 profile=None,
+                 journal=None,
+                 installexcludes=None,
+                 treeindex=False):
         self.dbo = dbo
         if dbo:
             root = dbo.get_config().installroot
@@ -85,11 +117,16 @@ class RuntimeBuilder(object):
 
         self._runner = LoraxTemplateRunner(inroot=root, outroot=root,
                                            dbo=dbo, templatedir=templatedir,
-                                           basearch=arch.basearch)
+                                           basearch=arch.basearch,
+                                           cachedir=templatecache, treeindex=treeindex)
+        self._runner.profile = profile
+        self._runner.journal = journal
         self.add_templates = add_templates or []
         self.add_template_vars = add_template_vars or {}
         self._installpkgs = installpkgs or []
         self._excludepkgs = excludepkgs or []
+        self._installexcludes = installexcludes
+        self._excludes = None
 
         # use a copy of product so we can modify it locally
         product = product.copy()
@@ -149,18 +186,46 @@ class RuntimeBuilder(object):
         if len(self._excludepkgs) > 0:
             self._runner.removepkg(*self._excludepkgs)
 
-        self._runner.run("runtime-install.tmpl")
+        install = self._runner.compile("runtime-install.tmpl")
+        if self._installexcludes:
+            self._excludes = self.get_excludes(install)
+            self._runner.excludes = self._excludes
+        try:
+            self._runner.run_compiled(install)
+        finally:
+            self._runner.excludes = None
 
         for tmpl in self.add_templates:
             self._runner.run(tmpl, **self.add_template_vars)
 
+    def get_excludes(self, install):
+        '''Return the InstallExcludes for the lines of runtime-cleanup.tmpl
+
+        :param install: The compiled runtime-install.tmpl
+        :type install: CompiledTemplate
+        :returns: The paths to leave out of the package transaction
+        :rtype: InstallExcludes
+
+        The templates run before the cleanup are compiled now, before the
+        packages are installed, to find the paths they use. The boot images
+        and the initrds are made from a copy of the tree before the cleanup,
+        so the paths they need, INSTALLROOT_PATHS, are always installed.
+        '''
+        readers = install.commands + \
+                  self._runner.compile("runtime-postinstall.tmpl", configdir="tmp/config_files").commands
+        for tmpl in self.add_templates:
+            readers += self._runner.compile(tmpl, **self.add_template_vars).commands
+        cleanup = self._runner.compile("runtime-cleanup.tmpl")
+        return InstallExcludes(self.vars.root, cleanup.commands, readers, protect=INSTALLROOT_PATHS,
+                               verify=self._installexcludes == "verify")
+
     def writepkglists(self, pkglistdir):
         '''debugging data: write out lists of package contents'''
         self._runner._writepkglists(pkglistdir)
 
-    def writepkgsizes(self, pkgsizefile):
+    def writepkgsizes(self, pkgsizefile, compression="xz"):
         '''debugging data: write a big list of pkg sizes'''
-        self._runner._writepkgsizes(pkgsizefile)
+        self._runner._writepkgsizes(pkgsizefile, compression)
 
     def postinstall(self):
         '''Do some post-install setup work with runtime-postinstall.tmpl'''
@@ -170,12 +235,99 @@ class RuntimeBuilder(object):
         fullpath = joinpaths(self.vars.root, configdir_path)
         if os.path.exists(fullpath):
             remove(fullpath)
-        copytree(configdir, fullpath)
-        self._runner.run("runtime-postinstall.tmpl", configdir=configdir_path)
+        stats = CopyStats()
+        imgutils.copytree(configdir, fullpath, stats=stats)
+        self._runner.copystats = stats
+        try:
+            self._runner.run("runtime-postinstall.tmpl", configdir=configdir_path)
+        finally:
+            self._runner.copystats = None
+        stats.log("postinstall")
 
     def cleanup(self):
         '''Remove unneeded packages and files with runtime-cleanup.tmpl'''
-        self._runner.run("runtime-cleanup.tmpl")
+        self._runner.batchremove = True
+        try:
+            self._runner.run("runtime-cleanup.tmpl")
+        finally:
+            self._runner.batchremove = False
+
+    def plan_cleanup(self, pkglistdir=None, reportfile=None):
+        '''Work out what runtime-cleanup.tmpl would remove, without removing anything
+
+        :param pkglistdir: The package file lists written by writepkglists, used
+                           when there is no package transaction, eg. for a saved root
+        :type pkglistdir: str
+        :param reportfile: The file to write the JSON report to
+        :type reportfile: str
+        :returns: The files and bytes removed by each line and the size of the tree
+        :rtype: dict
+        '''
+        if pkglistdir:
+            self._runner.load_pkglists(pkglistdir)
+        plan = CleanupPlan(self.vars.root, reportfile)
+        self._runner.plan = plan
+        try:
+            self._runner.run("runtime-cleanup.tmpl")
+        finally:
+            self._runner.plan = None
+            # The indexes have the planned removals in them
+            self._runner.invalidate()
+        report = plan.report()
+        plan.save(report)
+        plan.log_summary(report)
+        return report
+
+    def verify_excludes(self, reference=None):
+        '''Compare the tree with one installed without excludes
+
+        :param reference: A runtime-manifest.json, or the tree, of a build without excludes,
+                          after runtime-cleanup.tmpl
+        :type reference: str
+        :returns: True if the tree is the same as it would be without the excludes
+        :rtype: bool
+
+        When installexcludes is "verify" the excluded paths are created again,
+        empty, after the transaction, and any of them left after the cleanup are
+        reported. That can't find the differences made by package scriptlets that
+        ran without the excluded files, like caches they generate, so the file
+        lists and sizes are also compared with the reference, when there is one.
+        '''
+        status = True
+        if self._excludes and self._excludes.verify:
+            leftovers = self._excludes.leftovers()
+            for path in leftovers:
+                logger.error("%s was not installed, but runtime-cleanup.tmpl does not remove it", path)
+            if not leftovers:
+                logger.info("runtime-cleanup.tmpl removed all %d excluded paths", len(self._excludes.excluded))
+            status = not leftovers
+
+        if not reference:
+            logger.warning("No reference tree, the changes made by package scriptlets are not checked")
+            return status
+
+        if os.path.isdir(reference):
+            expected = tree_manifest(reference)
+        else:
+            with open(reference) as f:
+                expected = json.load(f)
+        missing, extra, changed = compare_manifests(tree_manifest(self.vars.root), expected,
+                                                    EXCLUDES_VERIFY_IGNORE)
+        for path in missing:
+            logger.error("%s is missing, it is in %s", path, reference)
+        for path in extra:
+            logger.error("%s is not in %s", path, reference)
+        for path in changed:
+            logger.error("%s is different from the one in %s", path, reference)
+        if missing or extra or changed:
+            return False
+        logger.info("The tree matches %s", reference)
+        return status
+
+    def write_manifest(self, manifestfile):
+        '''debugging data: write the files in the tree and their sizes, for verify_excludes()'''
+        with open(manifestfile, "w") as f:
+            json.dump(tree_manifest(self.vars.root), f, indent=1, sort_keys=True)
 
     def verify(self):
         '''Ensure that contents of the installroot can run'''
@@ -242,6 +394,14 @@ class RuntimeBuilder(object):
         # squash the rootfs
         return imgutils.mksquashfs(self.vars.root, outfile, compression, compressargs)
 
+    def create_erofs_runtime(self, outfile="/var/tmp/erofs.img", compression="xz", compressargs=None):
+        """Create a compressed erofs runtime"""
+        compressargs = compressargs or []
+        os.makedirs(os.path.dirname(outfile))
+
+        # erofs is made straight from the root, there is no rootfs.img to copy it into
+        return imgutils.mkerofs(self.vars.root, outfile, compression, compressargs)
+
     def create_ext4_runtime(self, outfile="/var/tmp/squashfs.img", compression="xz", compressargs=None, size=2):
         """Create a squashfs compressed ext4 runtime"""
         # make live rootfs image - must be named "LiveOS/rootfs.img" for dracut
@@ -270,7 +430,8 @@ class TreeBuilder(object):
     '''Builds the arch-specific boot images.
     inroot should be the installtree root (the newly-built runtime dir)'''
     def __init__(self, product, arch, inroot, outroot, runtime, isolabel, domacboot=True, doupgrade=True,
-                 templatedir=None, add_templates=None, add_template_vars=None, workdir=None, extra_boot_args=""):
+                 templatedir=None, add_templates=None, add_template_vars=None, workdir=None, extra_boot_args="",
+                 templatecache=None, profile=None, journal=None):
 
         # NOTE: if you pass an arg named "runtime" to a mako template it'll
         # clobber some mako internal variables - hence "runtime_img".
@@ -282,8 +443,11 @@ class TreeBuilder(object):
                                workdir=workdir, lower=string_lower,
                                extra_boot_args=extra_boot_args)
         self._runner = LoraxTemplateRunner(inroot, outroot, templatedir=templatedir,
-                                           basearch=arch.basearch)
+                                           basearch=arch.basearch,
+                                           cachedir=templatecache)
         self._runner.defaults = self.vars
+        self._runner.profile = profile
+        self._runner.journal = journal
         self.add_templates = add_templates or []
         self.add_template_vars = add_template_vars or {}
         self.templatedir = templatedir
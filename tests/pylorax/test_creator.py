@@ -86,6 +86,10 @@ class CreatorTest(unittest.TestCase):
         opts = DataHolder(dracut_args=["--xz",  "--omit plymouth", "--add livenet dmsquash-live dmsquash-live-ntfs"], dracut_conf=None)
         self.assertEqual(dracut_args(opts), ["--xz",  "--omit", "plymouth", "--add", "livenet dmsquash-live dmsquash-live-ntfs"])
 
+        # erofs runtimes always get the erofs driver
+        opts = DataHolder(dracut_args=None, dracut_conf=None, erofs=True)
+        self.assertEqual(dracut_args(opts), DRACUT_DEFAULT + ["--add-drivers", "erofs"])
+
     def test_make_appliance(self):
         """Test creating the appliance description XML file"""
         lorax_templates = find_templates("./share/")
@@ -153,7 +157,7 @@ class CreatorTest(unittest.TestCase):
                 mkFakeBoot(mount_dir)
                 opts = DataHolder(project="Fedora", releasever="devel", compression="xz", compress_args=[],
                                   release="", variant="", bugurl="", isfinal=False,
-                                  arch="x86_64", squashfs_only=True)
+                                  arch="x86_64", squashfs_only=True, erofs=False)
                 make_runtime(opts, mount_dir, work_dir)
 
                 # Make sure it made an install.img
@@ -169,6 +173,27 @@ class CreatorTest(unittest.TestCase):
                 self.assertTrue("vmlinuz-" in results)
 
 
+    def test_make_runtime_erofs(self):
+        """Test making a runtime erofs image"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            with tempfile.TemporaryDirectory(prefix="lorax.test.root.") as mount_dir:
+                # Make a fake kernel and initrd
+                mkFakeBoot(mount_dir)
+                opts = DataHolder(project="Fedora", releasever="devel", compression="xz", compress_args=[],
+                                  release="", variant="", bugurl="", isfinal=False,
+                                  arch="x86_64", squashfs_only=False, erofs=True)
+                self.assertEqual(make_runtime(opts, mount_dir, work_dir), 0)
+
+                # Make sure it has the erofs superblock magic
+                with open(joinpaths(work_dir, "images/install.img"), "rb") as f:
+                    f.seek(1024)
+                    self.assertEqual(f.read(4), b"\xe2\xe1\xf5\xe0")
+
+                # Make sure the fake kernel is in there
+                cmd = ["dump.erofs", "--ls", "--path=/boot", joinpaths(work_dir, "images/install.img")]
+                results = runcmd_output(cmd)
+                self.assertTrue("vmlinuz-" in results)
+
     @unittest.skipUnless(os.geteuid() == 0 and not os.path.exists("/.in-container"), "requires root privileges, and no containers")
     def test_make_runtime_squashfs_ext4(self):
         """Test making a runtime squashfs+ext4 only image"""
@@ -178,7 +203,7 @@ class CreatorTest(unittest.TestCase):
                 mkFakeBoot(mount_dir)
                 opts = DataHolder(project="Fedora", releasever="devel", compression="xz", compress_args=[],
                                   release="", variant="", bugurl="", isfinal=False,
-                                  arch="x86_64", squashfs_only=False)
+                                  arch="x86_64", squashfs_only=False, erofs=False)
                 make_runtime(opts, mount_dir, work_dir)
 
                 # Make sure it made an install.img
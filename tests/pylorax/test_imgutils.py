@@ -18,17 +18,22 @@ import glob
 import os
 import parted
 from subprocess import CalledProcessError
+import struct
 import tarfile
 import tempfile
 import unittest
+from unittest import mock
+import zlib
 
 from ..lib import get_file_magic
-from pylorax.executils import runcmd
+from pylorax.executils import runcmd, runcmd_output
 from pylorax.imgutils import mkcpio, mktar, mksquashfs, mksparse, mkqcow2, loop_attach, loop_detach
 from pylorax.imgutils import get_loop_name, LoopDev, dm_attach, dm_detach, DMDev, Mount
+from pylorax.imgutils import loop_configure, loop_backing_file, LOOP_INFO64, LOOP_CONFIG
 from pylorax.imgutils import mkdosimg, mkext4img, mkbtrfsimg, mkhfsimg, default_image_name
-from pylorax.imgutils import mount, umount, kpartx_disk_img, PartitionMount, mkfsimage_from_disk
-from pylorax.imgutils import DracutChroot
+from pylorax.imgutils import mount, umount, PartitionMount, mkfsimage_from_disk
+from pylorax.imgutils import read_partitions, fs_type
+from pylorax.imgutils import DracutChroot, estimate_size, data_size
 from pylorax.sysutils import joinpaths
 
 def mkfakerootdir(rootdir):
@@ -49,6 +54,29 @@ def mkfakerootdir(rootdir):
         with open(joinpaths(rootdir, f), "w") as ff:
             ff.write("I AM FAKE FILE %s" % f.upper())
 
+def read_cpio(cpio_file):
+    """Read the entries of an uncompressed newc cpio archive
+
+    :param cpio_file: Path to the archive
+    :type cpio_file: str
+    :returns: (name, ino, nlink, mtime, data) tuples, not including the trailer
+    :rtype: list
+    """
+    with open(cpio_file, "rb") as f:
+        archive = f.read()
+    entries = []
+    offset = 0
+    while True:
+        assert archive[offset:offset+6] == b"070701"
+        fields = [int(archive[offset+6+i*8:offset+14+i*8], 16) for i in range(13)]
+        namesize, size = fields[11], fields[6]
+        name = archive[offset+110:offset+110+namesize-1].decode("utf-8")
+        offset += (110 + namesize + 3) & ~3
+        if name == "TRAILER!!!":
+            return entries
+        entries.append((name, fields[0], fields[4], fields[5], archive[offset:offset+size]))
+        offset += (size + 3) & ~3
+
 def mkfakebootdir(bootdir):
     """Populate a fake /boot directory with a kernel and initrd
 
@@ -91,24 +119,24 @@ def mkfakediskimg(disk_img):
     except parted.PartedException:
         return False
 
-    # Mount the disk's partitions
-    loop_devs = kpartx_disk_img(disk_img)
+    # Attach the disk's partitions
+    loop_devs = [loop_attach(disk_img, offset, size) for _, offset, size in read_partitions(disk_img)]
 
     try:
         # Format the partitions
-        runcmd(["mkfs.ext4", "/dev/mapper/" + loop_devs[0][0]])
-        runcmd(["mkswap", "/dev/mapper/" + loop_devs[1][0]])
-        runcmd(["mkfs.ext4", "/dev/mapper/" + loop_devs[2][0]])
+        runcmd(["mkfs.ext4", loop_devs[0]])
+        runcmd(["mkswap", loop_devs[1]])
+        runcmd(["mkfs.ext4", loop_devs[2]])
 
         # Mount the boot partition and make a fake kernel and initrd
-        boot_mnt = mount("/dev/mapper/" + loop_devs[0][0])
+        boot_mnt = mount(loop_devs[0])
         try:
             mkfakebootdir(boot_mnt)
         finally:
             umount(boot_mnt)
 
         # Mount the / partition and make a fake / filesystem with /etc/passwd
-        root_mnt = mount("/dev/mapper/" + loop_devs[2][0])
+        root_mnt = mount(loop_devs[2])
         try:
             mkfakerootdir(root_mnt)
         finally:
@@ -116,8 +144,9 @@ def mkfakediskimg(disk_img):
     except Exception:
         return False
     finally:
-        # Remove the disk's mounted partitions
-        runcmd(["kpartx", "-d", "-s", disk_img])
+        # Remove the disk's loop devices
+        for dev in loop_devs:
+            loop_detach(dev)
 
     return True
 
@@ -133,6 +162,54 @@ class ImgUtilsTest(unittest.TestCase):
                 file_details = get_file_magic(disk_img.name)
                 self.assertTrue("cpio" in file_details, file_details)
 
+    def test_mkcpio_reproducible(self):
+        """Test mkcpio sorting, hardlinks, and mtime clamping"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            root_dir = joinpaths(work_dir, "root")
+            mkfakerootdir(root_dir)
+            os.link(joinpaths(root_dir, "/etc/passwd"), joinpaths(root_dir, "/root/passwd"))
+            os.link(joinpaths(root_dir, "/etc/passwd"), joinpaths(root_dir, "/etc/group"))
+            os.symlink("../etc/passwd", joinpaths(root_dir, "/usr/passwd"))
+
+            mkcpio(root_dir, joinpaths(work_dir, "first.img"), compression=None, epoch=1000)
+            os.utime(joinpaths(root_dir, "/root/.bashrc"), (2000, 2000))
+            mkcpio(root_dir, joinpaths(work_dir, "second.img"), compression=None, epoch=1000)
+            with open(joinpaths(work_dir, "first.img"), "rb") as first:
+                with open(joinpaths(work_dir, "second.img"), "rb") as second:
+                    self.assertEqual(first.read(), second.read())
+
+            entries = read_cpio(joinpaths(work_dir, "first.img"))
+            self.assertEqual([e[0] for e in entries],
+                             [".", "etc", "etc/group", "etc/passwd", "home", "home/bart", "home/bart/.bashrc",
+                              "root", "root/.bashrc", "root/passwd", "usr", "usr/local", "usr/passwd", "usr/sbin"])
+            self.assertTrue(all(e[3] == 1000 for e in entries))
+            self.assertEqual(entries[0][1], 1)
+
+            # Only the last link carries the data
+            links = [e for e in entries if e[0] in ("etc/group", "etc/passwd", "root/passwd")]
+            self.assertEqual(len(set(e[1] for e in links)), 1)
+            self.assertEqual([e[2] for e in links], [3, 3, 3])
+            self.assertEqual([e[4] for e in links], [b"", b"", b"I AM FAKE FILE /ETC/PASSWD"])
+            self.assertEqual(entries[12][4], b"../etc/passwd")
+
+    def test_mkcpio_single_file(self):
+        """Test mkcpio of a single file with compression"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            mkfakerootdir(work_dir)
+            self.assertEqual(mkcpio(joinpaths(work_dir, "/etc/passwd"), joinpaths(work_dir, "passwd.img")), 0)
+            file_details = get_file_magic(joinpaths(work_dir, "passwd.img"))
+            self.assertTrue("XZ compressed data" in file_details, file_details)
+
+    def test_mkcpio_error(self):
+        """Test that mkcpio cleans up when the archive can't be written"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            mkfakerootdir(work_dir)
+            outfile = joinpaths(work_dir, "initrd.img")
+            for exc in [ValueError("too large"), RuntimeError("changed size"), OSError("read error")]:
+                with mock.patch("pylorax.imgutils.CpioWriter.add", side_effect=exc):
+                    self.assertEqual(mkcpio(joinpaths(work_dir, "/etc"), outfile), 1)
+                self.assertFalse(os.path.exists(outfile))
+
     def test_mktar(self):
         """Test mktar function"""
         with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
@@ -152,7 +229,9 @@ class ImgUtilsTest(unittest.TestCase):
                 for (compression, magic) in [("xz", "XZ compressed"),
                                              ("lzma", "LZMA compressed"),
                                              ("gzip", "gzip compressed"),
-                                             ("bzip2", "bzip2 compressed")]:
+                                             ("bzip2", "bzip2 compressed"),
+                                             ("zstd", "Zstandard compressed"),
+                                             ("lz4", "LZ4 compressed")]:
                     os.unlink(disk_img.name)
                     mktar(work_dir, disk_img.name, compression=compression)
 
@@ -209,6 +288,39 @@ class ImgUtilsTest(unittest.TestCase):
             finally:
                 loop_detach(loop_dev)
 
+    def test_loop_structs(self):
+        """Test the loop ioctl structure sizes match linux/loop.h"""
+        self.assertEqual(struct.calcsize(LOOP_INFO64), 232)
+        self.assertEqual(struct.calcsize(LOOP_CONFIG), 304)
+
+    @unittest.skipUnless(os.geteuid() == 0 and not os.path.exists("/.in-container"), "requires root privileges, and no containers")
+    def test_loop_configure(self):
+        """Test attaching a loop device with ioctls (requires loop support)"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+            mksparse(disk_img.name, 42 * 1024**2)
+            loop_dev = loop_configure(disk_img.name)
+            try:
+                self.assertEqual(loop_backing_file(loop_dev), os.path.realpath(disk_img.name))
+                self.assertEqual(loop_dev[5:], get_loop_name(disk_img.name))
+                with open("/sys/block/%s/ro" % loop_dev[5:]) as f:
+                    self.assertEqual(f.read().strip(), "0")
+            finally:
+                self.assertTrue(loop_detach(loop_dev))
+            self.assertEqual(loop_backing_file(loop_dev), None)
+
+    @unittest.skipUnless(os.geteuid() == 0 and not os.path.exists("/.in-container"), "requires root privileges, and no containers")
+    def test_loop_configure_backing_file(self):
+        """Test that loop_configure detaches the device if its backing file is wrong (requires loop support)"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+            mksparse(disk_img.name, 42 * 1024**2)
+            with mock.patch("pylorax.imgutils.loop_backing_file", return_value="/other/file"), \
+                 mock.patch("pylorax.imgutils.loop_detach") as detach:
+                with self.assertRaises(OSError):
+                    loop_configure(disk_img.name)
+            self.assertEqual(detach.call_count, 1)
+            loop_dev = detach.call_args[0][0]
+            self.assertTrue(loop_detach(loop_dev))
+
     @unittest.skipUnless(os.geteuid() == 0 and not os.path.exists("/.in-container"), "requires root privileges, and no containers")
     def test_loop_context(self):
         """Test the LoopDev context manager (requires loop)"""
@@ -291,9 +403,32 @@ class ImgUtilsTest(unittest.TestCase):
                 except CalledProcessError as e:
                     self.assertTrue(e.stdout and "No space left on device" in e.stdout)
 
-    @unittest.skipUnless(os.geteuid() == 0 and not os.path.exists("/.in-container"), "requires root privileges, and no containers")
+    def test_mkext4img_rootdir(self):
+        """Test mkext4img populating the image without mounting it"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+                mkfakerootdir(work_dir)
+                os.link(joinpaths(work_dir, "/etc/passwd"), joinpaths(work_dir, "/etc/passwd-"))
+                mkext4img(work_dir, disk_img.name, label="test")
+                file_details = get_file_magic(disk_img.name)
+                self.assertTrue("ext2 filesystem" in file_details, file_details)
+                self.assertTrue('volume name "test"' in file_details, file_details)
+
+                passwd = runcmd_output(["debugfs", "-R", "cat /etc/passwd", disk_img.name])
+                self.assertTrue("I AM FAKE FILE /ETC/PASSWD" in passwd, passwd)
+                stat = runcmd_output(["debugfs", "-R", "stat /etc/passwd-", disk_img.name])
+                self.assertTrue("Links: 2" in stat, stat)
+
+                # Too small for the large file, it is tried again by mounting the image
+                with open(joinpaths(work_dir, "large-file"), "w") as f:
+                    for _ in range(5):
+                        f.write("A" * 1024**2)
+                with mock.patch("pylorax.imgutils.LoopDev", side_effect=RuntimeError("mounted")):
+                    with self.assertRaisesRegex(RuntimeError, "mounted"):
+                        mkext4img(work_dir, disk_img.name, size=4*1024**2)
+
     def test_mkbtrfsimg(self):
-        """Test mkbtrfsimg function (requires loop)"""
+        """Test mkbtrfsimg function"""
         with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
             with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
                 mkfakerootdir(work_dir)
@@ -313,12 +448,165 @@ class ImgUtilsTest(unittest.TestCase):
                 file_details = get_file_magic(disk_img.name)
                 self.assertTrue(any(s in file_details for s in ("Macintosh HFS", "Apple HFS")), file_details)
 
+    def test_estimate_size_hardlinks(self):
+        """Test that estimate_size counts hardlinked files once"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            with open(joinpaths(work_dir, "data"), "wb") as f:
+                f.write(b"\x01" * 4 * 1024**2)
+            single = estimate_size(work_dir, fstype="ext4")
+            for i in range(4):
+                os.link(joinpaths(work_dir, "data"), joinpaths(work_dir, "link-%d" % i))
+            self.assertEqual(estimate_size(work_dir, fstype="ext4"), single)
+
+            # Hardlinks are copied as separate files on vfat
+            self.assertGreater(estimate_size(work_dir, fstype="vfat"), 5 * 4 * 1024**2)
+
+    def test_estimate_size_sparse(self):
+        """Test that estimate_size only counts the data in sparse files"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            with open(joinpaths(work_dir, "sparse"), "wb") as f:
+                f.truncate(1024**3)
+                f.seek(512 * 1024**2)
+                f.write(b"\x01" * 4096)
+            if os.stat(joinpaths(work_dir, "sparse")).st_blocks * 512 >= 1024**2:
+                self.skipTest("the temporary directory doesn't support sparse files")
+            self.assertLess(data_size(joinpaths(work_dir, "sparse"), 1024**3), 1024**2)
+            self.assertLess(estimate_size(work_dir, fstype="ext4"), 64 * 1024**2)
+
+            # hfsplus doesn't support sparse files
+            self.assertGreater(estimate_size(work_dir, fstype="hfsplus"), 1024**3)
+
+    def test_estimate_size_inodes(self):
+        """Test that estimate_size leaves room for enough ext4 inodes"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            for i in range(10):
+                os.makedirs(joinpaths(work_dir, "dir-%d" % i))
+                for j in range(1000):
+                    open(joinpaths(work_dir, "dir-%d/file-%d" % (i, j)), "w").close()
+            # mkfs.ext4 makes an inode for every 4KiB on small filesystems
+            self.assertGreaterEqual(estimate_size(work_dir, fstype="ext4"), 10010 * 4096)
+
     def test_default_image_name(self):
         """Test default_image_name function"""
-        for compression, suffix in [("xz", ".xz"), ("gzip", ".gz"), ("bzip2", ".bz2"), ("lzma", ".lzma")]:
+        for compression, suffix in [("xz", ".xz"), ("gzip", ".gz"), ("bzip2", ".bz2"), ("lzma", ".lzma"),
+                                    ("zstd", ".zst"), ("lz4", ".lz4")]:
             filename = default_image_name(compression, "foobar")
             self.assertTrue(filename.endswith(suffix))
 
+    @staticmethod
+    def _write_gpt(f, entries, protective=True):
+        """Write a GPT with valid CRCs, and optionally its protective MBR"""
+        if protective:
+            f.seek(0x1BE)
+            f.write(struct.pack("<B3sB3sII", 0, b"", 0xEE, b"", 1, 16383))
+            f.seek(510)
+            f.write(b"\x55\xaa")
+        table = bytearray(128 * 128)
+        for i, first, last in entries:
+            struct.pack_into("<16s16sQQQ", table, i * 128, b"\xaf\x3d\xc6\x0f" * 4, b"", first, last, 0)
+        header = bytearray(struct.pack("<8sIIIIQQQQ16sQIII", b"EFI PART", 0x10000, 92, 0, 0,
+                                       1, 16383, 34, 16350, b"", 2, 128, 128, zlib.crc32(table)))
+        struct.pack_into("<I", header, 16, zlib.crc32(header))
+        f.seek(512)
+        f.write(header)
+        f.seek(1024)
+        f.write(table)
+
+    def test_read_partitions_gpt(self):
+        """Test reading a GPT partition table"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+            mksparse(disk_img.name, 8 * 1024**2)
+            with open(disk_img.name, "r+b") as f:
+                # The 2nd entry is unused
+                self._write_gpt(f, [(0, 2048, 4095), (2, 4096, 16349)])
+            self.assertEqual(read_partitions(disk_img.name),
+                             [(1, 1024**2, 1024**2), (3, 2 * 1024**2, 12254 * 512)])
+
+    def test_read_partitions_gpt_bad_crc(self):
+        """Test that a GPT with a corrupt entry array is not used"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+            mksparse(disk_img.name, 8 * 1024**2)
+            with open(disk_img.name, "r+b") as f:
+                self._write_gpt(f, [(0, 2048, 4095)])
+                f.seek(1024 + 32)
+                f.write(struct.pack("<Q", 4096))
+            self.assertEqual(read_partitions(disk_img.name), [])
+
+    def test_read_partitions_stale_gpt(self):
+        """Test that a leftover GPT header is ignored without a protective MBR"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+            mksparse(disk_img.name, 8 * 1024**2)
+            with open(disk_img.name, "r+b") as f:
+                self._write_gpt(f, [(0, 2048, 4095)], protective=False)
+                f.seek(0x1BE)
+                f.write(struct.pack("<B3sB3sII", 0, b"", 0x83, b"", 4096, 4096))
+                f.seek(510)
+                f.write(b"\x55\xaa")
+            self.assertEqual(read_partitions(disk_img.name), [(1, 2 * 1024**2, 2 * 1024**2)])
+
+    def test_read_partitions_mbr(self):
+        """Test reading an MBR partition table with logical partitions"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+            mksparse(disk_img.name, 8 * 1024**2)
+            with open(disk_img.name, "r+b") as f:
+                # Records at sector 0, and the extended boot records at 4096 and 10240
+                for sector, entries in [(0, [(0x83, 2048, 2048), (0x05, 4096, 12288)]),
+                                        (4096, [(0x83, 2048, 2048), (0x05, 6144, 6144)]),
+                                        (10240, [(0x82, 2048, 2048)])]:
+                    for i, (ptype, first, sectors) in enumerate(entries):
+                        f.seek(sector * 512 + 0x1BE + i * 16)
+                        f.write(struct.pack("<B3sB3sII", 0, b"", ptype, b"", first, sectors))
+                    f.seek(sector * 512 + 510)
+                    f.write(b"\x55\xaa")
+            self.assertEqual(read_partitions(disk_img.name),
+                             [(1, 1024**2, 1024**2), (5, 6144 * 512, 1024**2), (6, 12288 * 512, 1024**2)])
+
+    def test_read_partitions_none(self):
+        """Test reading an image without a partition table"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+            mksparse(disk_img.name, 1024**2)
+            self.assertEqual(read_partitions(disk_img.name), [])
+
+    def test_fs_type(self):
+        """Test identifying a filesystem at an offset"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+            mksparse(disk_img.name, 8 * 1024**2)
+            runcmd(["mkfs.ext4", "-q", "-F", "-E", "offset=%d" % 1024**2, disk_img.name, "4M"])
+            self.assertEqual(fs_type(disk_img.name), None)
+            self.assertEqual(fs_type(disk_img.name, 1024**2), "ext4")
+
+    def test_partition_mount_detach(self):
+        """Test that PartitionMount detaches every loop device it does not use"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+            mksparse(disk_img.name, 8 * 1024**2)
+            with open(disk_img.name, "r+b") as f:
+                self._write_gpt(f, [(0, 2048, 4095), (1, 4096, 8191), (2, 8192, 12287)])
+            devs = iter(["/dev/loop10", "/dev/loop11", "/dev/loop12"])
+            with mock.patch("pylorax.imgutils.fs_type", return_value="ext4"), \
+                 mock.patch("pylorax.imgutils.loop_attach", side_effect=lambda *args: next(devs)), \
+                 mock.patch("pylorax.imgutils.loop_detach") as detach, \
+                 mock.patch("pylorax.imgutils.mount", side_effect=[CalledProcessError(32, "mount"), None, None]), \
+                 mock.patch("pylorax.imgutils.umount"):
+                # The 2nd partition is mounted but rejected, the 3rd is used
+                mount_ok = mock.Mock(side_effect=[False, True])
+                with PartitionMount(disk_img.name, mount_ok=mount_ok) as img_mount:
+                    self.assertEqual(img_mount.mount_dev, "/dev/loop12")
+                    self.assertEqual(detach.call_args_list, [mock.call("/dev/loop10"), mock.call("/dev/loop11")])
+                self.assertEqual(detach.call_args_list[-1], mock.call("/dev/loop12"))
+
+            devs = iter(["/dev/loop10"])
+            with mock.patch("pylorax.imgutils.fs_type", return_value="ext4"), \
+                 mock.patch("pylorax.imgutils.loop_attach", side_effect=lambda *args: next(devs)), \
+                 mock.patch("pylorax.imgutils.loop_detach") as detach, \
+                 mock.patch("pylorax.imgutils.mount"), \
+                 mock.patch("pylorax.imgutils.umount") as umnt:
+                # An unexpected error still unmounts and detaches
+                with self.assertRaises(RuntimeError):
+                    with PartitionMount(disk_img.name, mount_ok=mock.Mock(side_effect=RuntimeError)):
+                        pass
+                self.assertEqual(umnt.call_count, 1)
+                detach.assert_called_once_with("/dev/loop10")
+
     @unittest.skipUnless(os.geteuid() == 0 and not os.path.exists("/.in-container"), "requires root privileges, and no containers")
     def test_partition_mount(self):
         """Test PartitionMount context manager (requires loop)"""
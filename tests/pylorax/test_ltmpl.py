@@ -15,17 +15,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 from contextlib import contextmanager
+import json
 import os
+import re
 from rpmfluff import SimpleRpmBuild, SourceFile, expectedArch
 import shutil
 import tempfile
+import threading
 import unittest
 
 import libdnf5 as dnf5
 
 from pylorax.dnfbase import get_dnf_base_object
 from pylorax.ltmpl import LoraxTemplate, LoraxTemplateRunner
-from pylorax.ltmpl import brace_expand, split_and_expand, rglob, rexists
+from pylorax.ltmpl import brace_expand, split_and_expand, rglob, rexists, glob_re
+from pylorax.ltmpl import ModuleIndex, FindClause, InstallExcludes
+from pylorax.ltmpl import PkgFileIndex, TreeIndex, TemplateProfile, CleanupPlan, TemplateJournal
 from pylorax.sysutils import joinpaths
 
 class TemplateFunctionsTestCase(unittest.TestCase):
@@ -55,6 +60,238 @@ class TemplateFunctionsTestCase(unittest.TestCase):
         self.assertTrue(rexists("chmod*tmpl", "./tests/pylorax/templates"))
         self.assertFalse(rexists("einstein", "./tests/pylorax/templates"))
 
+class FakePackage():
+    """Enough of a libdnf5 package for PkgFileIndex"""
+    def __init__(self, name, files):
+        self.name = name
+        self.files = files
+
+    def get_name(self):
+        return self.name
+
+    def get_arch(self):
+        return "noarch"
+
+    def get_files(self):
+        return self.files
+
+class PkgFileIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp(prefix="lorax.test.index.")
+        os.makedirs(joinpaths(self.root_dir, "/usr/bin"))
+        os.makedirs(joinpaths(self.root_dir, "/usr/share/doc/fake"))
+        for f, data in [("/usr/bin/one", "1"), ("/usr/bin/two", "22"), ("/usr/share/doc/fake/README", "333")]:
+            with open(joinpaths(self.root_dir, f), "w") as fobj:
+                fobj.write(data)
+        self.index = PkgFileIndex(self.root_dir,
+                                  [FakePackage("fake", ["/usr/bin", "/usr/bin/one", "/usr/bin/two"]),
+                                   FakePackage("fake-doc", ["/usr/share/doc/fake", "/usr/share/doc/fake/README"])])
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_filelist(self):
+        """Test PkgFileIndex filelist and sizes"""
+        self.assertEqual(self.index.filelist("fake"), set(["/usr/bin/one", "/usr/bin/two"]))
+        self.assertEqual(self.index.filelist("fake*"), set(["/usr/bin/one", "/usr/bin/two",
+                                                            "/usr/share/doc/fake/README"]))
+        self.assertEqual(self.index.filelist("missing"), set())
+        self.assertEqual(sum(self.index.getsize(f) for f in self.index.filelist("fake*")), 6)
+        self.assertEqual(self.index.owned_by(joinpaths(self.root_dir, "/usr/bin/one")), set(["fake"]))
+
+    def test_removed(self):
+        """Test PkgFileIndex tracking removed files"""
+        self.assertEqual(self.index.getsize("/usr/share/doc/fake/README"), 3)
+        shutil.rmtree(joinpaths(self.root_dir, "/usr/share/doc/fake"))
+        self.index.removed(joinpaths(self.root_dir, "/usr/share/doc/fake"))
+        self.assertEqual(self.index.getsize("/usr/share/doc/fake/README"), 0)
+        self.assertFalse(self.index.isdir("/usr/share/doc/fake"))
+
+    def test_invalidate(self):
+        """Test PkgFileIndex invalidating changed files"""
+        self.assertEqual(self.index.getsize("/usr/bin/two"), 2)
+        with open(joinpaths(self.root_dir, "/usr/bin/two"), "a") as fobj:
+            fobj.write("more")
+        self.assertEqual(self.index.getsize("/usr/bin/two"), 2)
+        self.index.invalidate(joinpaths(self.root_dir, "/usr/bin"))
+        self.assertEqual(self.index.getsize("/usr/bin/two"), 6)
+
+    def test_from_pkglists(self):
+        """Test PkgFileIndex using saved package file lists"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.pkglists.") as tdname:
+            with open(joinpaths(tdname, "fake"), "w") as fobj:
+                fobj.write("/usr/bin\n/usr/bin/one\n/usr/bin/two\n")
+            index = PkgFileIndex.from_pkglists(self.root_dir, tdname)
+        self.assertEqual(index.filelist("fake*"), set(["/usr/bin/one", "/usr/bin/two"]))
+        self.assertEqual(index.packages, [("fake", "", ["/usr/bin", "/usr/bin/one", "/usr/bin/two"])])
+
+class ModuleIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp(prefix="lorax.test.kmods.")
+        self.moddir = joinpaths(self.root_dir, "/usr/lib/modules/1.2.3")
+        os.makedirs(joinpaths(self.moddir, "kernel/sound/pci"))
+        os.makedirs(joinpaths(self.moddir, "kernel/drivers/video"))
+        for f in ["sound/foo1.ko", "sound/pci/foo2.ko", "drivers/video/bar1.ko"]:
+            with open(joinpaths(self.moddir, "kernel", f), "w") as fobj:
+                fobj.write("lorax test file")
+        with open(joinpaths(self.moddir, "modules.dep"), "w") as fobj:
+            fobj.write("kernel/drivers/video/bar1.ko: kernel/sound/pci/foo2.ko\n"
+                       "kernel/sound/pci/foo2.ko: kernel/sound/foo1.ko\n"
+                       "kernel/sound/foo1.ko:\n")
+        os.symlink("usr/lib", joinpaths(self.root_dir, "/lib"))
+        self.index = ModuleIndex(self.root_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_glob_re(self):
+        """Test converting globs to regexes"""
+        self.assertEqual(glob_re("foo*.ko"), r"foo[^/]*\.ko")
+        self.assertEqual(glob_re("drivers/**/[!a-c]?"), r"drivers/.*/[^a-c][^/]")
+
+    def test_match(self):
+        """Test ModuleIndex matching directories"""
+        sound = set(joinpaths(self.root_dir, "lib/modules/1.2.3/kernel", f)
+                    for f in ["sound/foo1.ko", "sound/pci/foo2.ko"])
+        self.assertEqual(self.index.match(["sound"]), sound)
+        self.assertEqual(self.index.match(["so*/", "sound/pci"]), sound)
+        self.assertEqual(len(self.index.match(["*"])), 3)
+        # Only directories are matched
+        self.assertEqual(self.index.match(["sound/foo1.ko", "sou"]), set())
+        self.assertEqual(self.index.getsize(*sound), 30)
+
+    def test_needed_by(self):
+        """Test ModuleIndex module dependencies"""
+        bar1 = joinpaths(self.root_dir, "lib/modules/1.2.3/kernel/drivers/video/bar1.ko")
+        self.assertEqual(self.index.needed_by([bar1]),
+                         set(joinpaths(self.root_dir, "lib/modules/1.2.3/kernel", f)
+                             for f in ["sound/foo1.ko", "sound/pci/foo2.ko"]))
+        self.assertEqual(self.index.needed_by(self.index.match(["sound"])),
+                         set([joinpaths(self.root_dir, "lib/modules/1.2.3/kernel/sound/foo1.ko")]))
+
+    def test_removed(self):
+        """Test ModuleIndex tracking removals"""
+        self.assertTrue(self.index.related(joinpaths(self.root_dir, "/usr/lib")))
+        self.assertFalse(self.index.related(joinpaths(self.root_dir, "/usr/share")))
+        self.index.removed(joinpaths(self.root_dir, "/usr/lib/modules/1.2.3/kernel/sound/pci"))
+        self.assertEqual(len(self.index.match(["sound"])), 1)
+        self.index.removed(joinpaths(self.root_dir, "/lib/modules/1.2.3/kernel/sound/foo1.ko"))
+        self.assertEqual(self.index.match(["sound"]), set())
+        self.index.removed(joinpaths(self.root_dir, "/usr"))
+        self.assertEqual(self.index.files, {})
+
+class InstallExcludesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp(prefix="lorax.test.excludes.")
+        packages = {"filesystem": ["/lib", "/usr", "/usr/bin", "/usr/lib", "/usr/share", "/usr/share/man"],
+                    "fake-docs": ["/usr/share/doc", "/usr/share/doc/a", "/usr/share/doc/b",
+                                  "/usr/share/man/man1", "/usr/share/man/man1/x.1"],
+                    "fake-bin": ["/usr/bin/one", "/usr/bin/two"],
+                    "fake-lib": ["/usr/lib/keep.so", "/usr/lib/drop.so", "/usr/lib/alias-only"],
+                    "fake-info": ["/usr/share/info", "/usr/share/info/dir", "/usr/share/info/x.info"],
+                    "fake-locale": ["/usr/share/locale", "/usr/share/locale/de", "/usr/share/locale/de/a.mo",
+                                    "/usr/share/locale/keep"]}
+        with tempfile.TemporaryDirectory(prefix="lorax.test.pkglists.") as tdname:
+            for name, files in packages.items():
+                with open(joinpaths(tdname, name), "w") as fobj:
+                    fobj.write("".join(f + "\n" for f in files))
+            self.index = PkgFileIndex.from_pkglists(self.root_dir, tdname)
+        runner = LoraxTemplateRunner(inroot=self.root_dir, outroot=self.root_dir,
+                                     templatedir="./tests/pylorax/templates")
+        self.commands = runner.compile("excludes-cleanup.tmpl").commands
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_find(self):
+        """Test finding the package files the cleanup removes"""
+        excludes = InstallExcludes(self.root_dir, self.commands, protect=["/usr/bin/one"])
+        self.assertEqual(excludes.find(self.index),
+                         ["/usr/bin/two", "/usr/lib/alias-only", "/usr/lib/drop.so", "/usr/share/doc",
+                          "/usr/share/info/x.info", "/usr/share/locale/de", "/usr/share/man/man1/x.1"])
+        self.assertIn("/usr/share/doc/a", excludes.excluded)
+        self.assertIn("/usr/share/locale/de/a.mo", excludes.excluded)
+
+        # Only the paths with the most files under them are used
+        excludes = InstallExcludes(self.root_dir, self.commands, max_paths=2)
+        self.assertEqual(excludes.find(self.index), ["/usr/share/doc", "/usr/share/locale/de"])
+
+    def test_find_scripts(self):
+        """Test that the paths read by scriptlets and file triggers are installed"""
+        excludes = InstallExcludes(self.root_dir, self.commands)
+        scripts = ["/usr/bin/install-info /usr/share/info/x.info /usr/share/info/dir || :",
+                   "/usr/share/locale", "cd /usr; ${D}/usr/share/doc $X/usr/share/man"]
+        self.assertEqual(excludes.find(self.index, scripts),
+                         ["/usr/bin/one", "/usr/bin/two", "/usr/lib/alias-only", "/usr/lib/drop.so", "/usr/share/doc",
+                          "/usr/share/man/man1/x.1"])
+
+    def test_leftovers(self):
+        """Test checking the excluded paths after the cleanup"""
+        excludes = InstallExcludes(self.root_dir, self.commands, verify=True)
+        excludes.find(self.index)
+        excludes.add_placeholders()
+        self.assertTrue(os.path.isdir(joinpaths(self.root_dir, "/usr/share/doc")))
+        self.assertTrue(os.path.isfile(joinpaths(self.root_dir, "/usr/share/doc/a")))
+        self.assertEqual(excludes.leftovers(), sorted(excludes.excluded))
+
+        shutil.rmtree(joinpaths(self.root_dir, "/usr/share/doc"))
+        os.unlink(joinpaths(self.root_dir, "/usr/bin/two"))
+        self.assertNotIn("/usr/share/doc/a", excludes.leftovers())
+        self.assertIn("/usr/lib/drop.so", excludes.leftovers())
+
+class TreeIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp(prefix="lorax.test.tree.")
+        os.makedirs(joinpaths(self.root_dir, "/usr/lib/modules/1.2.3/kernel/sound"))
+        os.makedirs(joinpaths(self.root_dir, "/usr/share/.hidden"))
+        for f in ["/usr/lib/modules/1.2.3/kernel/sound/foo1.ko", "/usr/lib/modules/1.2.3/kernel/sound/foo2.ko",
+                  "/usr/share/.hidden/foo3.ko"]:
+            with open(joinpaths(self.root_dir, f), "w") as fobj:
+                fobj.write("lorax test file")
+        os.symlink("usr/lib", joinpaths(self.root_dir, "/lib"))
+        os.symlink("missing", joinpaths(self.root_dir, "/usr/broken"))
+        self.index = TreeIndex(self.root_dir, check=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_glob(self):
+        """Test TreeIndex glob matching"""
+        self.assertEqual(sorted(self.index.glob("/lib/modules/*/kernel/sound/*")),
+                         ["lib/modules/1.2.3/kernel/sound/foo1.ko", "lib/modules/1.2.3/kernel/sound/foo2.ko"])
+        self.assertEqual(sorted(self.index.glob("**/foo1.ko")),
+                         ["lib/modules/1.2.3/kernel/sound/foo1.ko", "usr/lib/modules/1.2.3/kernel/sound/foo1.ko"])
+        self.assertEqual(sorted(self.index.glob("usr/*")), ["usr/broken", "usr/lib", "usr/share"])
+        self.assertEqual(sorted(self.index.glob("usr/*/")), ["usr/lib/", "usr/share/"])
+        self.assertEqual(self.index.glob("usr/share/*/*.ko"), [])
+        self.assertEqual(self.index.glob("usr/share/.*/*.ko"), ["usr/share/.hidden/foo3.ko"])
+        self.assertEqual(self.index.glob("lib/modules/../modules/1.2.3"), ["lib/modules/../modules/1.2.3"])
+        self.assertTrue(self.index.exists("usr/broken"))
+        self.assertFalse(self.index.exists("usr/broken/*"))
+
+    def test_changed(self):
+        """Test TreeIndex tracking changes"""
+        self.assertEqual(len(self.index.glob("lib/modules/*/kernel/sound/*")), 2)
+        shutil.rmtree(joinpaths(self.root_dir, "/usr/lib/modules/1.2.3/kernel/sound"))
+        self.index.removed(joinpaths(self.root_dir, "/lib/modules/1.2.3/kernel/sound"))
+        self.assertEqual(self.index.glob("lib/modules/*/kernel/sound/*"), [])
+
+        os.makedirs(joinpaths(self.root_dir, "/usr/lib/modules/1.2.3/kernel/sound"))
+        self.index.changed(joinpaths(self.root_dir, "/usr/lib/modules/1.2.3/kernel/sound"))
+        os.symlink("../../../../../share", joinpaths(self.root_dir, "/usr/lib/modules/1.2.3/kernel/sound/share"))
+        self.index.changed(joinpaths(self.root_dir, "/usr/lib/modules/1.2.3/kernel/sound/share"))
+        self.assertEqual(self.index.glob("lib/**/*.ko"), [])
+        self.assertEqual(self.index.glob("lib/modules/*/kernel/sound/share/.hidden/*"),
+                         ["lib/modules/1.2.3/kernel/sound/share/.hidden/foo3.ko"])
+
+        # The index is not updated until it is told about the change
+        with open(joinpaths(self.root_dir, "/usr/new-file"), "w") as fobj:
+            fobj.write("lorax test file")
+        with self.assertRaises(RuntimeError):
+            self.index.glob("usr/new-*")
+        self.index.changed()
+        self.assertEqual(self.index.glob("usr/new-*"), ["usr/new-file"])
+
 class LoraxTemplateTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(self):
@@ -80,6 +317,97 @@ class LoraxTemplateTestCase(unittest.TestCase):
                                     ['installpkg', 'foo-one', 'foo-two'],
                                     ['run_pkg_transaction']])
 
+    def test_parse_template_lines(self):
+        """Test that LoraxTemplate.parse_lines() returns the source line of each command"""
+        lines = self.templates.parse_lines("parse-test.tmpl", {"basearch": "s390x"})
+        self.assertEqual(lines, [(3, ("parse-test.tmpl", 3), ['installpkg', 'common-package']),
+                                 (4, ("parse-test.tmpl", 4), ['installpkg', 'foo-one', 'foo-two']),
+                                 (7, ("parse-test.tmpl", 10), ['run_pkg_transaction'])])
+
+    def test_parse_template_cache(self):
+        """Test LoraxTemplate.parse() with a compiled template cache"""
+        cachedir = tempfile.mkdtemp(prefix="lorax.test.cache.")
+        try:
+            templates = LoraxTemplate(["./tests/pylorax/templates/"], cachedir=cachedir)
+            first = templates.parse("parse-test.tmpl", {"basearch": "x86_64"})
+            modules = [f for _root, _dirs, files in os.walk(cachedir) for f in files]
+            self.assertEqual(len(modules), 1)
+            self.assertTrue(re.match(r"parse-test.tmpl.[0-9a-f]{16}.py$", modules[0]), modules)
+
+            self.assertEqual(templates.parse("parse-test.tmpl", {"basearch": "x86_64"}), first)
+            self.assertEqual(templates.stats["memory"], 1)
+            self.assertEqual(templates.stats["expanded"], 1)
+
+            templates = LoraxTemplate(["./tests/pylorax/templates/"], cachedir=cachedir)
+            self.assertEqual(templates.parse("parse-test.tmpl", {"basearch": "x86_64"}), first)
+            self.assertEqual(templates.stats["disk"], 1)
+            self.assertEqual(templates.stats["compiled"], 0)
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_parse_template_expanded_limit(self):
+        """Test that LoraxTemplate only keeps the last max_expanded results"""
+        templates = LoraxTemplate(["./tests/pylorax/templates/"])
+        templates.max_expanded = 1
+        templates.parse("parse-test.tmpl", {"basearch": "x86_64"})
+        templates.parse("parse-test.tmpl", {"basearch": "s390x"})
+        templates.parse("parse-test.tmpl", {"basearch": "x86_64"})
+        self.assertEqual(templates.stats["expanded"], 0)
+        templates.parse("parse-test.tmpl", {"basearch": "x86_64"})
+        self.assertEqual(templates.stats["expanded"], 1)
+
+    def test_parse_template_cache_changed(self):
+        """Test that a changed template is recompiled even if its mtime is older"""
+        tmpdir = tempfile.mkdtemp(prefix="lorax.test.cache.")
+        try:
+            cachedir = os.path.join(tmpdir, "cache")
+            tmpl = os.path.join(tmpdir, "test.tmpl")
+            with open(tmpl, "w") as f:
+                f.write("installpkg one\n")
+            self.assertEqual(LoraxTemplate([tmpdir], cachedir=cachedir).parse("test.tmpl", {}),
+                             [["installpkg", "one"]])
+
+            # Like an rpm update, with the build time mtime
+            with open(tmpl, "w") as f:
+                f.write("installpkg two\n")
+            os.utime(tmpl, (1000000000, 1000000000))
+            self.assertEqual(LoraxTemplate([tmpdir], cachedir=cachedir).parse("test.tmpl", {}),
+                             [["installpkg", "two"]])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parse_template_rewritten(self):
+        """Test that a template rewritten within the same second is parsed again"""
+        tmpdir = tempfile.mkdtemp(prefix="lorax.test.tmpl.")
+        try:
+            tmpl = os.path.join(tmpdir, "test.tmpl")
+            with open(tmpl, "w") as f:
+                f.write("runcmd one\n")
+            os.utime(tmpl, (1000000000, 1000000000))
+            templates = LoraxTemplate([tmpdir])
+            self.assertEqual(templates.parse("test.tmpl", {}), [["runcmd", "one"]])
+
+            with open(tmpl, "w") as f:
+                f.write("runcmd three\n")
+            os.utime(tmpl, (1000000000, 1000000000))
+            self.assertEqual(templates.parse("test.tmpl", {}), [["runcmd", "three"]])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parse_template_cache_unsafe(self):
+        """Test that a cache directory writable by other users is not used"""
+        tmpdir = tempfile.mkdtemp(prefix="lorax.test.cache.")
+        try:
+            os.chmod(tmpdir, 0o777)
+            with self.assertLogs("pylorax.ltmpl", level="WARNING"):
+                templates = LoraxTemplate(["./tests/pylorax/templates/"], cachedir=os.path.join(tmpdir, "cache"))
+                templates.parse("parse-test.tmpl", {"basearch": "x86_64"})
+            self.assertEqual(templates.stats["compiled"], 1)
+            modules = [f for _root, _dirs, files in os.walk(tmpdir) for f in files]
+            self.assertEqual(modules, [])
+        finally:
+            shutil.rmtree(tmpdir)
+
 @contextmanager
 def in_tempdir(prefix='tmp'):
     """Execute a block of code with chdir in a temporary location"""
@@ -225,6 +553,21 @@ class LoraxTemplateRunnerTestCase(unittest.TestCase):
             else:
                 self.assertEqual(r, [], t[0])
 
+    def test_00_pkgvers(self):
+        """Test resolving several package specs together"""
+        r = self.runner._pkgvers(["fake-bart", "fake-mil*", "fake-bart", "foopkg="])
+        self.assertEqual(sorted(r), ["fake-bart", "fake-mil*", "foopkg="])
+        self.assertEqual([p.get_evr() for p in r["fake-bart"]], ["2:2.3.0-1"])
+        self.assertEqual(set(p.get_evr() for p in r["fake-mil*"]), set(["1.3.0-1"]))
+        self.assertIsInstance(r["foopkg="], RuntimeError)
+        self.assertEqual(str(r["foopkg="]), "Missing version")
+
+        # The results are cached, the failures are resolved again
+        r2 = self.runner._pkgvers(["fake-bart", "foopkg="])
+        self.assertIs(r2["fake-bart"], r["fake-bart"])
+        self.assertIsInstance(r2["foopkg="], RuntimeError)
+        self.assertIsNot(r2["foopkg="], r["foopkg="])
+
     @unittest.skipUnless(os.geteuid() == 0 and not os.path.exists("/.in-container"), "requires root privileges, and no containers")
     def test_01_runner_multi_repo(self):
         """Test installing packages with updates in a 2nd repo"""
@@ -251,6 +594,13 @@ class LoraxTemplateRunnerTestCase(unittest.TestCase):
         # Check the debug log
         self.assertTrue(exists("/root/debug-pkgs.log"))
 
+        # Check the package manifest
+        with open(joinpaths(self.root_dir, "/root/lorax-packages.json")) as f:
+            manifest = [m for m in json.load(f) if m["nevra"].startswith("fake-marge-2.3.0-1.")]
+        self.assertEqual(len(manifest), 1)
+        self.assertTrue(manifest[0]["debuginfo"].startswith("fake-marge-debuginfo-2.3.0-1."))
+        self.assertTrue(manifest[0]["size"] > 0)
+
         # Check package version installs
         self.assertTrue(exists("/fake-lisa/1.1.4-5"))
         self.assertFalse(exists("/fake-lisa/1.2.0-1"))
@@ -270,6 +620,7 @@ class LoraxTemplateRunnerTestCase(unittest.TestCase):
         """Test installimg template command"""
         self.runner.run("installimg-cmd.tmpl")
         self.assertTrue(os.path.exists(joinpaths(self.root_dir, "images/product.img")))
+        self.assertTrue(os.path.exists(joinpaths(self.root_dir, "images/product.img.zst")))
 
     def test_mkdir(self):
         """Test mkdir template command"""
@@ -284,6 +635,21 @@ class LoraxTemplateRunnerTestCase(unittest.TestCase):
             data = f.read()
         self.assertEqual(data, "Running 1.2.3 for lorax\n")
 
+    def test_replace_multi(self):
+        """Test replace template command with several patterns"""
+        compiled = self.runner.compile("replace-multi-cmd.tmpl")
+        # The replace lines with the same files are combined
+        self.assertEqual([c.name for c in compiled.commands], ["append", "replace", "replace"])
+        self.runner.run_compiled(compiled)
+        with open(joinpaths(self.root_dir, "/etc/lorax-replace-multi")) as f:
+            data = f.read()
+        self.assertEqual(data, "Fedora 1.2.3 x86_64\nFedora\n")
+
+        with self.assertRaises(ValueError):
+            self.runner._parse_replace("@VERSION@", "1.2.3", "@ARCH@", "--files", "/etc/lorax-replace-multi")
+        with self.assertRaises(ValueError):
+            self.runner._parse_replace("@VERSION@", "1.2.3", "--files")
+
     def test_treeinfo(self):
         """Test treeinfo template command"""
         self.runner.run("treeinfo-cmd.tmpl")
@@ -334,6 +700,112 @@ class LoraxTemplateRunnerTestCase(unittest.TestCase):
         self.runner.run("remove-cmd.tmpl")
         self.assertFalse(os.path.exists(joinpaths(self.root_dir, "/lorax-file")))
 
+    def test_remove_batched(self):
+        """Test remove template command with batched removals"""
+        self.runner.batchremove = True
+        try:
+            self.runner.run("remove-batched-cmd.tmpl")
+        finally:
+            self.runner.batchremove = False
+        self.assertTrue(os.path.isdir(joinpaths(self.root_dir, "/lorax-batch/one")))
+        self.assertFalse(os.path.exists(joinpaths(self.root_dir, "/lorax-batch/one/file")))
+        self.assertEqual(os.listdir(joinpaths(self.root_dir, "/lorax-batch/two")), [])
+
+        # A path that is already gone is ignored, like it is without batching
+        self.runner._batching = True
+        try:
+            self.runner._remove(joinpaths(self.root_dir, "/lorax-batch/missing"))
+        finally:
+            self.runner._batching = False
+        self.assertEqual(len(self.runner._pending), 0)
+
+    def test_tree_index(self):
+        """Test template commands using the tree index"""
+        runner = LoraxTemplateRunner(inroot=self.root_dir, outroot=self.root_dir,
+                                     templatedir="./tests/pylorax/templates",
+                                     treeindex=True, checktree=True)
+        runner.run("tree-index-cmd.tmpl")
+        self.assertFalse(os.path.exists(joinpaths(self.root_dir, "/lorax-tree/one/two/file")))
+        self.assertEqual(os.stat(joinpaths(self.root_dir, "/lorax-tree/three/file")).st_mode, 0o100600)
+        self.assertEqual(runner._glob_in("/lorax-tree/**/file"), ["/lorax-tree/three/file"])
+        self.assertTrue(runner._exists_in("lorax-tree/link/"))
+
+    def test_profile(self):
+        """Test recording a template profile"""
+        with tempfile.NamedTemporaryFile(suffix=".json") as f:
+            self.runner.profile = TemplateProfile(f.name)
+            self.runner.batchremove = True
+            try:
+                self.runner.run("remove-batched-cmd.tmpl")
+            finally:
+                self.runner.batchremove = False
+                self.runner.profile = None
+            with open(f.name) as fobj:
+                report = json.load(fobj)
+        self.assertEqual([(r["line"], r["command"]) for r in report["lines"]],
+                         [(2, "mkdir"), (3, "append"), (4, "append"), (5, "remove"), (6, "remove"),
+                          (7, "remove"), (0, "flush"), (8, "mkdir")])
+        self.assertEqual(report["commands"]["remove"]["count"], 3)
+        self.assertEqual(report["commands"]["remove"]["files"], 3)
+        self.assertEqual(report["templates"]["remove-batched-cmd.tmpl"]["count"], 8)
+
+    def test_plan(self):
+        """Test planning removals without removing anything"""
+        for f, data in [("/lorax-plan/one/file", "1234"), ("/lorax-plan/one/other", "12"),
+                        ("/lorax-plan/two/a.txt", "123"), ("/lorax-plan/two/b.dat", "12345"),
+                        ("/lorax-plan/doc/README", "123456")]:
+            os.makedirs(os.path.dirname(joinpaths(self.root_dir, f)), exist_ok=True)
+            with open(joinpaths(self.root_dir, f), "w") as fobj:
+                fobj.write(data)
+        runner = LoraxTemplateRunner(inroot=self.root_dir, outroot=self.root_dir,
+                                     templatedir="./tests/pylorax/templates")
+        with tempfile.TemporaryDirectory(prefix="lorax.test.pkglists.") as tdname:
+            for name, files in [("fake-pkg", ["/lorax-plan/two", "/lorax-plan/two/a.txt", "/lorax-plan/two/b.dat"]),
+                                ("fake-doc", ["/lorax-plan/doc/README"])]:
+                with open(joinpaths(tdname, name), "w") as fobj:
+                    fobj.write("\n".join(files) + "\n")
+            runner.load_pkglists(tdname)
+        runner.plan = CleanupPlan(joinpaths(self.root_dir, "/lorax-plan"))
+        runner.run("plan-cmd.tmpl")
+        report = runner.plan.report()
+
+        # Nothing was changed
+        self.assertTrue(os.path.exists(joinpaths(self.root_dir, "/lorax-plan/one/file")))
+        self.assertTrue(os.path.exists(joinpaths(self.root_dir, "/lorax-plan/doc/README")))
+        self.assertFalse(os.path.exists(joinpaths(self.root_dir, "/lorax-plan/new")))
+
+        self.assertEqual([(r["line"], r["command"], r["files"], r["bytes"]) for r in report["lines"]],
+                         [(2, "remove", 1, 4), (3, "remove", 1, 2), (5, "removefrom", 1, 3), (6, "removepkg", 1, 6),
+                          (7, "find", 1, 5)])
+        self.assertEqual([(r["line"], r["command"]) for r in report["skipped"]], [(4, "append")])
+        self.assertEqual((report["files"], report["bytes"]), (5, 20))
+        self.assertEqual((report["size_before"], report["size_after"]), (20, 0))
+        self.assertTrue(os.path.exists(joinpaths(self.root_dir, "/lorax-plan/two/b.dat")))
+
+    def test_journal(self):
+        """Test resuming a template using the journal"""
+        with tempfile.NamedTemporaryFile(suffix=".jsonl") as f:
+            runner = LoraxTemplateRunner(inroot=self.root_dir, outroot=self.root_dir,
+                                         templatedir="./tests/pylorax/templates")
+            runner.journal = TemplateJournal(f.name)
+            with self.assertRaises(IOError):
+                runner.run("journal-cmd.tmpl")
+            runner.journal.close()
+
+            with open(joinpaths(self.root_dir, "/lorax-journal/later"), "w") as fobj:
+                fobj.write("later")
+            runner = LoraxTemplateRunner(inroot=self.root_dir, outroot=self.root_dir,
+                                         templatedir="./tests/pylorax/templates")
+            runner.journal = TemplateJournal(f.name, resume=True)
+            runner.run("journal-cmd.tmpl")
+            runner.journal.close()
+
+        # The completed lines were skipped, except for treeinfo which was run again
+        with open(joinpaths(self.root_dir, "/lorax-journal/file")) as fobj:
+            self.assertEqual(fobj.read(), "one\ntwo\n")
+        self.assertEqual(runner.results.treeinfo, {"journal": {"key": "value"}})
+        self.assertEqual(os.stat(joinpaths(self.root_dir, "/lorax-journal/later")).st_mode, 0o100644)
+
     def test_chmod(self):
         """Test chmod template command"""
         self.runner.run("chmod-cmd.tmpl")
@@ -352,6 +824,94 @@ class LoraxTemplateRunnerTestCase(unittest.TestCase):
         self.assertFalse(os.path.exists(joinpaths(self.root_dir, "/lib/modules/1.2.3/kernel/sound/foo1.ko")))
         self.assertFalse(os.path.exists(joinpaths(self.root_dir, "/lib/modules/1.2.3/kernel/sound/foo2.ko")))
 
+    def test_removekmod_keepdeps(self):
+        """Test removekmod keeping the modules needed by the modules that are kept"""
+        self.runner.run("removekmod-keepdeps-cmd.tmpl")
+        for f in ["virtio_net.ko", "net_failover.ko", "failover.ko"]:
+            self.assertTrue(os.path.exists(joinpaths(self.root_dir, "/lib/modules/4.5.6/kernel/drivers/net", f)))
+        self.assertFalse(os.path.exists(joinpaths(self.root_dir, "/lib/modules/4.5.6/kernel/drivers/net/e1000.ko")))
+        self.assertFalse(os.path.exists(joinpaths(self.root_dir, "/lib/modules/4.5.6/kernel/lib/crc8.ko")))
+
+    def test_find(self):
+        """Test find template command"""
+        for d in ["boot/loader", "boot/efi", "etc/sub", "usr/lib/python", "fonts"]:
+            os.makedirs(joinpaths(self.root_dir, "find-test", d))
+        for f in ["boot/vmlinuz-1", "boot/initrd.img", "boot/loader/entry", "boot/efi/vmlinuz-2",
+                  "etc/real.pyc", "usr/lib/python/one.pyc", "usr/lib/python/one.py", "fonts/old", "fonts/new"]:
+            with open(joinpaths(self.root_dir, "find-test", f), "w") as fobj:
+                fobj.write("lorax test file")
+        os.symlink("/find-test/etc/real.pyc", joinpaths(self.root_dir, "find-test/etc/good.pyc"))
+        os.symlink("/find-test/missing", joinpaths(self.root_dir, "find-test/etc/sub/broken"))
+        os.symlink("../boot/initrd.img", joinpaths(self.root_dir, "find-test/etc/initrd.img"))
+        os.utime(joinpaths(self.root_dir, "find-test/fonts/old"), (1000, 1000))
+
+        self.runner.run("find-cmd.tmpl")
+        self.assertEqual(sorted(os.listdir(joinpaths(self.root_dir, "find-test/boot"))), ["efi", "vmlinuz-1"])
+        self.assertEqual(os.listdir(joinpaths(self.root_dir, "find-test/boot/efi")), ["vmlinuz-2"])
+        # The .pyc link was checked before the file it points to was deleted
+        self.assertEqual(sorted(os.listdir(joinpaths(self.root_dir, "find-test/etc"))), ["good.pyc", "sub"])
+        self.assertEqual(os.listdir(joinpaths(self.root_dir, "find-test/etc/sub")), [])
+        self.assertEqual(os.listdir(joinpaths(self.root_dir, "find-test/usr/lib/python")), ["one.py"])
+        self.assertEqual(os.stat(joinpaths(self.root_dir, "find-test/fonts/old")).st_mtime, 1000)
+        self.assertEqual(os.stat(joinpaths(self.root_dir, "find-test/fonts/new")).st_mtime, 2000)
+
+    def test_find_errors(self):
+        """Test find command argument errors"""
+        for args in [["-name", "foo", "-delete"], ["/foo", "-name", "foo"], ["/foo", "-delete", "-name", "foo"],
+                     ["/foo", "-type", "x", "-delete"], ["/foo", "!", "-delete"], ["/foo", "-newer", "now", "-log"],
+                     ["/foo", "-unknown", "-log"], ["/foo", "-name"]]:
+            with self.assertRaises(ValueError):
+                FindClause(args)
+        clause = FindClause(["//etc/", "/usr", "-xdev", "!", "-type", "l", "-log"])
+        self.assertEqual(clause.paths, ["etc", "usr"])
+        self.assertTrue(clause.xdev)
+        self.assertFalse(clause.deletes)
+
+    def test_background(self):
+        """Test running template commands in the background"""
+        self.runner.run("background-cmd.tmpl", root=self.root_dir)
+        for f in ["one", "two", "three"]:
+            self.assertTrue(os.path.exists(joinpaths(self.root_dir, "bg-test", f)))
+
+    def test_background_errors(self):
+        """Test errors from template commands in the background"""
+        with self.assertRaisesRegex(RuntimeError, "line 2"):
+            self.runner.run("background-errors.tmpl")
+        with open(joinpaths(self.root_dir, "bg-error-test")) as f:
+            self.assertEqual(f.read(), "still run\n")
+        self.assertEqual(self.runner._jobs, [])
+
+        with self.assertRaises(ValueError):
+            self.runner._compile_line(1, ["installpkg", "fake-bart", "&"])
+        with self.assertRaisesRegex(ValueError, "append cannot be run in the background"):
+            self.runner._compile_line(1, ["append", "/bg-test/one", "one", "&"])
+        self.assertFalse(self.runner._compile_line(1, ["wait"]).background)
+
+    def test_background_updates(self):
+        """Test that background lines update the indexes from the template's thread"""
+        threads = []
+        indexes_changed = self.runner._indexes_changed
+        def record_thread(path):
+            threads.append(threading.current_thread())
+            indexes_changed(path)
+
+        with tempfile.NamedTemporaryFile(suffix=".json") as f:
+            self.runner.profile = TemplateProfile(f.name)
+            self.runner._indexes_changed = record_thread
+            try:
+                self.runner.run("background-cmd.tmpl", root=self.root_dir)
+            finally:
+                del self.runner._indexes_changed
+                self.runner.profile = None
+            with open(f.name) as fobj:
+                report = json.load(fobj)
+        self.assertTrue(threads)
+        self.assertEqual(set(threads), set([threading.main_thread()]))
+        # The runcmd lines are measured in their worker
+        self.assertEqual(sorted((r["line"], r["command"]) for r in report["lines"]),
+                         [(2, "mkdir"), (3, "append"), (4, "runcmd"), (5, "runcmd"), (6, "wait"), (7, "append")])
+        self.assertGreater([r for r in report["lines"] if r["line"] == 4][0]["wall"], 0.2)
+
     def test_createaddrsize(self):
         """Test createaddrsize template command"""
         self.runner.run("createaddrsize-cmd.tmpl", root=self.root_dir)
@@ -362,6 +922,16 @@ class LoraxTemplateRunnerTestCase(unittest.TestCase):
         self.runner.run("systemctl-cmd.tmpl")
         self.assertTrue(os.path.islink(joinpaths(self.root_dir, "/etc/systemd/system/multi-user.target.wants/foo.service")))
 
+    @unittest.skipUnless(shutil.which("systemctl"), "requires systemctl")
+    def test_systemctl_verify(self):
+        """Test systemctl template command checked with systemctl"""
+        self.runner.systemctlmode = "verify"
+        try:
+            self.runner.run("systemctl-cmd.tmpl")
+        finally:
+            self.runner.systemctlmode = "native"
+        self.assertTrue(os.path.islink(joinpaths(self.root_dir, "/etc/systemd/system/multi-user.target.wants/foo.service")))
+
     def test_bad_template(self):
         """Test parsing a bad template"""
         with self.assertRaises(Exception):
@@ -371,3 +941,22 @@ class LoraxTemplateRunnerTestCase(unittest.TestCase):
         """Test a template with an unknown command"""
         with self.assertRaises(ValueError):
             self.runner.run("unknown-cmd.tmpl")
+
+    def test_compile_errors(self):
+        """Test that a template with bad lines does not run any of them"""
+        with self.assertRaises(ValueError):
+            self.runner.run("compile-errors.tmpl")
+        self.assertFalse(os.path.exists(joinpaths(self.root_dir, "/lorax-compile-errors")))
+
+    def test_run_compiled(self):
+        """Test running a compiled template in a different root"""
+        compiled = self.runner.compile("mkdir-cmd.tmpl")
+        self.assertEqual([c.name for c in compiled.commands], ["mkdir"])
+        other_dir = tempfile.mkdtemp(prefix="lorax.test.compiled.")
+        try:
+            runner = LoraxTemplateRunner(inroot=other_dir, outroot=other_dir,
+                                         templatedir="./tests/pylorax/templates")
+            runner.run_compiled(compiled)
+            self.assertTrue(os.path.isdir(joinpaths(other_dir, "/etc/lorax-mkdir")))
+        finally:
+            shutil.rmtree(other_dir)
@@ -0,0 +1,87 @@
+#
+# Copyright (C) 2024 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pylorax.sysutils import joinpaths
+from pylorax.pkgsizes import PackageSizes, estimated_with, zstd
+
+class PackageSizesTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="lorax.test.pkgsizes.")
+        os.makedirs(joinpaths(self.root, "/usr/lib"))
+        with open(joinpaths(self.root, "/usr/lib/zeros"), "wb") as f:
+            f.write(b"\0" * 300000)
+        with open(joinpaths(self.root, "/usr/lib/random"), "wb") as f:
+            f.write(os.urandom(100000))
+        with open(joinpaths(self.root, "/usr/lib/sparse"), "wb") as f:
+            f.truncate(10 * 1024 * 1024)
+        os.link(joinpaths(self.root, "/usr/lib/random"), joinpaths(self.root, "/usr/lib/random-link"))
+        os.symlink("zeros", joinpaths(self.root, "/usr/lib/zeros-link"))
+        self.packages = [("zeros", "noarch", ["/usr/lib", "/usr/lib/zeros", "/usr/lib/zeros-link",
+                                              "/usr/lib/sparse", "/usr/lib/missing"]),
+                         ("random", "x86_64", ["/usr/lib/random", "/usr/lib/random-link"]),
+                         ("random-copy", "x86_64", ["/usr/lib/random-link"])]
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_report(self):
+        """Test the package sizes"""
+        report = PackageSizes(self.root, self.packages, "xz").report()
+        packages = {p["name"]: p for p in report["packages"]}
+        self.assertEqual(packages["zeros"]["files"], 2)
+        self.assertEqual(packages["zeros"]["size"], 300000 + 10 * 1024 * 1024)
+        # The sparse file doesn't use any space
+        self.assertTrue(packages["zeros"]["disk"] < 400000)
+        self.assertTrue(packages["zeros"]["compressed"] < 100000)
+
+        # Hardlinks are only counted once
+        self.assertEqual(packages["random"]["files"], 1)
+        self.assertEqual(packages["random"]["size"], 100000)
+        self.assertTrue(packages["random"]["compressed"] > 95000)
+        self.assertEqual(report["total"]["files"], 3)
+        self.assertEqual(report["total"]["size"], 400000 + 10 * 1024 * 1024)
+
+        # Sorted by the compressed size
+        self.assertEqual(report["packages"][-1]["name"], "zeros")
+
+    def test_write(self):
+        """Test writing the package sizes"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.pkgsizes.") as tdname:
+            PackageSizes(self.root, self.packages, "gzip").write(joinpaths(tdname, "pkgsizes.txt"),
+                                                                 joinpaths(tdname, "pkgsizes.json"))
+            with open(joinpaths(tdname, "pkgsizes.txt")) as f:
+                self.assertEqual(f.read(), "random.x86_64: 100000\n"
+                                           "random-copy.x86_64: 100000\n"
+                                           "zeros.noarch: %d\n" % (300000 + 10 * 1024 * 1024))
+            with open(joinpaths(tdname, "pkgsizes.json")) as f:
+                report = json.load(f)
+        self.assertEqual(report["compression"], "gzip")
+        self.assertEqual(report["estimated_with"], "gzip")
+        self.assertEqual(len(report["packages"]), 3)
+
+    def test_estimated_with(self):
+        """Test which compression the compressed sizes are estimated with"""
+        self.assertEqual(estimated_with("xz"), "xz")
+        self.assertEqual(estimated_with("gzip"), "gzip")
+        self.assertEqual(estimated_with("lz4"), "gzip")
+        self.assertEqual(estimated_with("zstd"), "zstd" if zstd else "gzip")
+        self.assertEqual(PackageSizes(self.root, self.packages, "lz4").report()["estimated_with"], "gzip")
@@ -0,0 +1,135 @@
+#
+# Copyright (C) 2024 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from pylorax.sysutils import joinpaths
+from pylorax.systemdutils import UnitFiles, parse_install_section, split_unit_name
+
+UNITS = {
+    "foo.service": "[Unit]\nDescription=foo\n[Install]\nWantedBy=multi-user.target\n"
+                   "Alias=foo-alias.service\nAlso=bar.socket\n",
+    "bar.socket": "[Socket]\nListenStream=/run/bar\n[Install]\nWantedBy=sockets.target\nRequiredBy=foo.service\n",
+    "getty@.service": "[Service]\nExecStart=/bin/true\n[Install]\nWantedBy=getty.target\nDefaultInstance=tty1\n",
+    "static.service": "[Service]\nExecStart=/bin/true\n",
+    "multi.service": "[Install]\nWantedBy=a.target \\\n  b.target\nWantedBy=\nWantedBy=c.target %p-x.target\n",
+}
+
+OPERATIONS = [("enable", ["foo.service", "getty@.service", "getty@tty2.service", "static.service",
+                          "multi.service", "missing.service"]),
+              ("disable", ["foo.service", "getty@tty2.service"]),
+              ("mask", ["static.service", "nothere.service"]),
+              ("enable", ["static.service"]),
+              ("disable", ["getty@.service", "multi.service"])]
+
+def make_root():
+    root = tempfile.mkdtemp(prefix="lorax.test.systemd.")
+    os.makedirs(joinpaths(root, "/usr/lib/systemd/system"))
+    os.makedirs(joinpaths(root, "/etc/systemd/system"))
+    for name, data in UNITS.items():
+        with open(joinpaths(root, "/usr/lib/systemd/system", name), "w") as f:
+            f.write(data)
+    return root
+
+def get_links(root):
+    links = {}
+    for dirpath, dirs, files in os.walk(os.path.join(root, "etc")):
+        for f in files + dirs:
+            path = os.path.join(dirpath, f)
+            if os.path.islink(path):
+                links[path[len(root):]] = os.readlink(path)
+    return links
+
+class SystemdUtilsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = make_root()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_parse_install_section(self):
+        """Test parsing the [Install] section of a unit file"""
+        install = parse_install_section(joinpaths(self.root, "/usr/lib/systemd/system/multi.service"))
+        self.assertEqual(install["WantedBy"], ["c.target", "%p-x.target"])
+        self.assertEqual(install["Alias"], [])
+
+    def test_split_unit_name(self):
+        """Test splitting unit names"""
+        self.assertEqual(split_unit_name("foo.service"), ("foo", None, "service"))
+        self.assertEqual(split_unit_name("getty@.service"), ("getty", "", "service"))
+        self.assertEqual(split_unit_name("getty@tty1.service"), ("getty", "tty1", "service"))
+
+    def test_enable(self):
+        """Test enabling units"""
+        unitfiles = UnitFiles(self.root)
+        self.assertEqual(unitfiles.enable(OPERATIONS[0][1]), ["missing.service"])
+        self.assertEqual(get_links(self.root), {
+            "/etc/systemd/system/multi-user.target.wants/foo.service": "/usr/lib/systemd/system/foo.service",
+            "/etc/systemd/system/foo-alias.service": "/usr/lib/systemd/system/foo.service",
+            "/etc/systemd/system/sockets.target.wants/bar.socket": "/usr/lib/systemd/system/bar.socket",
+            "/etc/systemd/system/foo.service.requires/bar.socket": "/usr/lib/systemd/system/bar.socket",
+            "/etc/systemd/system/getty.target.wants/getty@tty1.service": "/usr/lib/systemd/system/getty@.service",
+            "/etc/systemd/system/getty.target.wants/getty@tty2.service": "/usr/lib/systemd/system/getty@.service",
+            "/etc/systemd/system/c.target.wants/multi.service": "/usr/lib/systemd/system/multi.service",
+            "/etc/systemd/system/multi-x.target.wants/multi.service": "/usr/lib/systemd/system/multi.service",
+        })
+
+        # Enabling using the alias does not change anything
+        self.assertEqual(unitfiles.enable(["foo-alias.service"]), [])
+        self.assertEqual(len(get_links(self.root)), 8)
+
+    def test_disable_mask(self):
+        """Test disabling and masking units"""
+        unitfiles = UnitFiles(self.root)
+        unitfiles.enable(OPERATIONS[0][1])
+        self.assertEqual(unitfiles.disable(["foo.service", "getty@tty2.service", "missing.service"]),
+                         ["missing.service"])
+        self.assertEqual(sorted(get_links(self.root)), [
+            "/etc/systemd/system/c.target.wants/multi.service",
+            "/etc/systemd/system/getty.target.wants/getty@tty1.service",
+            "/etc/systemd/system/multi-x.target.wants/multi.service",
+        ])
+
+        self.assertEqual(unitfiles.mask(["multi.service", "nothere.service"]), ["nothere.service"])
+        self.assertEqual(os.readlink(joinpaths(self.root, "/etc/systemd/system/nothere.service")), "/dev/null")
+
+        # Masks are not removed by disable, and masked units are not enabled
+        unitfiles.disable(["multi.service"])
+        unitfiles.enable(["multi.service"])
+        self.assertEqual(get_links(self.root), {
+            "/etc/systemd/system/getty.target.wants/getty@tty1.service": "/usr/lib/systemd/system/getty@.service",
+            "/etc/systemd/system/multi.service": "/dev/null",
+            "/etc/systemd/system/nothere.service": "/dev/null",
+        })
+
+    @unittest.skipUnless(shutil.which("systemctl"), "requires systemctl")
+    def test_systemctl(self):
+        """Test that the links are the same as the ones systemctl creates"""
+        systemctl_root = make_root()
+        try:
+            unitfiles = UnitFiles(self.root)
+            for cmd, units in OPERATIONS:
+                getattr(unitfiles, cmd)(units)
+                for unit in units:
+                    subprocess.run(["systemctl", "--root", systemctl_root, "--no-reload", cmd, unit],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+                self.assertEqual(get_links(self.root), get_links(systemctl_root), "%s %s" % (cmd, units))
+        finally:
+            shutil.rmtree(systemctl_root)
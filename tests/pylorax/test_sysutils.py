@@ -18,8 +18,11 @@ import io
 import unittest
 import tempfile
 import os
+import shutil
+from unittest import mock
 
-from pylorax.sysutils import joinpaths, touch, replace, chown_, chmod_, remove, linktree
+from pylorax.sysutils import joinpaths, touch, replace, multi_replace, chown_, chmod_, remove, linktree
+from pylorax.sysutils import PendingRemovals, TreeCopier, CopyStats, cpfile, tree_manifest, compare_manifests
 from pylorax.sysutils import _read_file_end
 
 class SysUtilsTest(unittest.TestCase):
@@ -52,6 +55,26 @@ class SysUtilsTest(unittest.TestCase):
         self.assertEqual(line, "A few words to apply ant eaters testing\n")
         os.unlink(f.name)
 
+    def test_multi_replace(self):
+        """Test replacing several patterns in several files"""
+        with tempfile.TemporaryDirectory() as tdname:
+            fnames = [os.path.join(tdname, f) for f in ["one", "two", "three"]]
+            for f, data in zip(fnames, ["@ONE@ and @TWO@\n@ONE@\n", "@TWO@\n", "nothing\n"]):
+                with open(f, "w") as fobj:
+                    fobj.write(data)
+            os.chmod(fnames[0], 0o600)
+            mtime = os.stat(fnames[2]).st_mtime_ns
+
+            changed = multi_replace(fnames, [("@ONE@", "1"), ("@TWO@", "2"), ("^1$", "one")])
+            self.assertEqual(changed, fnames[:2])
+            with open(fnames[0]) as fobj:
+                self.assertEqual(fobj.read(), "1 and 2\none\n")
+            with open(fnames[1]) as fobj:
+                self.assertEqual(fobj.read(), "2\n")
+            self.assertEqual(os.stat(fnames[0]).st_mode, 0o100600)
+            self.assertEqual(os.stat(fnames[2]).st_mtime_ns, mtime)
+            self.assertEqual(sorted(os.listdir(tdname)), ["one", "three", "two"])
+
     @unittest.skipUnless(os.geteuid() == 0, "requires root privileges")
     def test_chown(self):
         with tempfile.NamedTemporaryFile() as f:
@@ -69,6 +92,36 @@ class SysUtilsTest(unittest.TestCase):
         remove(remove_file)
         self.assertFalse(os.path.exists(remove_file))
 
+    def test_pending_removals(self):
+        """Test batching removals"""
+        with tempfile.TemporaryDirectory() as tdname:
+            for d in ["one/two", "three"]:
+                os.makedirs(os.path.join(tdname, d))
+            for f in ["one/file-a", "one/two/file-b", "three/file-c", "three/file-d"]:
+                with open(os.path.join(tdname, f), "w") as fobj:
+                    fobj.write("test was here")
+            os.symlink(os.path.join(tdname, "three"), os.path.join(tdname, "link-three"))
+
+            pending = PendingRemovals()
+            self.assertTrue(pending.add(os.path.join(tdname, "one/two/file-b")))
+            self.assertTrue(pending.add(os.path.join(tdname, "one")))
+            # Already removed with its parent
+            self.assertFalse(pending.add(os.path.join(tdname, "one/file-a")))
+            self.assertFalse(pending.add(os.path.join(tdname, "one")))
+            # Removes the symlink, not the directory
+            self.assertTrue(pending.add(os.path.join(tdname, "link-three")))
+            # The symlink is gone, so this file cannot be found anymore
+            self.assertFalse(pending.add(os.path.join(tdname, "link-three/file-c")))
+            self.assertTrue(pending.add(os.path.join(tdname, "three/file-d")))
+            self.assertEqual(len(pending), 4)
+
+            # Nothing is removed until it is flushed
+            self.assertTrue(os.path.exists(os.path.join(tdname, "one/two/file-b")))
+            self.assertEqual(pending.flush(), 3)
+            self.assertEqual(len(pending), 0)
+            self.assertEqual(sorted(os.listdir(tdname)), ["three"])
+            self.assertEqual(os.listdir(os.path.join(tdname, "three")), ["file-c"])
+
     def test_linktree(self):
         with tempfile.TemporaryDirectory() as tdname:
             path = os.path.join("one", "two", "three")
@@ -80,6 +133,135 @@ class SysUtilsTest(unittest.TestCase):
 
             self.assertTrue(os.path.exists(os.path.join(tdname, "copy", "two", "three", "lorax-link-test-file")))
 
+    def test_tree_copier(self):
+        with tempfile.TemporaryDirectory() as tdname:
+            src = os.path.join(tdname, "src")
+            os.makedirs(os.path.join(src, "one", "two"))
+            with open(os.path.join(src, "one", "file"), "w") as f:
+                f.write("test was here")
+            os.chmod(os.path.join(src, "one", "file"), 0o4751)
+            os.link(os.path.join(src, "one", "file"), os.path.join(src, "one", "two", "link"))
+            os.symlink("../file", os.path.join(src, "one", "two", "symlink"))
+            with open(os.path.join(src, "sparse"), "wb") as f:
+                f.truncate(64 * 1024**2)
+                f.seek(32 * 1024**2)
+                f.write(b"data")
+            os.utime(os.path.join(src, "one"), (1000000000, 1000000000))
+            try:
+                os.setxattr(os.path.join(src, "one", "file"), "user.lorax", b"test")
+                xattrs = True
+            except OSError:
+                xattrs = False
+
+            stats = CopyStats()
+            TreeCopier(stats=stats).copy(src, os.path.join(tdname, "dst"))
+            dst = os.path.join(tdname, "dst")
+            self.assertEqual((stats.files, stats.links), (2, 1))
+            self.assertEqual(sum(stats.bytes.values()), 64 * 1024**2 + 13)
+
+            with open(os.path.join(dst, "one", "file")) as f:
+                self.assertEqual(f.read(), "test was here")
+            st = os.stat(os.path.join(dst, "one", "file"))
+            self.assertEqual(st.st_mode & 0o7777, 0o4751)
+            self.assertEqual(st.st_ino, os.stat(os.path.join(dst, "one", "two", "link")).st_ino)
+            self.assertEqual(os.readlink(os.path.join(dst, "one", "two", "symlink")), "../file")
+            self.assertEqual(os.stat(os.path.join(dst, "one")).st_mtime, 1000000000)
+            self.assertEqual(os.stat(os.path.join(dst, "sparse")).st_size, 64 * 1024**2)
+            self.assertLess(os.stat(os.path.join(dst, "sparse")).st_blocks * 512, 32 * 1024**2)
+            if xattrs:
+                self.assertEqual(os.getxattr(os.path.join(dst, "one", "file"), "user.lorax"), b"test")
+
+            # Without preserving, symlinks are followed and hardlinks are copied
+            TreeCopier(preserve=False, follow=True).copy(src, os.path.join(tdname, "vfat"))
+            self.assertFalse(os.path.islink(os.path.join(tdname, "vfat", "one", "two", "symlink")))
+            self.assertNotEqual(os.stat(os.path.join(tdname, "vfat", "one", "file")).st_ino,
+                                os.stat(os.path.join(tdname, "vfat", "one", "two", "link")).st_ino)
+
+    def test_tree_copier_merge(self):
+        with tempfile.TemporaryDirectory() as tdname:
+            src = os.path.join(tdname, "src")
+            dst = os.path.join(tdname, "dst")
+            os.makedirs(os.path.join(src, "a"))
+            with open(os.path.join(src, "a", "file"), "w") as f:
+                f.write("new file")
+            os.symlink("file", os.path.join(src, "a", "symlink"))
+            os.chmod(os.path.join(src, "a"), 0o750)
+
+            # Existing directories are kept, other entries are replaced
+            os.makedirs(os.path.join(dst, "a"))
+            with open(os.path.join(dst, "a", "file"), "w") as f:
+                f.write("old file")
+            os.link(os.path.join(dst, "a", "file"), os.path.join(dst, "a", "link"))
+            with open(os.path.join(dst, "a", "symlink"), "w") as f:
+                f.write("not a symlink")
+            with open(os.path.join(dst, "a", "other"), "w") as f:
+                f.write("other file")
+
+            TreeCopier().copy(src, dst)
+            with open(os.path.join(dst, "a", "file")) as f:
+                self.assertEqual(f.read(), "new file")
+            with open(os.path.join(dst, "a", "link")) as f:
+                self.assertEqual(f.read(), "old file")
+            self.assertEqual(os.readlink(os.path.join(dst, "a", "symlink")), "file")
+            self.assertTrue(os.path.exists(os.path.join(dst, "a", "other")))
+            self.assertEqual(os.stat(os.path.join(dst, "a")).st_mode & 0o777, 0o750)
+
+    def test_cpfile_copy_range_zero(self):
+        """Test falling back to read/write when copy_file_range copies nothing"""
+        with tempfile.TemporaryDirectory() as tdname:
+            with open(os.path.join(tdname, "file"), "w") as f:
+                f.write("test was here")
+
+            stats = CopyStats()
+            with mock.patch("pylorax.sysutils.fcntl.ioctl", side_effect=OSError), \
+                 mock.patch("pylorax.sysutils.os.copy_file_range", return_value=0):
+                cpfile(os.path.join(tdname, "file"), os.path.join(tdname, "copy"), stats)
+            with open(os.path.join(tdname, "copy")) as f:
+                self.assertEqual(f.read(), "test was here")
+            self.assertEqual(stats.bytes["read/write"], 13)
+
+    def test_compare_manifests(self):
+        with tempfile.TemporaryDirectory() as tdname:
+            os.makedirs(os.path.join(tdname, "a", "b"))
+            with open(os.path.join(tdname, "a", "file"), "w") as f:
+                f.write("test was here")
+            os.symlink("file", os.path.join(tdname, "a", "symlink"))
+            os.makedirs(os.path.join(tdname, "var", "lib", "rpm"))
+            reference = tree_manifest(tdname)
+            self.assertEqual(reference["/a/file"], ["f", 13])
+            self.assertEqual(reference["/a/symlink"], ["l", "file"])
+            self.assertEqual(reference["/a/b"], ["d", None])
+            self.assertEqual(compare_manifests(tree_manifest(tdname), reference), ([], [], []))
+
+            # A cache made by a scriptlet, a different size, and a missing directory
+            with open(os.path.join(tdname, "a", "file"), "w") as f:
+                f.write("test")
+            with open(os.path.join(tdname, "a", "cache"), "w") as f:
+                f.write("cache")
+            with open(os.path.join(tdname, "var", "lib", "rpm", "rpmdb.sqlite"), "w") as f:
+                f.write("rpmdb")
+            os.rmdir(os.path.join(tdname, "a", "b"))
+            self.assertEqual(compare_manifests(tree_manifest(tdname), reference, ["/var/lib/rpm"]),
+                             (["/a/b"], ["/a/cache"], ["/a/file"]))
+
+    def test_cpfile(self):
+        with tempfile.TemporaryDirectory() as tdname:
+            with open(os.path.join(tdname, "file"), "w") as f:
+                f.write("test was here")
+            os.chmod(os.path.join(tdname, "file"), 0o640)
+            os.makedirs(os.path.join(tdname, "dir"))
+
+            stats = CopyStats()
+            self.assertEqual(cpfile(os.path.join(tdname, "file"), os.path.join(tdname, "dir"), stats),
+                             os.path.join(tdname, "dir", "file"))
+            self.assertEqual(stats.files, 1)
+            with open(os.path.join(tdname, "dir", "file")) as f:
+                self.assertEqual(f.read(), "test was here")
+            self.assertEqual(os.stat(os.path.join(tdname, "dir", "file")).st_mode & 0o777, 0o640)
+
+            with self.assertRaises(shutil.SameFileError):
+                cpfile(os.path.join(tdname, "file"), os.path.join(tdname, "file"))
+
     def _generate_lines(self, unicode=False):
         # helper to generate several KiB of lines of text
         bio = io.BytesIO()
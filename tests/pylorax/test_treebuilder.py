@@ -15,7 +15,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 from contextlib import contextmanager
+import glob
 import os
+import re
 from rpmfluff import SimpleRpmBuild, SourceFile, expectedArch
 import shutil
 import tempfile
@@ -23,7 +25,7 @@ import unittest
 
 from pylorax import ArchData, DataHolder
 from pylorax.dnfbase import get_dnf_base_object
-from pylorax.treebuilder import RuntimeBuilder
+from pylorax.treebuilder import RuntimeBuilder, INSTALLROOT_PATHS
 
 # TODO Put these into a common test library location
 @contextmanager
@@ -147,3 +149,17 @@ class InstallBrandingTestCase(unittest.TestCase):
             branding = self.install_branding(repo_dir, skip_branding=True)
             self.assertEqual(branding.release, None)
             self.assertEqual(branding.logos, None)
+
+
+class InstallRootPathsTestCase(unittest.TestCase):
+    def test_arch_template_paths(self):
+        """Test that the installroot paths used by the arch templates are always installed"""
+        paths_re = re.compile(r'(?:^|[\s"=(+])/?((?:boot|etc|usr|var)/[^\s"$]*)')
+        for tmpl in glob.glob("./share/templates.d/99-generic/*.tmpl"):
+            if os.path.basename(tmpl).startswith("runtime-"):
+                continue
+            with open(tmpl) as f:
+                for path in paths_re.findall(f.read()):
+                    path = "/" + path.rstrip("/")
+                    self.assertTrue(any(path == p or path.startswith(p + "/") for p in INSTALLROOT_PATHS),
+                                    "%s uses %s" % (tmpl, path))